@@ -0,0 +1,176 @@
+from __future__ import print_function, unicode_literals, division
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import Thread
+
+from ipy.LoggingBase import LoggingBase	# the root LoggingBase module only has ClassLoggingBase, without log_to.
+from GraphiteRunnerBase import GraphiteRunnerBase
+
+class AsyncSqlMonitorGraphiteRunner(GraphiteRunnerBase, LoggingBase):
+
+
+	def __init__(self, loop=None, max_workers=None, **kwargs):
+		""" An alternative to SqlMonitorGraphiteRunner which schedules all work as coroutines on a single asyncio event loop
+			instead of one System.Threading.Timer per object, and so runs under CPython 3.
+			Each second, every added server's look_for_work is run in a thread pool of max_workers threads (blocking
+			database calls never run on the loop), and enqueued metrics are sent to graphite.  Exporters added with
+			add_exporter (e.g. GraphiteSqlPersist) are run on the loop in the same way, every five seconds.
+
+			If no loop is passed, the runner creates one and runs it on a background thread from start until quit, so that
+			start, pause and quit behave as they do on SqlMonitorGraphiteRunner.  A loop that is passed must be run by the caller.
+			The 'pickle' protocol defaults to non-blocking writes here, so that a slow carbon cannot stall the loop.
+		"""
+		self._owns_loop = loop is None
+		self._loop = asyncio.new_event_loop() if self._owns_loop else loop
+		self._loop_thread = None
+		self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+		self._exporters = []
+		self._tasks = []
+		self._is_shut_down = False
+
+		if kwargs.get('protocol') == 'pickle' and 'wait_for_write' not in kwargs:
+			kwargs['wait_for_write'] = False
+
+		super(AsyncSqlMonitorGraphiteRunner, self).__init__(**kwargs)
+		self.info(">>>>>>>>>>>>>>>>>>LET'S!>>START!>>RUNNING!!!>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
+
+	loop = property(lambda self: self._loop, None, None
+		, 'The event loop on which all polling, sending and exporting is scheduled.')
+
+	is_running = property(lambda self: bool(self._tasks))
+
+	@LoggingBase.log_to('debug', log_with_params=True)
+	def add_exporter(self, exporter):
+		""" Adds an object scheduled by calling its look_for_work every five seconds (e.g. GraphiteSqlPersist).
+			The exporter's prepare method is called with this runner on start.
+		"""
+		self._exporters.append(exporter)
+		return self
+
+	@LoggingBase.log_to('debug', log_with_params=True)
+	def start(self, graphite_server=None, graphite_port=None, echo=None):
+		""" On start, the runner passes its queue to all added servers as a place to store graphite metric results,
+			and prepares all added exporters.  Polling, sending and exporting then begin on the event loop.
+		"""
+		self.configure(graphite_server, graphite_port, echo)
+		for server_name in self._servers:
+			self[server_name].attach(self._queue)
+		for exporter in self._exporters:
+			exporter.prepare(self)
+		self.start_relays()
+
+		return self.run()
+
+	@LoggingBase.log_to('debug')
+	def run(self):
+		if self._owns_loop and self._loop_thread is None:
+			self._loop_thread = Thread(target=self._loop.run_forever, name='AsyncSqlMonitorGraphiteRunner')
+			self._loop_thread.daemon = True
+			self._loop_thread.start()
+
+		self._loop.call_soon_threadsafe(self.__schedule)
+		return self
+
+	@LoggingBase.log_to('debug')
+	def pause(self):
+		self._loop.call_soon_threadsafe(self.__cancel)
+
+	@LoggingBase.log_to('debug')
+	def quit(self, drain_seconds=None):
+		return self.shutdown(drain_seconds)
+
+	def __del__(self):
+		self.shutdown()
+
+	def shutdown(self, drain_seconds=None):
+		""" Stops all scheduled work, then sends whatever remains enqueued until the queue is empty or drain_seconds
+			(default: shutdown_drain_seconds) pass.  Returns the number of items left unsent.
+			Must not be called from the event loop's own thread.
+		"""
+		if self._is_shut_down:
+			return 0
+
+		unsent = 0
+		try:
+			if self._loop.is_running():
+				asyncio.run_coroutine_threadsafe(self.__stop(), self._loop).result()
+			self._executor.shutdown(wait=True)
+			self.stop_relays()
+			unsent = self.drain_for_shutdown(drain_seconds)
+		except (Exception) as e:
+			self.exception(e)
+			raise e
+		finally:
+			self._is_shut_down = True
+			self.close_connections()
+			if self._owns_loop:
+				self._loop.call_soon_threadsafe(self._loop.stop)
+				if self._loop_thread is not None:
+					self._loop_thread.join()
+				self._loop.close()
+
+		return unsent
+
+	def __schedule(self):
+		""" Creates the polling, sending and exporting tasks.  Runs on the event loop. """
+		if self._tasks:
+			return
+
+		self._tasks.append(self._loop.create_task(self.every(1, self.send_tick)))
+		for server_name in self._servers:
+			self._tasks.append(self._loop.create_task(self.every(1, self.poll_server, self[server_name])))
+		for exporter in self._exporters:
+			self._tasks.append(self._loop.create_task(self.every(5, self.export_tick, exporter)))
+
+	def __cancel(self):
+		for task in self._tasks:
+			task.cancel()
+		tasks, self._tasks = self._tasks, []
+		return tasks
+
+	async def __stop(self):
+		tasks = self.__cancel()
+		if tasks:
+			await asyncio.gather(*tasks, return_exceptions=True)
+
+	async def every(self, interval_seconds, coroutine_function, *args):
+		""" Awaits coroutine_function(*args) every interval_seconds, until it returns False or the task is cancelled.
+			A call that runs longer than the interval delays the next call rather than overlapping it.
+		"""
+		next_run = self._loop.time()
+		while True:
+			try:
+				if await coroutine_function(*args) is False:
+					return
+			except (asyncio.CancelledError):
+				raise
+			except (Exception) as e:
+				self.exception(e)
+
+			next_run += interval_seconds
+			delay = next_run - self._loop.time()
+			if delay < 0:
+				next_run = self._loop.time()
+				delay = 0
+			await asyncio.sleep(delay)
+
+	async def poll_server(self, server):
+		""" Runs the server's look_for_work (which calls any scheduled metrics) in the thread pool. """
+		await self._loop.run_in_executor(self._executor, server.look_for_work)
+
+	async def export_tick(self, exporter):
+		""" Runs the exporter's look_for_work in the thread pool.  Returns False once the exporter's cutoff has passed. """
+		await self._loop.run_in_executor(self._executor, exporter.look_for_work)
+		return datetime.now() <= exporter.cutoff_dt
+
+	async def send_tick(self):
+		""" Sends enqueued items to the graphite server & port within the per tick budget of max_items_per_tick and
+			max_seconds_per_tick, yielding to the event loop between chunks.  Returns the number of items sent.
+		"""
+		for step in self.drain_steps(self.max_items_per_tick, time.time() + self.max_seconds_per_tick):
+			await asyncio.sleep(0)
+		return self.last_line_count
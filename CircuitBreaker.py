@@ -0,0 +1,76 @@
+from __future__ import print_function, unicode_literals, division
+
+import time
+
+class CircuitBreaker(object):
+
+	states = ('closed', 'open', 'half_open')
+
+	def __init__(self, failure_threshold=3, cooldown_seconds=300):
+		""" Stops calling something which keeps failing.  While closed, every call is allowed; after failure_threshold
+			consecutive failures the breaker trips open, and calls are skipped for cooldown_seconds.  The first call after
+			the cooldown is allowed as a probe (half open): its success closes the breaker, and its failure opens it again
+			for another cooldown.
+		"""
+		if failure_threshold < 1:
+			raise Exception('A circuit breaker must trip after at least one failure.  User specified: {}'.format(failure_threshold))
+		self._failure_threshold = failure_threshold
+		self._cooldown_seconds = cooldown_seconds
+		self._state = 'closed'
+		self._consecutive_failures = 0
+		self._opened_at = None
+
+		self._failure_count = 0
+		self._trip_count = 0
+		self._skip_count = 0
+		self._probe_count = 0
+
+	failure_threshold = property(lambda self: self._failure_threshold)
+
+	cooldown_seconds = property(lambda self: self._cooldown_seconds)
+
+	state = property(lambda self: self._state)
+
+	is_closed = property(lambda self: self._state == 'closed')
+
+	failure_count = property(lambda self: self._failure_count, None, None
+		, 'The number of failures recorded.')
+
+	trip_count = property(lambda self: self._trip_count, None, None
+		, 'The number of times the breaker opened.')
+
+	skip_count = property(lambda self: self._skip_count, None, None
+		, 'The number of calls skipped while the breaker was open.')
+
+	probe_count = property(lambda self: self._probe_count, None, None
+		, 'The number of calls allowed after a cooldown, to test whether to close the breaker.')
+
+	def counters(self):
+		return dict(failures=self._failure_count, trips=self._trip_count, skips=self._skip_count, probes=self._probe_count)
+
+	def allow(self, at_time=None):
+		""" Returns True if a call should be made now.  A skipped call is counted. """
+		if self._state == 'closed':
+			return True
+		at_time = at_time if at_time is not None else time.time()
+		if self._state == 'open' and at_time - self._opened_at >= self._cooldown_seconds:
+			self._state = 'half_open'
+			self._probe_count += 1
+			return True
+		self._skip_count += 1
+		return False
+
+	def record_success(self):
+		self._state = 'closed'
+		self._consecutive_failures = 0
+
+	def record_failure(self, at_time=None):
+		""" Records a failed call.  Returns True if the breaker tripped open. """
+		self._failure_count += 1
+		self._consecutive_failures += 1
+		if self._state == 'half_open' or self._consecutive_failures >= self._failure_threshold:
+			self._state = 'open'
+			self._opened_at = at_time if at_time is not None else time.time()
+			self._trip_count += 1
+			return True
+		return False
@@ -0,0 +1,213 @@
+from __future__ import print_function, unicode_literals, division
+
+import bisect
+import socket
+import time
+from hashlib import md5
+
+from GraphiteSender import PartialSendError
+from MetricBatch import iter_datapoints, batch_datapoints
+
+def format_node_key(node):
+	""" Returns the string carbon hashes for a ring node: the repr of its (server, instance) tuple, e.g. "('carbon1', 'a')".
+		Built explicitly so that unicode strings are not written with a u prefix under python 2.
+	"""
+	server, instance = node
+	return "('{}', {})".format(server, "'{}'".format(instance) if instance is not None else 'None')
+
+class ConsistentHashRing(object):
+
+
+	def __init__(self, nodes=None, replica_count=100):
+		""" A consistent hash ring which places nodes and metric paths exactly as carbon-relay's ConsistentHashRing does with
+			its default md5 hash type: each (server, instance) node is placed at replica_count positions, given by the first
+			two bytes of the md5 of "<<node key>>:<<replica number>>".  A path belongs to the first node at or after its own position.
+			As in carbon, a replica whose position is already taken is moved up to the next free position, so nodes must be
+			added in the same order as carbon-relay's destinations for the rings to agree.
+		"""
+		self._replica_count = replica_count
+		self._nodes = set()
+		self._ring = []	# sorted (position, server, instance or '') entries, matching the order of carbon's (position, node) entries
+		self._entry_nodes = {}
+		self._positions = set()
+
+		for node in (nodes or []):
+			self.add_node(node)
+
+	nodes = property(lambda self: set(self._nodes))
+
+	def compute_ring_position(self, key):
+		return int(md5(key.encode('utf-8')).hexdigest()[:4], 16)
+
+	def add_node(self, node):
+		self._nodes.add(node)
+		node_key = format_node_key(node)
+		for i in range(self._replica_count):
+			position = self.compute_ring_position("{}:{}".format(node_key, i))
+			while position in self._positions:
+				position += 1
+			self._positions.add(position)
+			entry = (position, node[0], node[1] if node[1] is not None else '')
+			self._entry_nodes[entry] = node
+			bisect.insort(self._ring, entry)
+
+	def remove_node(self, node):
+		self._nodes.discard(node)
+		self._ring = [entry for entry in self._ring if self._entry_nodes[entry] != node]
+		self._entry_nodes = dict([(entry, self._entry_nodes[entry]) for entry in self._ring])
+		self._positions = set([entry[0] for entry in self._ring])
+
+	def get_node(self, key):
+		return next(self.get_nodes(key), None)
+
+	def get_nodes(self, key):
+		""" Generator function yields each distinct node in ring order, starting from the node which owns the key. """
+		if not self._ring:
+			return
+		index = bisect.bisect_left(self._ring, (self.compute_ring_position(key), )) % len(self._ring)
+		seen = set()
+		for i in range(len(self._ring)):
+			node = self._entry_nodes[self._ring[(index + i) % len(self._ring)]]
+			if node not in seen:
+				seen.add(node)
+				yield node
+				if len(seen) == len(self._nodes):
+					return
+
+class GraphiteDestinationSet(object):
+
+
+	def __init__(self, destinations, sender_class, sender_kwargs=None, replication_factor=1, down_seconds=30):
+		""" Sends each metric to replication_factor of N carbon destinations, chosen by the metric path's place on a
+			ConsistentHashRing.  Destinations are (server, port) or (server, port, instance) tuples; as in carbon-relay,
+			only server & instance determine placement on the ring.  Each destination gets its own sender_class instance.
+
+			A destination whose send fails is marked down for down_seconds, and its items fail over to the next destination
+			on the ring which is up (and not already a replica for the item).  Items which cannot be placed on any destination
+			are raised with a PartialSendError.
+		"""
+		self._replication_factor = replication_factor
+		self._down_seconds = down_seconds
+		self._ring = ConsistentHashRing()
+		self._senders = {}
+		self._down_until = {}
+		self._failover_count = 0
+
+		for destination in destinations:
+			server, port = destination[0], destination[1]
+			instance = destination[2] if len(destination) > 2 else None
+			node = (server, instance)
+			if node in self._senders:
+				raise Exception('The destination {} was specified more than once.'.format(destination))
+			self._senders[node] = sender_class(server, port, **(sender_kwargs or {}))
+			self._ring.add_node(node)
+
+		if replication_factor > len(self._senders):
+			raise Exception('The replication factor ({}) cannot exceed the number of destinations ({}).'.format(replication_factor, len(self._senders)))
+
+	ring = property(lambda self: self._ring)
+
+	replication_factor = property(lambda self: self._replication_factor)
+
+	failover_count = property(lambda self: self._failover_count, None, None
+		, 'The number of items re-routed to another destination because their destination was down.')
+
+	# the first destination stands in for the graphite server & port, e.g. when building render urls.
+	graphite_server = property(lambda self: sorted(self._senders)[0][0])
+
+	graphite_port = property(lambda self: self._senders[sorted(self._senders)[0]].graphite_port)
+
+	max_datagram_bytes = property(lambda self: getattr(self._senders[sorted(self._senders)[0]], 'max_datagram_bytes', None), None, None
+		, 'The largest UDP payload of the destinations\' senders.')
+	@max_datagram_bytes.setter
+	def max_datagram_bytes(self, value):
+		for sender in self._senders.values():
+			sender.max_datagram_bytes = value
+
+	is_backing_off = property(lambda self: all([getattr(sender, 'is_backing_off', False) for sender in self._senders.values()])
+		, None, None, 'True while every destination\'s sender is waiting out its reconnect back off.')
+
+	def __getitem__(self, node):
+		return self._senders[node]
+
+	def is_up(self, node, at_time=None):
+		return self._down_until.get(node, 0) <= (at_time if at_time is not None else time.time())
+
+	def mark_down(self, node, down_seconds=None):
+		self._down_until[node] = time.time() + (down_seconds if down_seconds is not None else self._down_seconds)
+
+	def mark_up(self, node):
+		self._down_until.pop(node, None)
+
+	def down_nodes(self):
+		now = time.time()
+		return set([node for node in self._senders if not self.is_up(node, now)])
+
+	def route(self, path, down=frozenset()):
+		""" Returns the replication_factor destinations for the path, skipping destinations in down. """
+		nodes = []
+		for node in self._ring.get_nodes(path):
+			if node not in down:
+				nodes.append(node)
+				if len(nodes) == self._replication_factor:
+					break
+		return nodes
+
+	def failover_node(self, path, routed_down, down):
+		""" Returns the next destination on the ring for a path, after the destinations it was routed to while routed_down
+			were down, skipping all destinations now down.  Returns None when no such destination is up.
+		"""
+		replicas = set(self.route(path, routed_down))
+		for node in self._ring.get_nodes(path):
+			if node not in replicas and node not in down:
+				return node
+		return None
+
+	def send(self, items):
+		""" Sends each datapoint of the items (or batches) to its destinations, as MetricBatch records per destination.
+			Returns the total number of datagrams (or pickled batches) sent.
+		"""
+		routed_down = self.down_nodes()
+		groups = {}	# node: (path, value, timestamp) datapoints
+		unsent = []
+		for datapoint in iter_datapoints(items):
+			nodes = self.route(datapoint[0], routed_down)
+			if not nodes:
+				unsent.append(datapoint)
+			for node in nodes:
+				groups.setdefault(node, []).append(datapoint)
+
+		sent = 0
+		down = set(routed_down)
+		unsent_ids = set([id(datapoint) for datapoint in unsent])
+		while groups:
+			node, datapoints = groups.popitem()
+			try:
+				sent += self._senders[node].send(batch_datapoints(datapoints))
+			except (socket.error) as e:
+				self.mark_down(node)
+				down.add(node)
+				if isinstance(e, PartialSendError):	# only re-route the datapoints the destination did not take.
+					not_taken = set(iter_datapoints(e.unsent_items))
+					datapoints = [datapoint for datapoint in datapoints if datapoint in not_taken]
+				for datapoint in datapoints:
+					failover = self.failover_node(datapoint[0], routed_down, down)
+					if failover is None:
+						if id(datapoint) not in unsent_ids:
+							unsent_ids.add(id(datapoint))
+							unsent.append(datapoint)
+					else:
+						self._failover_count += 1
+						groups.setdefault(failover, []).append(datapoint)
+
+		if unsent:
+			raise PartialSendError(batch_datapoints(unsent), "{} datapoints could not be sent; destinations down: {}".format(
+				len(unsent), sorted(down)))
+		return sent
+
+	def flush(self):
+		return sum([sender.flush() for sender in self._senders.values()])
+
+	def close(self):
+		for sender in self._senders.values():
+			sender.close()
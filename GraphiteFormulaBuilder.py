@@ -259,6 +259,14 @@ class GraphiteSqlPersist(SqlConnection):
 
 	@SqlConnection.log_to('debug')
 	def start(self, graphite=None):
+		self.prepare(graphite)
+		self.run()
+
+	@SqlConnection.log_to('debug')
+	def prepare(self, graphite=None):
+		""" Marks the start of a new export batch, without starting the timer.  Used by runners which schedule
+			look_for_work themselves.
+		"""
 		if graphite:
 			self._graphite = graphite
 			self.graphite_server = graphite.graphite_server
@@ -268,7 +276,7 @@ class GraphiteSqlPersist(SqlConnection):
 		self.next_export_dt = self.start_dt + timedelta(seconds=self.export_interval_seconds)
 
 		self._batch_id = self.mark_batch_start()
-		self.run()
+		return self
 
 	@SqlConnection.log_to('debug')
 	def run(self):
@@ -0,0 +1,393 @@
+from __future__ import print_function, unicode_literals, division
+
+import io
+import pickle
+import re
+import socket
+import struct
+import time
+from threading import Event, Lock, Thread
+
+from MetricAggregation import MetricWindow, rollup_functions
+from MetricBatch import batch_datapoints, intern_path
+
+aggregation_rule_pattern = re.compile(r'^\s*(?P<output>\S+)\s+\((?P<frequency>\d+)\)\s*=\s*(?P<method>\w+)\s+(?P<input>\S+)\s*$')
+
+class SafeUnpickler(pickle.Unpickler):
+	""" Unpickles only plain data (lists, tuples, strings & numbers), as carbon's own receiver does, since a pickle which
+		references a class or function could run arbitrary code.
+	"""
+
+	def find_class(self, module, name):
+		raise pickle.UnpicklingError('Pickled metrics may not reference {}.{}'.format(module, name))
+
+def unpickle_datapoints(payload):
+	""" Returns (path, value, timestamp) tuples from a carbon pickle payload of [(path, (timestamp, value)), ...]. """
+	datapoints = []
+	for path, (timestamp, value) in SafeUnpickler(io.BytesIO(payload)).load():
+		if isinstance(path, bytes):
+			path = path.decode('utf-8')
+		datapoints.append((intern_path(path), float(value), int(float(timestamp))))
+	return datapoints
+
+def parse_plaintext_line(line):
+	""" Returns the (path, value, timestamp) tuple of a graphite plaintext line, or None when the line is malformed. """
+	try:
+		path, value, timestamp = line.decode('utf-8').split()
+		return intern_path(path), float(value), int(float(timestamp))
+	except (ValueError, UnicodeDecodeError):
+		return None
+
+class AggregationRule(object):
+
+
+	def __init__(self, input_pattern, output_pattern, method='sum', frequency_seconds=60):
+		""" A carbon-aggregator style rule, which combines every metric path matching input_pattern into the output path,
+			with the method (any of avg, min, max, last, sum & count) over windows of frequency_seconds.
+			In input_pattern, "*" matches within one node, "<name>" captures one node and "<<name>>" captures one or more
+			nodes; each captured <name> is substituted into output_pattern.
+			e.g. "ceci.all.5seconds.waits.<metric>" from "ceci.*.5seconds.waits.<metric>" sums a wait over all collectors.
+		"""
+		if method not in rollup_functions:
+			raise Exception('The aggregation method must be one of {}.  User specified: {}'.format(rollup_functions, method))
+
+		self._input_pattern = input_pattern
+		self._output_pattern = output_pattern
+		self._method = method
+		self._frequency_seconds = frequency_seconds
+		self._regex = re.compile(self.build_regex(input_pattern))
+		self._outputs = {}	# metric path: its output path, or None when it does not match
+
+	input_pattern = property(lambda self: self._input_pattern)
+
+	output_pattern = property(lambda self: self._output_pattern)
+
+	method = property(lambda self: self._method)
+
+	frequency_seconds = property(lambda self: self._frequency_seconds)
+
+	@classmethod
+	def parse(cls, line):
+		""" Returns a rule from a line of carbon's aggregation-rules.conf format:
+			"output_template (frequency) = method input_pattern".
+		"""
+		m = aggregation_rule_pattern.match(line)
+		if not m:
+			raise Exception('The aggregation rule must be formatted "output_template (frequency) = method input_pattern".  User specified: {}'.format(line))
+		return cls(m.group('input'), m.group('output'), m.group('method'), int(m.group('frequency')))
+
+	def build_regex(self, input_pattern):
+		regex = ''
+		for token in re.split(r'(<<\w+>>|<\w+>|\*)', input_pattern):
+			if token == '*':
+				regex += r'[^.]*'
+			elif token.startswith('<<'):
+				regex += r'(?P<{}>.+)'.format(token[2:-2])
+			elif token.startswith('<'):
+				regex += r'(?P<{}>[^.]+)'.format(token[1:-1])
+			else:
+				regex += re.escape(token)
+		return '^' + regex + '$'
+
+	def get_output(self, path):
+		""" Returns the output path for a metric path, or None when the path does not match the rule. """
+		if path in self._outputs:
+			return self._outputs[path]
+		output = None
+		m = self._regex.match(path)
+		if m:
+			output = self._output_pattern
+			for name, value in m.groupdict().items():
+				output = output.replace('<{}>'.format(name), value)
+			output = intern_path(output)
+		self._outputs[path] = output
+		return output
+
+class RelayAggregator(object):
+
+
+	def __init__(self, rules, delay_seconds=5):
+		""" Combines datapoints across sources by the AggregationRules passed (or lines of aggregation-rules.conf).
+			A window of an output path is completed delay_seconds after its end, to allow for late senders.
+		"""
+		self._rules = [AggregationRule.parse(rule) if not isinstance(rule, AggregationRule) else rule for rule in rules]
+		self._delay_seconds = delay_seconds
+		self._windows = {}	# (output path, window start): (rule, MetricWindow)
+		self._lock = Lock()
+
+	rules = property(lambda self: list(self._rules))
+
+	window_count = property(lambda self: len(self._windows))
+
+	def add(self, path, value, timestamp):
+		""" Adds the datapoint to the window of each rule's output path which it matches.  Returns True if any rule matched. """
+		matched = False
+		for rule in self._rules:
+			output = rule.get_output(path)
+			if output is None:
+				continue
+			matched = True
+			start = int(timestamp) - (int(timestamp) % rule.frequency_seconds)
+			with self._lock:
+				entry = self._windows.get((output, start))
+				if entry is None:
+					self._windows[(output, start)] = (rule, MetricWindow(start, value))
+				else:
+					entry[1].add(value)
+		return matched
+
+	def flush(self, at_time=None, force=False):
+		""" Returns the (path, value, timestamp) datapoints of each window completed by the epoch time at_time (or of
+			every window, when force is True).
+		"""
+		at_time = at_time if at_time is not None else time.time()
+		datapoints = []
+		with self._lock:
+			for (output, start), (rule, window) in list(self._windows.items()):
+				if force or start + rule.frequency_seconds + self._delay_seconds <= at_time:
+					del self._windows[(output, start)]
+					datapoints.append((output, window.rollup(rule.method), start))
+		return sorted(datapoints, key=lambda datapoint: datapoint[2])
+
+class GraphiteRelay(object):
+
+
+	def __init__(self, host='', plaintext_port=2003, pickle_port=2004, udp=True, tcp=True, aggregation_rules=None
+			, aggregate_delay_seconds=5, forward_aggregated=True, priority='normal', max_pickle_bytes=1048576):
+		""" Listens for metrics sent by other collectors (or anything speaking carbon's protocols) and merges them into a
+			runner's queue, so that several collectors funnel through one process.  Plaintext lines are accepted over UDP
+			and TCP on plaintext_port, and carbon pickles over TCP on pickle_port.  Pass None as a port to not listen on it.
+
+			With aggregation_rules (AggregationRules, or lines of carbon's aggregation-rules.conf), matching datapoints are
+			also combined across sources, and the aggregates are enqueued once their window completes.  Set forward_aggregated
+			to False to not forward the datapoints which matched a rule.
+		"""
+		self._host = host
+		self._plaintext_port = plaintext_port
+		self._pickle_port = pickle_port
+		self._udp = udp
+		self._tcp = tcp
+		self._aggregator = RelayAggregator(aggregation_rules, aggregate_delay_seconds) if aggregation_rules else None
+		self._forward_aggregated = forward_aggregated
+		self._priority = priority
+		self._max_pickle_bytes = max_pickle_bytes
+
+		self._queue = None
+		self._stopping = Event()
+		self._sockets = []
+		self._connections = set()
+		self._threads = []
+		self._lock = Lock()
+
+		self._received_count = 0
+		self._invalid_count = 0
+		self._connection_count = 0
+		self._aggregated_count = 0
+
+	aggregator = property(lambda self: self._aggregator, None, None
+		, 'The RelayAggregator which combines datapoints across sources, or None.')
+
+	is_running = property(lambda self: bool(self._threads) and not self._stopping.is_set())
+
+	received_count = property(lambda self: self._received_count, None, None
+		, 'The number of datapoints received.')
+
+	invalid_count = property(lambda self: self._invalid_count, None, None
+		, 'The number of malformed lines and pickles received.')
+
+	connection_count = property(lambda self: self._connection_count, None, None
+		, 'The number of TCP connections accepted.')
+
+	aggregated_count = property(lambda self: self._aggregated_count, None, None
+		, 'The number of aggregate datapoints enqueued.')
+
+	def counters(self):
+		return dict(received=self._received_count, invalid=self._invalid_count, connections=self._connection_count
+			, aggregated=self._aggregated_count)
+
+	def attach(self, queue):
+		""" Sets the queue in which received metrics are enqueued. """
+		self._queue = queue
+		return self
+
+	def start(self):
+		if self._queue is None:
+			raise Exception('The relay must be attached to a queue before it is started.')
+		self._stopping.clear()
+		if self._plaintext_port is not None and self._udp:
+			s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			s.bind((self._host, self._plaintext_port))
+			self.__listen(s, self.serve_udp)
+		if self._plaintext_port is not None and self._tcp:
+			self.__listen(self.__tcp_socket(self._plaintext_port), self.serve_tcp, self.read_plaintext)
+		if self._pickle_port is not None:
+			self.__listen(self.__tcp_socket(self._pickle_port), self.serve_tcp, self.read_pickle)
+		return self
+
+	def __tcp_socket(self, port):
+		s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		s.bind((self._host, port))
+		s.listen(16)
+		return s
+
+	def __listen(self, s, target, *args):
+		s.settimeout(1.0)	# so that listening threads notice when the relay stops.
+		self._sockets.append(s)
+		self.__start_thread(target, s, *args)
+
+	def __start_thread(self, target, *args):
+		t = Thread(target=target, args=args, name='GraphiteRelay')
+		t.daemon = True
+		t.start()
+		self._threads.append(t)
+
+	def stop(self, join_seconds=2.0):
+		""" Stops listening and closes all connections, then waits up to join_seconds in all for the relay's threads to end.
+			Aggregates not yet completed are left for flush_aggregates(force=True).
+		"""
+		self._stopping.set()
+		with self._lock:
+			for s in self._sockets + list(self._connections):
+				try:
+					s.shutdown(socket.SHUT_RDWR)	# wakes a thread blocked in recv on the socket, which close alone may not.
+				except (socket.error):
+					pass
+				try:
+					s.close()
+				except (socket.error):
+					pass
+			self._sockets = []
+			self._connections.clear()
+		deadline = time.time() + join_seconds
+		for t in self._threads:
+			t.join(max(deadline - time.time(), 0))
+		self._threads = []
+
+	def __count(self, received=0, invalid=0, connections=0, aggregated=0):
+		""" Adds to the counters, which the relay's connection threads update concurrently. """
+		with self._lock:
+			self._received_count += received
+			self._invalid_count += invalid
+			self._connection_count += connections
+			self._aggregated_count += aggregated
+
+	def receive(self, datapoints):
+		""" Enqueues received (path, value, timestamp) datapoints, and adds them to the aggregates. """
+		if not datapoints:
+			return
+		self.__count(received=len(datapoints))
+		if self._aggregator is not None:
+			datapoints = [datapoint for datapoint in datapoints if not self._aggregator.add(*datapoint) or self._forward_aggregated]
+		for batch in batch_datapoints(datapoints, self._priority):
+			self._queue.Enqueue(batch)
+
+	def poll(self, at_time=None, force=False):
+		""" Called by the runner on each send tick (and with force True once stopped): enqueues completed aggregates. """
+		return self.flush_aggregates(at_time, force)
+
+	def flush_aggregates(self, at_time=None, force=False):
+		""" Enqueues the aggregates of completed windows.  Returns the number of datapoints enqueued. """
+		if self._aggregator is None or self._queue is None:
+			return 0
+		datapoints = self._aggregator.flush(at_time, force)
+		for batch in batch_datapoints(datapoints, self._priority):
+			self._queue.Enqueue(batch)
+		self.__count(aggregated=len(datapoints))
+		return len(datapoints)
+
+	def parse_lines(self, data):
+		datapoints = []
+		invalid = 0
+		for line in data.splitlines():
+			if not line.strip():
+				continue
+			datapoint = parse_plaintext_line(line)
+			if datapoint is None:
+				invalid += 1
+			else:
+				datapoints.append(datapoint)
+		if invalid:
+			self.__count(invalid=invalid)
+		return datapoints
+
+	def serve_udp(self, s):
+		while not self._stopping.is_set():
+			try:
+				data, address = s.recvfrom(65535)
+			except (socket.timeout):
+				continue
+			except (socket.error):
+				break
+			self.receive(self.parse_lines(data))
+
+	def serve_tcp(self, s, reader):
+		while not self._stopping.is_set():
+			try:
+				connection, address = s.accept()
+			except (socket.timeout):
+				continue
+			except (socket.error):
+				break
+			connection.settimeout(None)
+			with self._lock:
+				if self._stopping.is_set():
+					connection.close()
+					break
+				self._connections.add(connection)
+			self.__count(connections=1)
+			self.__start_thread(self.serve_connection, connection, reader)
+
+	def serve_connection(self, connection, reader):
+		try:
+			reader(connection)
+		except (socket.error, EOFError):
+			pass
+		finally:
+			with self._lock:
+				self._connections.discard(connection)
+			connection.close()
+
+	def read_plaintext(self, connection):
+		""" Receives newline terminated plaintext lines until the sender closes the connection. """
+		remainder = b''
+		while True:
+			data = connection.recv(65536)
+			if not data:
+				break
+			data = remainder + data
+			end = data.rfind(b'\n') + 1
+			remainder = data[end:]
+			self.receive(self.parse_lines(data[:end]))
+		if remainder:
+			self.receive(self.parse_lines(remainder))
+
+	def read_pickle(self, connection):
+		""" Receives length prefixed pickles until the sender closes the connection.  A pickle larger than max_pickle_bytes
+			or which cannot be unpickled closes the connection, since the stream can no longer be trusted.
+		"""
+		while True:
+			header = self.__receive_exactly(connection, 4)
+			if header is None:
+				break
+			length = struct.unpack(b'!L', header)[0]
+			if length > self._max_pickle_bytes:
+				self.__count(invalid=1)
+				break
+			payload = self.__receive_exactly(connection, length)
+			if payload is None:
+				break
+			try:
+				self.receive(unpickle_datapoints(payload))
+			except (Exception):
+				self.__count(invalid=1)
+				break
+
+	def __receive_exactly(self, connection, byte_count):
+		data = b''
+		while len(data) < byte_count:
+			chunk = connection.recv(byte_count - len(data))
+			if not chunk:
+				return None
+			data += chunk
+		return data
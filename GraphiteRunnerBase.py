@@ -0,0 +1,611 @@
+from __future__ import print_function, unicode_literals, division
+
+import socket
+import time
+
+from GraphiteSender import GraphitePlaintextUdpSender, GraphitePickleTcpSender, format_plaintext_lines
+from MetricBatch import datapoint_count
+from GraphiteDestinations import GraphiteDestinationSet
+from MetricQueue import BoundedMetricQueue, PriorityMetricQueue, default_lane_weights
+from MetricSpool import MetricSpool
+from MetricFilters import SendOnChangeFilter
+from MetricTracing import LatencyTracer
+
+try:
+	from LoggingBase import LoggingBase
+except ImportError:	# the root LoggingBase module, when it is ahead of ipy on the path, only has ClassLoggingBase.
+	from ipy.LoggingBase import LoggingBase
+
+class GraphiteRunnerBase(object):
+
+
+	def __init__(self, **kwargs):
+		""" Holds the monitored servers, and dequeues & sends their metrics to graphite.  Inheriting runners supply
+			the scheduling.  Must be inherited ahead of a LoggingBase class, to which the remaining kwargs are passed.
+		"""
+		self._servers = {}
+		self._relays = []
+		self._queue = self.__build_queue(kwargs)
+
+		self._sender = self.__build_sender(kwargs)
+		self._echo = False
+		self._silent = False
+
+		self._last_datagram_count = 0
+		self._last_line_count = 0
+		self._send_error_count = 0
+		self._dropped_count = 0
+		self._sent_count = 0
+		self._datagram_count = 0
+		self._tick_count = 0
+		self._tick_seconds_total = 0.0
+		self._tick_seconds_max = 0.0
+
+		# the runner's own health metrics are enqueued and sent with all others when a prefix is given.
+		self._self_metrics_prefix = kwargs.pop('self_metrics_prefix') if 'self_metrics_prefix' in kwargs else None
+		self._self_metrics_interval_seconds = kwargs.pop('self_metrics_interval_seconds') if 'self_metrics_interval_seconds' in kwargs else 10
+		self._last_health = None
+		self._last_health_time = None
+
+		# the latency of each traced batch's stages, from its scheduled run time to its send.
+		self._tracer = LatencyTracer() if (kwargs.pop('trace_latency') if 'trace_latency' in kwargs else True) else None
+		self._publish_latency_by_metric = kwargs.pop('publish_latency_by_metric') if 'publish_latency_by_metric' in kwargs else False
+		self._publish_execution_stats = kwargs.pop('publish_execution_stats') if 'publish_execution_stats' in kwargs else False
+
+		self._spool = self.__build_spool(kwargs)
+		self._change_filter = self.__build_change_filter(kwargs)
+		self._spool_replay_items_per_tick = kwargs.pop('spool_replay_items_per_tick') if 'spool_replay_items_per_tick' in kwargs else 5000
+
+		# per tick budget, so that a single timer tick cannot run past the next one.
+		self._max_items_per_tick = kwargs.pop('max_items_per_tick') if 'max_items_per_tick' in kwargs else 100000
+		self._max_seconds_per_tick = kwargs.pop('max_seconds_per_tick') if 'max_seconds_per_tick' in kwargs else 0.8
+		self._shutdown_drain_seconds = kwargs.pop('shutdown_drain_seconds') if 'shutdown_drain_seconds' in kwargs else 10
+
+		super(GraphiteRunnerBase, self).__init__(**kwargs)
+
+	def __build_queue(self, kwargs):
+		""" The queue shared by all monitored servers holds at most "queue_capacity" items (default 500000).  When it is full
+			the "overflow_policy" (default 'drop_oldest') applies; see BoundedMetricQueue for the available policies.
+
+			With "priority_lanes", items are enqueued to a lane per metric priority, each holding up to queue_capacity items,
+			and drained by weighted round robin.  Pass True for the default critical (8), normal (3) and bulk (1) lanes, or
+			a dict or sequence of (lane, weight) pairs.  See PriorityMetricQueue.
+		"""
+		queue_kwargs = dict([(kw, kwargs.pop(kw)) for kw in ('overflow_policy', 'block_timeout_seconds') if kw in kwargs])
+		if 'queue_capacity' in kwargs:
+			queue_kwargs['capacity'] = kwargs.pop('queue_capacity')
+		priority_lanes = kwargs.pop('priority_lanes') if 'priority_lanes' in kwargs else None
+		if priority_lanes:
+			return PriorityMetricQueue(default_lane_weights if priority_lanes is True else priority_lanes, **queue_kwargs)
+		return BoundedMetricQueue(**queue_kwargs)
+
+	def __build_spool(self, kwargs):
+		""" When "spool_directory" is given, items which cannot be sent are written to an on disk MetricSpool there (capped at
+			"spool_max_bytes"), and replayed at up to "spool_replay_items_per_tick" items per tick once sends succeed again.
+		"""
+		if 'spool_directory' not in kwargs:
+			return None
+		spool_kwargs = dict([(kw[len('spool_'):], kwargs.pop(kw)) for kw in ('spool_max_bytes', 'spool_segment_bytes', 'spool_fsync') if kw in kwargs])
+		return MetricSpool(kwargs.pop('spool_directory'), **spool_kwargs)
+
+	def __build_change_filter(self, kwargs):
+		""" When "send_on_change" is True, a dequeued item whose value equals the last value sent for its path is not sent,
+			unless "heartbeat_seconds" (default 300) have passed since that path was last sent.  See SendOnChangeFilter.
+		"""
+		send_on_change = kwargs.pop('send_on_change') if 'send_on_change' in kwargs else False
+		heartbeat_seconds = kwargs.pop('heartbeat_seconds') if 'heartbeat_seconds' in kwargs else 300
+		return SendOnChangeFilter(heartbeat_seconds) if send_on_change else None
+
+	def __build_sender(self, kwargs):
+		""" The kwarg "protocol" selects how metrics are sent to graphite: 'udp' (the default) packs plaintext lines into
+			UDP datagrams of up to "max_datagram_bytes"; 'pickle' writes pickled batches of up to "max_batch_size" datapoints
+			over a persistent TCP connection to carbon's pickle port.  With 'pickle', "wait_for_write" (default True) chooses
+			between blocking and non-blocking writes.
+
+			When "destinations" lists several (server, port[, instance]) carbon endpoints, each metric path is routed to
+			"replication_factor" (default 1) of them by a consistent hash ring compatible with carbon-relay's, and a failed
+			destination is skipped for "destination_down_seconds" (default 30).  See GraphiteDestinationSet.
+		"""
+		protocol = kwargs.pop('protocol') if 'protocol' in kwargs else 'udp'
+		if protocol == 'udp':
+			sender_kwargs = ('max_datagram_bytes', 'prefix_cache_size')
+			sender_class = GraphitePlaintextUdpSender
+		elif protocol == 'pickle':
+			sender_kwargs = ('max_batch_size', 'wait_for_write', 'write_timeout_seconds', 'reconnect_min_seconds', 'reconnect_max_seconds'
+				, 'max_pending_bytes')
+			sender_class = GraphitePickleTcpSender
+		else:
+			raise Exception("The protocol must be one of 'udp' or 'pickle'.  User specified: {}".format(protocol))
+
+		self._protocol = protocol
+		sender_kwargs = dict([(kw, kwargs.pop(kw)) for kw in sender_kwargs if kw in kwargs])
+		if 'destinations' in kwargs:
+			return GraphiteDestinationSet(kwargs.pop('destinations'), sender_class, sender_kwargs
+				, replication_factor=kwargs.pop('replication_factor') if 'replication_factor' in kwargs else 1
+				, down_seconds=kwargs.pop('destination_down_seconds') if 'destination_down_seconds' in kwargs else 30
+				)
+		return sender_class(**sender_kwargs)
+
+	def add_server(self, server):
+		self[server.name] = server
+		return self
+
+	def add_relay(self, relay):
+		""" Adds a relay, which merges metrics from other collectors into the runner's queue once started: a GraphiteRelay
+			receiving carbon protocols over the network, or a SharedMetricRingRelay reading collector processes' shared memory.
+			Relays are polled on each send tick.
+		"""
+		self._relays.append(relay)
+		return self
+
+	def start_relays(self):
+		for relay in self._relays:
+			relay.attach(self._queue).start()
+
+	def stop_relays(self):
+		""" Stops all relays, and enqueues whatever they still hold (e.g. aggregates, completed or not). """
+		for relay in self._relays:
+			relay.stop()
+			relay.poll(force=True)
+
+	def __getitem__(self, server_name):
+		if '\\' in server_name:
+			server_name = server_name.replace('\\', '.')
+		return self._servers[server_name]
+
+	@LoggingBase.log_to('debug', log_with_params=True)
+	def __setitem__(self, server_name, value):
+		if '\\' in server_name:
+			server_name = server_name.replace('\\', '.')
+		if server_name in self._servers:
+			self.error('''Cannot add the same server and instance to the monitor runner twice.  To alter metrics attached to the server, address the attached server directly.''')
+		else:
+			self._servers[server_name] = value
+
+	queue = property(lambda self: self._queue, None, None
+		, 'The bounded queue in which monitored servers enqueue metric results.  Exposes depth and enqueued, dropped & coalesced counters.'
+		+ '  With priority_lanes, a PriorityMetricQueue which also exposes the counters and latency of each lane.')
+
+	graphite_server = property(lambda self: self._sender.graphite_server)
+	@graphite_server.setter
+	def graphite_server(self, value):
+		self.__check_single_destination('graphite_server')
+		self._sender.graphite_server = value
+
+	graphite_port = property(lambda self: self._sender.graphite_port)
+	@graphite_port.setter
+	def graphite_port(self, value):
+		self.__check_single_destination('graphite_port')
+		self._sender.graphite_port = value
+
+	def __check_single_destination(self, name):
+		if isinstance(self._sender, GraphiteDestinationSet):
+			raise Exception('The runner sends to several destinations, which are set with the destinations option; {} cannot be set.'.format(name))
+
+	protocol = property(lambda self: self._protocol, None, None
+		, "The protocol used to send metrics to graphite: 'udp' (plaintext) or 'pickle' (TCP).")
+
+	sender = property(lambda self: self._sender, None, None
+		, 'The object which sends dequeued metrics over the wire for the selected protocol.')
+
+	tracer = property(lambda self: self._tracer, None, None
+		, 'The LatencyTracer which keeps per stage & per metric latency histograms of sent batches, or None when trace_latency is False.')
+
+	publish_latency_by_metric = property(lambda self: self._publish_latency_by_metric, None, None
+		, 'When True, the self metrics include the latency of each stage per server & metric, not only overall.')
+	@publish_latency_by_metric.setter
+	def publish_latency_by_metric(self, value):
+		self._publish_latency_by_metric = bool(value)
+
+	publish_execution_stats = property(lambda self: self._publish_execution_stats, None, None
+		, 'When True, the self metrics include the query seconds, rows, values & path building seconds of each server\'s metrics.')
+	@publish_execution_stats.setter
+	def publish_execution_stats(self, value):
+		self._publish_execution_stats = bool(value)
+
+	change_filter = property(lambda self: self._change_filter, None, None
+		, 'The SendOnChangeFilter which suppresses unchanged values when send_on_change is True, otherwise None.')
+
+	max_datagram_bytes = property(lambda self: self._sender.max_datagram_bytes, None, None
+		, 'The largest UDP payload, in bytes, into which plaintext metric lines are packed before sending.')
+	@max_datagram_bytes.setter
+	def max_datagram_bytes(self, value):
+		self._sender.max_datagram_bytes = value
+
+	last_datagram_count = property(lambda self: self._last_datagram_count, None, None
+		, 'The number of datagrams (or pickled batches) sent on the most recent send tick.')
+
+	last_line_count = property(lambda self: self._last_line_count, None, None
+		, 'The number of metric lines sent on the most recent send tick.')
+
+	send_error_count = property(lambda self: self._send_error_count, None, None
+		, 'The number of sends that failed with a socket error.')
+
+	dropped_count = property(lambda self: self._dropped_count, None, None
+		, 'The number of dequeued items lost to failed sends (which could not be spooled).')
+
+	spool = property(lambda self: self._spool, None, None
+		, 'The on disk spool holding items which could not be sent, or None.  Exposes depth and spooled & replayed counters.')
+
+	sent_count = property(lambda self: self._sent_count, None, None
+		, 'The number of items sent since the runner was created.')
+
+	datagram_count = property(lambda self: self._datagram_count, None, None
+		, 'The number of datagrams (or pickled batches) sent since the runner was created.')
+
+	self_metrics_prefix = property(lambda self: self._self_metrics_prefix, None, None
+		, 'The graphite path under which the runner publishes its own health metrics, or None to not publish them.')
+	@self_metrics_prefix.setter
+	def self_metrics_prefix(self, value):
+		self._self_metrics_prefix = value
+
+	self_metrics_interval_seconds = property(lambda self: self._self_metrics_interval_seconds, None, None
+		, 'The interval, in seconds, at which the runner publishes its own health metrics.')
+	@self_metrics_interval_seconds.setter
+	def self_metrics_interval_seconds(self, value):
+		self._self_metrics_interval_seconds = value
+
+	max_items_per_tick = property(lambda self: self._max_items_per_tick, None, None
+		, 'The most items dequeued and sent on a single send tick.  None removes the limit.')
+	@max_items_per_tick.setter
+	def max_items_per_tick(self, value):
+		self._max_items_per_tick = value
+
+	max_seconds_per_tick = property(lambda self: self._max_seconds_per_tick, None, None
+		, 'The most time, in seconds, a single send tick spends draining the queue.  Should be kept below the one second tick interval.')
+	@max_seconds_per_tick.setter
+	def max_seconds_per_tick(self, value):
+		self._max_seconds_per_tick = value
+
+	shutdown_drain_seconds = property(lambda self: self._shutdown_drain_seconds, None, None
+		, 'The most time, in seconds, spent sending items still enqueued when the runner quits.')
+	@shutdown_drain_seconds.setter
+	def shutdown_drain_seconds(self, value):
+		self._shutdown_drain_seconds = value
+
+	echo = property(lambda self: self._echo, None, None
+		, '''Echoes all received metrics to the screen when True. When False still prints "." to the terminal while running and "*" while sending. To suppress all output set "silent" to True.''')
+	@echo.setter
+	def echo(self, value):
+		self._echo = bool(value)
+
+	silent = property(lambda self: self._silent, None, None
+		, '''Suppresses all terminal output.''')
+	@silent.setter
+	def silent(self, value):
+		self._silent = bool(value)
+
+	def __call__(self, graphite_server=None, graphite_port=None, echo=None):
+		self.start(graphite_server, graphite_port, echo)
+
+	def configure(self, graphite_server=None, graphite_port=None, echo=None):
+		if graphite_server:
+			self.graphite_server = graphite_server
+		if graphite_port:
+			self.graphite_port = graphite_port
+		if echo:
+			self._echo = echo
+
+	def dequeue_items(self, max_items=None, deadline=None):
+		""" Dequeues items (or batches) until they hold at least max_items datapoints, stopping early when the queue is empty
+			or the epoch time deadline passes.
+		"""
+		items = []
+		count = 0
+		while max_items is None or count < max_items:
+			if deadline is not None and time.time() >= deadline:
+				break
+			got_item, item = self._queue.TryDequeue()
+			if not got_item:
+				break
+			items.append(item)
+			count += datapoint_count((item, ))
+		return items
+
+	def send_items(self, items):
+		""" Sends the dequeued items to the graphite server & port; packed into as few datagrams as max_datagram_bytes allows
+			over UDP, or as pickled batches over TCP.  Returns the number of datagrams sent, or None if the send failed.
+			Items which fail to send are written to the spool if one is configured, otherwise they are lost.
+			Prints the sent lines to the screen when echo is ON, otherwise a star ("*") per datagram.
+		"""
+		try:
+			sent = self._sender.send(items)
+		except (socket.error) as e:
+			unsent = getattr(e, 'unsent_items', items)
+			self._send_error_count += 1
+			self.error("Failed to send {} items to {}:{}.  {}".format(datapoint_count(unsent), self.graphite_server, self.graphite_port, e))
+			self.spool_items(unsent)
+			return None
+
+		if self._tracer is not None:
+			self._tracer.record_items(items)
+		if not self.silent:
+			print(format_plaintext_lines(items) if self.echo else '*' * sent, end='')
+		return sent
+
+	def spool_items(self, items):
+		""" Writes items which could not be sent to the spool.  Without a spool, the items are counted as dropped. """
+		if self._spool is None:
+			self._dropped_count += datapoint_count(items)
+			return 0
+		try:
+			return self._spool.append(items)
+		except (IOError, OSError) as e:
+			self._dropped_count += datapoint_count(items)
+			self.error("Failed to spool {} items to {}.  {}".format(datapoint_count(items), self._spool.directory, e))
+			return 0
+
+	def replay_spool(self, deadline=None, chunk_size=1000):
+		""" Sends up to spool_replay_items_per_tick spooled items, oldest first, until the epoch time deadline passes.
+			Spooled items are only removed from the spool once they have been sent.
+			Returns a tuple of the number of items and datagrams sent.
+		"""
+		line_count = 0
+		datagram_count = 0
+		while line_count < self._spool_replay_items_per_tick and self._spool.depth_bytes:
+			if deadline is not None and time.time() >= deadline:
+				break
+			items, position = self._spool.peek(min(chunk_size, self._spool_replay_items_per_tick - line_count))
+			if not items:
+				self._spool.advance(position)
+				break
+
+			try:
+				sent = self._sender.send(items)
+			except (socket.error) as e:
+				self._send_error_count += 1
+				self.error("Failed to replay {} spooled items to {}:{}.  {}".format(len(items), self.graphite_server, self.graphite_port, e))
+				break
+
+			self._spool.advance(position, len(items))
+			line_count += len(items)
+			datagram_count += sent
+
+		if line_count:
+			self.info("Replayed {} spooled items; {} bytes remain spooled.".format(line_count, self._spool.depth_bytes))
+		return line_count, datagram_count
+
+	def finish_tick(self, line_count, datagram_count, tick_seconds=0.0):
+		""" Records the totals of a send tick.  If no items were sent, prints a dot (".") to the screen. """
+		self._last_line_count = line_count
+		self._last_datagram_count = datagram_count
+		self._sent_count += line_count
+		self._datagram_count += datagram_count
+		self._tick_count += 1
+		self._tick_seconds_total += tick_seconds
+		self._tick_seconds_max = max(self._tick_seconds_max, tick_seconds)
+		if not line_count:
+			if not self.silent:
+				print('.', end='')
+			return 0
+
+		self.debug("Sent {} lines in {} datagrams.".format(line_count, datagram_count))
+		return line_count
+
+	def drain_steps(self, max_items=None, deadline=None, chunk_size=1000):
+		""" Generator function which iteratively dequeues items in chunks of chunk_size and sends each chunk to the graphite
+			server & port, yielding after each chunk.  Draining stops when the queue is empty, max_items have been dequeued,
+			or the epoch time deadline passes.
+
+			With send_on_change, unchanged values are filtered out of each chunk before it is sent, and the values of a chunk
+			are recorded as sent once it was sent or spooled.
+			Once a send fails, the rest of the tick's chunks go straight to the spool (or, without a spool, draining stops).
+			When every send succeeded, spooled items are then replayed within the same deadline.
+			While the sender is backing off from a failed connection, nothing is dequeued, so that items wait in the queue
+			rather than being dropped (or spooled) on every tick of an outage.
+		"""
+		started = time.time()
+		self.publish_self_metrics(started)
+		for relay in self._relays:
+			relay.poll(started)
+
+		if getattr(self._sender, 'is_backing_off', False):
+			self.finish_tick(0, 0, time.time() - started)
+			return
+
+		line_count = 0
+		datagram_count = 0
+		dequeued_count = 0
+		failed = False
+		while max_items is None or dequeued_count < max_items:
+			items = self.dequeue_items(
+				chunk_size if max_items is None else min(chunk_size, max_items - dequeued_count)
+				, deadline
+				)
+			if not items:
+				break
+			dequeued_count += datapoint_count(items)
+			if self._change_filter is not None:
+				items = self._change_filter(items)
+				if not items:
+					yield
+					continue
+
+			if failed:
+				self.spool_items(items)
+				sent = None
+			else:
+				sent = self.send_items(items)
+				if sent is not None:
+					line_count += datapoint_count(items)
+					datagram_count += sent
+			if self._change_filter is not None and (sent is not None or self._spool is not None):
+				self._change_filter.commit(items)
+			if sent is None:
+				if self._spool is None:
+					break
+				failed = True
+			yield
+
+		if self._change_filter is not None:
+			self._change_filter.expire(started)
+
+		if not failed and self._spool is not None and self._spool.depth_bytes:
+			replayed_count, replayed_datagram_count = self.replay_spool(deadline, chunk_size)
+			line_count += replayed_count
+			datagram_count += replayed_datagram_count
+
+		self.finish_tick(line_count, datagram_count, time.time() - started)
+
+	def drain(self, max_items=None, deadline=None, chunk_size=1000):
+		""" Runs drain_steps to completion.  Returns the number of items sent. """
+		for step in self.drain_steps(max_items, deadline, chunk_size):
+			pass
+		return self._last_line_count
+
+	def health(self, at_time=None):
+		""" Returns a dict of the runner's cumulative counters and current gauges: queue depth & counters, the age in seconds
+			of the oldest enqueued item, items & datagrams sent, send errors, dropped items, send ticks and spool depth, and the
+			metric timeouts, circuit breaker trips & skipped metric calls, and live series of the servers.
+		"""
+		at_time = at_time if at_time is not None else time.time()
+		oldest_enqueue_time = self._queue.oldest_enqueue_time()
+		health = dict(
+			queue_depth=self._queue.Count
+			, queue_enqueued=self._queue.enqueued_count
+			, queue_dequeued=self._queue.dequeued_count
+			, queue_dropped=self._queue.dropped_count
+			, queue_coalesced=self._queue.coalesced_count
+			, oldest_item_age_seconds=max(at_time - oldest_enqueue_time, 0) if oldest_enqueue_time is not None else 0
+			, items_sent=self._sent_count
+			, datagrams_sent=self._datagram_count
+			, send_errors=self._send_error_count
+			, items_dropped=self._dropped_count
+			, ticks=self._tick_count
+			, tick_seconds_total=self._tick_seconds_total
+			, tick_seconds_max=self._tick_seconds_max
+			)
+		for lane in getattr(self._queue, 'lanes', []):
+			for counter, value in self._queue.lane_counters(lane).items():
+				health['lane_{}_{}'.format(lane, counter)] = value
+		if self._change_filter is not None:
+			health['items_unchanged_sent'] = self._change_filter.heartbeat_count
+			health['items_suppressed'] = self._change_filter.suppressed_count
+		if self._relays:
+			health['relay_received'] = sum([relay.received_count for relay in self._relays])
+			health['relay_invalid'] = sum([relay.invalid_count for relay in self._relays])
+			health['relay_dropped'] = sum([getattr(relay, 'dropped_count', 0) for relay in self._relays])
+		if self._spool is not None:
+			health['spool_depth_bytes'] = self._spool.depth_bytes
+			health['spool_discarded_bytes'] = self._spool.discarded_bytes
+		circuits = [counters for server in self._servers.values() if hasattr(server, 'circuit_counters')
+			for counters in server.circuit_counters().values()]
+		if circuits:
+			health['metric_timeouts'] = sum([counters['failures'] for counters in circuits])
+			health['metric_breaker_trips'] = sum([counters['trips'] for counters in circuits])
+			health['metric_breaker_skips'] = sum([counters['skips'] for counters in circuits])
+		live_series = [count for server in self._servers.values() if hasattr(server, 'live_series')
+			for count in server.live_series().values()]
+		if live_series:
+			health['live_series'] = sum(live_series)
+		return health
+
+	def publish_self_metrics(self, at_time=None):
+		""" Every self_metrics_interval_seconds, enqueues the runner's health under self_metrics_prefix: gauges as they are,
+			counters as per second rates over the interval (e.g. queue_dequeued_per_second, datagrams_sent_per_second), and the
+			mean & max drain time of the interval's send ticks.  Returns the number of items enqueued.
+			They are enqueued with TryEnqueue: this runs on the sending thread, so a full queue drops them, rather than
+			blocking the queue's only consumer or displacing monitored metrics.
+
+			With latency tracing, the count, mean, max & percentiles of each stage over the interval are included as
+			"latency.<<stage>>.<<statistic>>" (and, with publish_latency_by_metric, as
+			"latency.by_metric.<<server>>.<<metric>>.<<stage>>.<<statistic>>"), and the tracer's histograms are then emptied.
+			With publish_execution_stats, the execution statistics of each metric function over the interval are included as
+			"execution.<<server>>.<<metric>>.<<measure>>.<<statistic>>", and emptied likewise.
+		"""
+		if not self._self_metrics_prefix:
+			return 0
+
+		at_time = at_time if at_time is not None else time.time()
+		if self._last_health_time is not None and at_time - self._last_health_time < self._self_metrics_interval_seconds:
+			return 0
+
+		health = self.health(at_time)
+		previous, previous_time = self._last_health, self._last_health_time
+		self._last_health, self._last_health_time = health, at_time
+		self._tick_seconds_max = 0.0
+		if hasattr(self._queue, 'reset_latency_max'):
+			self._queue.reset_latency_max()
+		if previous is None:
+			return 0
+
+		elapsed = at_time - previous_time
+		ticks = health['ticks'] - previous['ticks']
+		values = dict(
+			queue_depth=health['queue_depth']
+			, oldest_item_age_seconds=health['oldest_item_age_seconds']
+			, tick_seconds_mean=(health['tick_seconds_total'] - previous['tick_seconds_total']) / ticks if ticks else 0
+			, tick_seconds_max=health['tick_seconds_max']
+			)
+		for counter in ('queue_enqueued', 'queue_dequeued', 'queue_dropped', 'queue_coalesced', 'items_sent', 'datagrams_sent'
+				, 'send_errors', 'items_dropped', 'items_unchanged_sent', 'items_suppressed', 'relay_received', 'relay_invalid', 'relay_dropped'
+				, 'metric_timeouts', 'metric_breaker_trips', 'metric_breaker_skips'):
+			if counter in health and counter in previous:
+				values[counter + '_per_second'] = (health[counter] - previous[counter]) / elapsed
+		for lane in getattr(self._queue, 'lanes', []):
+			dequeued = health['lane_{}_dequeued'.format(lane)] - previous['lane_{}_dequeued'.format(lane)]
+			latency_seconds = health['lane_{}_latency_seconds_total'.format(lane)] - previous['lane_{}_latency_seconds_total'.format(lane)]
+			values['lane_{}_depth'.format(lane)] = health['lane_{}_depth'.format(lane)]
+			values['lane_{}_dequeued_per_second'.format(lane)] = dequeued / elapsed
+			values['lane_{}_latency_seconds_mean'.format(lane)] = latency_seconds / dequeued if dequeued else 0
+			values['lane_{}_latency_seconds_max'.format(lane)] = health['lane_{}_latency_seconds_max'.format(lane)]
+		for gauge in ('spool_depth_bytes', 'spool_discarded_bytes', 'live_series'):
+			if gauge in health:
+				values[gauge] = health[gauge]
+
+		if self._tracer is not None:
+			for stage, summary in self._tracer.summaries(reset=True).items():
+				for statistic, value in summary.items():
+					values['latency.{}.{}'.format(stage, statistic)] = value
+			by_metric = self._tracer.summaries(by_metric=True, reset=True)
+			if self._publish_latency_by_metric:
+				for (server, metric_name, stage), summary in by_metric.items():
+					node = 'latency.by_metric.{}.{}.{}'.format(server.replace('\\', '_').replace('.', '_'), metric_name.replace('.', '_'), stage)
+					for statistic, value in summary.items():
+						values['{}.{}'.format(node, statistic)] = value
+
+		if self._publish_execution_stats:
+			for server in self._servers.values():
+				if not hasattr(server, 'execution_summaries'):
+					continue
+				for metric_name, summaries in server.execution_summaries(reset=True).items():
+					node = 'execution.{}.{}'.format(server.instance.replace('\\', '_').replace('.', '_'), metric_name.replace('.', '_'))
+					for measure, summary in summaries.items():
+						for statistic, value in summary.items():
+							values['{}.{}.{}'.format(node, measure, statistic)] = value
+
+		prefix = self._self_metrics_prefix.rstrip('.') + '.'
+		timestamp = int(at_time)
+		for name in sorted(values):
+			self._queue.TryEnqueue(dict(graphite_path=prefix + name, value=round(values[name], 3), timestamp=timestamp))
+		return len(values)
+
+	def drain_for_shutdown(self, drain_seconds=None):
+		""" Sends whatever remains enqueued until the queue is empty or drain_seconds (default: shutdown_drain_seconds) pass,
+			then flushes any writes held by the sender.  Items still enqueued after that are written to the spool, if one
+			is configured.  Returns the number of items left unsent (including those spooled).
+		"""
+		if drain_seconds is None:
+			drain_seconds = self.shutdown_drain_seconds
+
+		self.drain(deadline=time.time() + drain_seconds)
+		try:
+			self._sender.flush()
+		except (socket.error) as e:
+			self._send_error_count += 1
+			self.error("Failed to flush held writes to {}:{}.  {}".format(self.graphite_server, self.graphite_port, e))
+			self.spool_items(getattr(e, 'unsent_items', []))
+
+		unsent = self._queue.Count
+		if unsent:
+			self.warning("Shut down with {} items left unsent after draining for {} seconds.".format(unsent, drain_seconds))
+			if self._spool is not None:
+				spooled = self.spool_items(self.dequeue_items())
+				self.info("Spooled {} unsent items to {} for replay on the next start.".format(spooled, self._spool.directory))
+		return unsent
+
+	def close_connections(self):
+		""" Closes the sender's socket and the spool's open segment. """
+		self._sender.close()
+		if self._spool is not None:
+			self._spool.close()
@@ -0,0 +1,374 @@
+from __future__ import print_function, unicode_literals, division
+
+import errno
+import pickle
+import socket
+import struct
+import time
+from collections import OrderedDict, deque
+
+from MetricBatch import iter_datapoints, batch_datapoints
+
+def format_plaintext_lines(items):
+	""" Returns the graphite plaintext protocol lines for all datapoints of the dict items and MetricBatch records passed. """
+	return ''.join(["{} {} {}\n".format(path, value, timestamp) for path, value, timestamp in iter_datapoints(items)])
+
+class PartialSendError(socket.error):
+
+
+	def __init__(self, unsent_items, message):
+		""" Raised by a sender which delivered only some of the items passed to it.  unsent_items holds the rest. """
+		super(PartialSendError, self).__init__(message)
+		self.unsent_items = unsent_items
+
+class GraphitePlaintextUdpSender(object):
+
+
+	def __init__(self, graphite_server=None, graphite_port=None, max_datagram_bytes=1400, prefix_cache_size=100000):
+		""" Sends graphite plaintext lines over UDP, packing as many whole lines into each datagram as will fit
+			in max_datagram_bytes.  A line is never split across datagrams; a single line longer than the limit
+			is sent in a datagram of its own.
+
+			The default of 1400 bytes keeps each datagram inside a standard 1500 byte ethernet MTU once IP & UDP
+			headers are added.
+
+			Lines are written straight into one preallocated datagram buffer: the encoded "the.metric.path " prefix of each
+			path is kept in a least recently used cache of up to prefix_cache_size paths, and the encoded timestamp suffix
+			is reused for consecutive items with the same timestamp, so only each value is encoded per item.
+		"""
+		self._graphite_server = graphite_server
+		self._graphite_port = graphite_port
+		self._max_datagram_bytes = self.check_max_datagram_bytes(max_datagram_bytes)
+		self._buffer = bytearray(self._max_datagram_bytes)
+
+		self._prefix_cache_size = prefix_cache_size
+		self._prefix_cache = OrderedDict()	# graphite path: encoded "graphite_path " prefix, least recently used first
+
+		self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)	# UDP
+
+	def check_max_datagram_bytes(self, max_datagram_bytes):
+		if max_datagram_bytes < 1 or max_datagram_bytes > 65507:
+			raise Exception('The maximum datagram payload must be between 1 and 65507 bytes.  User specified: {}'.format(max_datagram_bytes))
+		return max_datagram_bytes
+
+	graphite_server = property(lambda self: self._graphite_server)
+	@graphite_server.setter
+	def graphite_server(self, value):
+		self._graphite_server = value
+
+	graphite_port = property(lambda self: self._graphite_port)
+	@graphite_port.setter
+	def graphite_port(self, value):
+		self._graphite_port = value
+
+	max_datagram_bytes = property(lambda self: self._max_datagram_bytes, None, None
+		, 'The largest UDP payload, in bytes, the sender will build from packed plaintext lines.')
+	@max_datagram_bytes.setter
+	def max_datagram_bytes(self, value):
+		self._max_datagram_bytes = self.check_max_datagram_bytes(value)
+		self._buffer = bytearray(self._max_datagram_bytes)
+
+	prefix_cache_count = property(lambda self: len(self._prefix_cache), None, None
+		, 'The number of graphite paths whose encoded prefix is cached.')
+
+	def path_prefix(self, graphite_path):
+		""" Returns the encoded "graphite_path " prefix of a line, from the least recently used cache when possible. """
+		prefix = self._prefix_cache.pop(graphite_path, None)
+		if prefix is None:
+			prefix = (graphite_path + ' ').encode('utf-8')
+			if len(self._prefix_cache) >= self._prefix_cache_size:
+				self._prefix_cache.popitem(last=False)
+		self._prefix_cache[graphite_path] = prefix
+		return prefix
+
+	def pack(self, items):
+		""" Generator function yields datagram payloads built from the metric items (or batches) passed, in order.
+			Each payload holds as many whole plaintext lines as fit in max_datagram_bytes, and is a memoryview of the sender's
+			reusable buffer, so it is only valid until the next payload is requested.
+		"""
+		buffer = self._buffer
+		view = memoryview(buffer)
+		max_bytes = self._max_datagram_bytes
+		used = 0
+		last_timestamp = None
+		suffix = b''
+		for path, value, timestamp in iter_datapoints(items):
+			if timestamp != last_timestamp:
+				last_timestamp = timestamp
+				suffix = ' {}\n'.format(timestamp).encode('utf-8')
+			prefix = self.path_prefix(path)
+			value = '{}'.format(value).encode('utf-8')
+			line_bytes = len(prefix) + len(value) + len(suffix)
+
+			if used and used + line_bytes > max_bytes:
+				yield view[:used]
+				used = 0
+			if line_bytes > max_bytes:
+				# a single line longer than the buffer is sent on its own.
+				yield memoryview(prefix + value + suffix)
+				continue
+
+			end = used + len(prefix)
+			buffer[used:end] = prefix
+			used, end = end, end + len(value)
+			buffer[used:end] = value
+			used, end = end, end + len(suffix)
+			buffer[used:end] = suffix
+			used = end
+		if used:
+			yield view[:used]
+
+	def send(self, items):
+		""" Packs and sends the metric items as plaintext lines to the graphite server & port.  Returns the number of datagrams sent. """
+		datagram_count = 0
+		address = (self._graphite_server, self._graphite_port)
+		for datagram in self.pack(items):
+			self._socket.sendto(datagram, address)
+			datagram_count += 1
+		return datagram_count
+
+	def flush(self):
+		""" Datagrams are written as they are packed, so there is never anything to flush. """
+		return 0
+
+	def close(self):
+		self._socket.close()
+
+class GraphitePickleTcpSender(object):
+
+
+	def __init__(self, graphite_server=None, graphite_port=None, max_batch_size=1000, wait_for_write=True
+			, write_timeout_seconds=5, reconnect_min_seconds=1, reconnect_max_seconds=60, max_pending_bytes=16777216):
+		""" Sends metrics over one persistent TCP connection to carbon's pickle receiver (port 2004 by default in carbon.conf).
+			Each call to send writes the items as length prefixed pickled lists of (path, (timestamp, value)) tuples,
+			with at most max_batch_size tuples per pickle.
+
+			When the connection fails it is closed, and reconnection is attempted on later sends with a back off that
+			doubles from reconnect_min_seconds up to reconnect_max_seconds.
+
+			When wait_for_write is True, each send blocks (up to write_timeout_seconds) until carbon has accepted all bytes.
+			When False, the socket is non-blocking; pickles the socket cannot take immediately are held (up to
+			max_pending_bytes) and written ahead of the next send.
+
+			Only pickles the socket accepted in full count as sent.  When a send fails, a PartialSendError holds the
+			datapoints of every pickle which was not written in full (including held pickles of earlier sends), so that
+			they can be spooled without sending the written ones twice.  A partly written pickle is discarded by carbon
+			when the connection closes, so its datapoints are among the unsent.
+		"""
+		self._graphite_server = graphite_server
+		self._graphite_port = graphite_port
+		self._max_batch_size = max_batch_size
+		self._wait_for_write = wait_for_write
+		self._write_timeout_seconds = write_timeout_seconds
+		self._reconnect_min_seconds = reconnect_min_seconds
+		self._reconnect_max_seconds = reconnect_max_seconds
+		self._max_pending_bytes = max_pending_bytes
+
+		self._socket = None
+		self._pending = deque()	# [pickle payload, bytes written, (path, value, timestamp) datapoints] held for writing
+		self._pending_bytes = 0
+		self._reconnect_seconds = reconnect_min_seconds
+		self._next_connect_time = 0
+		self._connect_count = 0
+
+	graphite_server = property(lambda self: self._graphite_server)
+	@graphite_server.setter
+	def graphite_server(self, value):
+		self._graphite_server = value
+		self.close()
+
+	graphite_port = property(lambda self: self._graphite_port)
+	@graphite_port.setter
+	def graphite_port(self, value):
+		self._graphite_port = value
+		self.close()
+
+	max_batch_size = property(lambda self: self._max_batch_size, None, None
+		, 'The most (path, (timestamp, value)) tuples written in a single pickle.')
+	@max_batch_size.setter
+	def max_batch_size(self, value):
+		self._max_batch_size = value
+
+	wait_for_write = property(lambda self: self._wait_for_write, None, None
+		, 'When True, each send blocks until all bytes are written to the socket.')
+
+	is_connected = property(lambda self: self._socket is not None)
+
+	is_backing_off = property(lambda self: self._socket is None and time.time() < self._next_connect_time, None, None
+		, 'True while not connected and the reconnect back off has not expired; a send would fail without trying.')
+
+	connect_count = property(lambda self: self._connect_count, None, None
+		, 'The number of times a connection to carbon has been established.')
+
+	pending_bytes = property(lambda self: self._pending_bytes, None, None
+		, 'The number of bytes held for writing on the next send when wait_for_write is False.')
+
+	pending_count = property(lambda self: len(self._pending), None, None
+		, 'The number of pickles held for writing on the next send when wait_for_write is False.')
+
+	def connect(self):
+		""" Opens the TCP connection if it is not already open.  Raises socket.error if the connection cannot be made,
+			or if the reconnect back off has not yet expired.
+		"""
+		if self._socket is not None:
+			return self._socket
+
+		now = time.time()
+		if now < self._next_connect_time:
+			raise socket.error("Not connected to {}:{}; the next connection attempt is in {:.1f} seconds.".format(
+				self._graphite_server, self._graphite_port, self._next_connect_time - now))
+
+		try:
+			s = socket.create_connection((self._graphite_server, self._graphite_port), self._write_timeout_seconds)
+		except (socket.error):
+			self._next_connect_time = now + self._reconnect_seconds
+			self._reconnect_seconds = min(self._reconnect_seconds * 2, self._reconnect_max_seconds)
+			raise
+
+		s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		if self._wait_for_write:
+			s.settimeout(self._write_timeout_seconds)
+		else:
+			s.setblocking(0)
+
+		self._socket = s
+		self._reconnect_seconds = self._reconnect_min_seconds
+		self._connect_count += 1
+		return self._socket
+
+	def pack(self, items):
+		""" Generator function yields length prefixed pickle payloads of at most max_batch_size datapoints.
+			Items without a numeric value (e.g. NULL results) are skipped, since carbon cannot store them.
+		"""
+		for payload, datapoints in self.pack_datapoints(items):
+			yield payload
+
+	def pack_datapoints(self, items):
+		""" Generator function yields a tuple of each pickle payload (see pack) and the (path, value, timestamp)
+			datapoints pickled in it.
+		"""
+		batch = []
+		datapoints = []
+		for datapoint in iter_datapoints(items):
+			path, value, timestamp = datapoint
+			try:
+				batch.append( (path, (int(timestamp), float(value))) )
+			except (TypeError, ValueError):
+				continue
+			datapoints.append(datapoint)
+			if len(batch) >= self._max_batch_size:
+				yield self.frame(batch), datapoints
+				batch = []
+				datapoints = []
+		if batch:
+			yield self.frame(batch), datapoints
+
+	def frame(self, batch):
+		payload = pickle.dumps(batch, protocol=2)
+		return struct.pack(b'!L', len(payload)) + payload
+
+	def send(self, items):
+		""" Pickles and sends the metric items to carbon.  Returns the number of pickled batches written in full by this
+			call (including held batches of earlier sends); with wait_for_write False, the rest are held for the next send.
+			Raises socket.error when nothing could be written, or PartialSendError holding the datapoints of the pickles
+			which were not written in full, after closing the connection so that the next send reconnects.
+		"""
+		payloads = list(self.pack_datapoints(items))
+		try:
+			self.connect()
+		except (socket.error) as e:
+			if self._pending:
+				raise self.__unsent_error(payloads, e)
+			raise
+
+		if self._wait_for_write:
+			for i, (payload, datapoints) in enumerate(payloads):
+				try:
+					self._socket.sendall(payload)
+				except (socket.error) as e:
+					self.close()
+					raise self.__unsent_error(payloads[i:], e)
+			return len(payloads)
+
+		for payload, datapoints in payloads:
+			self._pending.append([payload, 0, datapoints])
+			self._pending_bytes += len(payload)
+		try:
+			written = self.flush_pending()
+		except (socket.error) as e:
+			self.close()
+			raise self.__unsent_error([], e)
+		if self._pending_bytes > self._max_pending_bytes:
+			self.close()
+			raise self.__unsent_error([], "{} bytes are waiting to be written to {}:{}, more than the {} allowed.".format(
+				self._pending_bytes, self._graphite_server, self._graphite_port, self._max_pending_bytes))
+		return written
+
+	def __unsent_error(self, payloads, reason):
+		""" Returns a PartialSendError holding the datapoints of the payloads and of every held pickle, which are no
+			longer held.
+		"""
+		unsent = []
+		for payload, written, datapoints in self._pending:
+			unsent.extend(datapoints)
+		for payload, datapoints in payloads:
+			unsent.extend(datapoints)
+		self._pending.clear()
+		self._pending_bytes = 0
+		return PartialSendError(batch_datapoints(unsent), "{} datapoints were not written to {}:{}.  {}".format(len(unsent)
+			, self._graphite_server, self._graphite_port, reason))
+
+	def flush_pending(self):
+		""" Writes as many held bytes as the non-blocking socket accepts.  Returns the number of held pickles written
+			in full.
+		"""
+		written_count = 0
+		while self._pending:
+			entry = self._pending[0]
+			try:
+				written = self._socket.send(memoryview(entry[0])[entry[1]:])
+			except (socket.error) as e:
+				if e.args and e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+					break
+				raise
+			entry[1] += written
+			self._pending_bytes -= written
+			if entry[1] >= len(entry[0]):
+				self._pending.popleft()
+				written_count += 1
+		return written_count
+
+	def flush(self):
+		""" Blocks (up to write_timeout_seconds) while writing the pickles held by a non-blocking send, connecting if
+			need be.  Returns 0 once none are held.  Raises PartialSendError holding the datapoints of the held pickles
+			if they cannot be written; they are then no longer held.
+		"""
+		if self._pending:
+			try:
+				self.connect()
+				self._socket.settimeout(self._write_timeout_seconds)
+				while self._pending:
+					payload, written, datapoints = self._pending[0]
+					self._socket.sendall(memoryview(payload)[written:])
+					self._pending.popleft()
+					self._pending_bytes -= len(payload) - written
+			except (socket.error) as e:
+				self.close()
+				raise self.__unsent_error([], e)
+			finally:
+				if self._socket is not None and not self._wait_for_write:
+					self._socket.setblocking(0)
+		return self._pending_bytes
+
+	def close(self):
+		""" Closes the connection.  Held pickles are kept, and written again from their start after reconnecting, since
+			carbon discards a partly written pickle when the connection closes.
+		"""
+		if self._socket is not None:
+			try:
+				self._socket.close()
+			finally:
+				self._socket = None
+		if self._pending:
+			self._pending_bytes += self._pending[0][1]
+			self._pending[0][1] = 0
@@ -0,0 +1,169 @@
+from __future__ import print_function, unicode_literals, division
+
+rollup_functions = ('avg', 'min', 'max', 'last', 'sum', 'count')
+
+class MetricWindow(object):
+	""" The running rollups of one metric path over one aggregation window. """
+	__slots__ = ('start', 'count', 'total', 'minimum', 'maximum', 'last')
+
+	def __init__(self, start, value):
+		self.start = start
+		self.count = 1
+		self.total = value
+		self.minimum = value
+		self.maximum = value
+		self.last = value
+
+	def add(self, value):
+		self.count += 1
+		self.total += value
+		if value < self.minimum:
+			self.minimum = value
+		if value > self.maximum:
+			self.maximum = value
+		self.last = value
+
+	def rollup(self, function_name):
+		if function_name == 'avg':
+			return self.total / self.count
+		if function_name == 'min':
+			return self.minimum
+		if function_name == 'max':
+			return self.maximum
+		if function_name == 'last':
+			return self.last
+		if function_name == 'sum':
+			return self.total
+		return self.count
+
+class CounterRates(object):
+
+
+	def __init__(self):
+		""" Turns samples of cumulative counters (e.g. wait times, IO stalls, log flushes) into per second rates, keeping only
+			the previous (timestamp, value) of each metric path.  No rate is produced for a path's first sample, nor when the
+			counter went backwards (it was reset, or SQL Server restarted), in which case the sample starts a new baseline.
+		"""
+		self._previous = {}	# metric path: (timestamp, value)
+		self._first_count = 0
+		self._reset_count = 0
+		self._expired_count = 0
+
+	path_count = property(lambda self: len(self._previous))
+
+	first_count = property(lambda self: self._first_count, None, None
+		, 'The number of samples which produced no rate because they were the first of their path.')
+
+	reset_count = property(lambda self: self._reset_count, None, None
+		, 'The number of samples which produced no rate because their counter went backwards.')
+
+	expired_count = property(lambda self: self._expired_count, None, None
+		, 'The number of paths forgotten because they were not sampled for idle_seconds.')
+
+	def rate(self, path, value, timestamp):
+		""" Returns the per second rate since the path's previous sample, or None. """
+		try:
+			value = float(value)
+		except (TypeError, ValueError):
+			return None
+
+		previous = self._previous.get(path)
+		if previous is not None and timestamp <= previous[0]:
+			return None	# a repeated sample would give a rate over no time.
+		self._previous[path] = (timestamp, value)
+		if previous is None:
+			self._first_count += 1
+			return None
+		if value < previous[1]:
+			self._reset_count += 1
+			return None
+		return (value - previous[1]) / (timestamp - previous[0])
+
+	def forget(self, path=None):
+		if path is None:
+			self._previous.clear()
+		else:
+			self._previous.pop(path, None)
+
+	def expire(self, at_time, idle_seconds):
+		""" Forgets the paths not sampled for idle_seconds (e.g. a key folded away, or a dropped database), and returns
+			the number forgotten.  A path sampled again later starts a new baseline.
+		"""
+		expired = [path for path, previous in self._previous.items() if at_time - previous[0] > idle_seconds]
+		for path in expired:
+			del self._previous[path]
+		self._expired_count += len(expired)
+		return len(expired)
+
+class MetricAggregator(object):
+
+
+	def __init__(self, interval_seconds=60, rollups=('avg', ), path_format='{path}_{rollup}'):
+		""" Accumulates samples per metric path into windows of interval_seconds (aligned to the epoch, as graphite aligns
+			its datapoints), and emits the requested rollups of each completed window as metric items.
+			Each rollup is sent to its own path, named by path_format; e.g. "...wait_time_ms_avg" and "...wait_time_ms_max".
+			The rollup's timestamp is the start of its window.  Samples without a numeric value are ignored.
+		"""
+		unknown = [r for r in rollups if r not in rollup_functions]
+		if unknown:
+			raise Exception('The rollups {} are not supported.  Rollups must be among: {}'.format(unknown, rollup_functions))
+		if interval_seconds < 1:
+			raise Exception('The aggregation interval must be at least one second.  User specified: {}'.format(interval_seconds))
+
+		self._interval_seconds = interval_seconds
+		self._rollups = tuple(rollups)
+		self._path_format = path_format
+		self._windows = {}	# metric path: MetricWindow
+		self._rollup_paths = {}	# metric path: the rollup paths, in the order of self._rollups
+
+	interval_seconds = property(lambda self: self._interval_seconds)
+
+	rollups = property(lambda self: self._rollups)
+
+	window_count = property(lambda self: len(self._windows), None, None
+		, 'The number of metric paths with an open aggregation window.')
+
+	def window_start(self, timestamp):
+		return int(timestamp) - (int(timestamp) % self._interval_seconds)
+
+	def add(self, path, value, timestamp):
+		""" Adds a sample to the path's window.  If the sample falls in a later window than the open one, the open window
+			is completed, and its rollup items are returned.  Otherwise returns an empty list.
+		"""
+		try:
+			value = float(value)
+		except (TypeError, ValueError):
+			return []
+
+		start = self.window_start(timestamp)
+		window = self._windows.get(path)
+		if window is None:
+			self._windows[path] = MetricWindow(start, value)
+			return []
+		if window.start == start:
+			window.add(value)
+			return []
+
+		self._windows[path] = MetricWindow(start, value)
+		return self.rollup_items(path, window)
+
+	def rollup_items(self, path, window):
+		if path not in self._rollup_paths:
+			self._rollup_paths[path] = [self._path_format.format(path=path, rollup=r) for r in self._rollups]
+		return [dict(graphite_path=rollup_path, value=window.rollup(rollup), timestamp=window.start)
+			for rollup, rollup_path in zip(self._rollups, self._rollup_paths[path])]
+
+	def flush(self, timestamp=None, force=False):
+		""" Completes every window which ended at or before the epoch timestamp (or every window, when force is True),
+			and returns the rollup items.  The rollup paths of a completed window's path are forgotten with it, so that
+			paths which are no longer sampled (e.g. a dropped database) are not held on to.
+		"""
+		items = []
+		current_start = self.window_start(timestamp) if timestamp is not None else None
+		for path in list(self._windows.keys()):
+			window = self._windows[path]
+			if force or current_start is None or window.start < current_start:
+				del self._windows[path]
+				items.extend(self.rollup_items(path, window))
+				del self._rollup_paths[path]
+		return items
@@ -0,0 +1,75 @@
+from __future__ import print_function, unicode_literals, division
+
+import sys
+
+try:
+	intern_string = sys.intern
+except (AttributeError):
+	intern_string = intern	# python 2, where only byte strings can be interned.
+
+def intern_path(path):
+	""" Returns the interned copy of a metric path, so that the paths of a metric polled every interval share one string.
+		Unicode paths cannot be interned under CPython 2, and are returned as they are.
+	"""
+	try:
+		return intern_string(path)
+	except (TypeError):
+		return path
+
+class MetricBatch(object):
+	""" The datapoints of one metric call, which share a timestamp: parallel lists of metric paths and values.
+		Enqueued in place of one dict item per value.  The key identifies the batch's metric & server, so that a coalescing
+		queue keeps only the newest batch of each.  The trace, when set, holds the (scheduled, query start, query end, enqueued)
+		epoch times of the metric call, for the LatencyTracer.
+	"""
+	__slots__ = ('timestamp', 'paths', 'values', 'priority', 'key', 'trace')
+
+	def __init__(self, timestamp, paths=None, values=None, priority='normal', key=None, trace=None):
+		self.timestamp = timestamp
+		self.paths = paths if paths is not None else []
+		self.values = values if values is not None else []
+		self.priority = priority
+		self.key = key
+		self.trace = trace
+
+	def __len__(self):
+		return len(self.paths)
+
+	def append(self, path, value):
+		self.paths.append(intern_path(path))
+		self.values.append(value)
+
+	def datapoints(self):
+		""" Generator function yields a (path, value, timestamp) tuple per value. """
+		timestamp = self.timestamp
+		for path, value in zip(self.paths, self.values):
+			yield path, value, timestamp
+
+def iter_datapoints(items):
+	""" Generator function yields a (path, value, timestamp) tuple for each datapoint of the items passed, which may be
+		dict items (with graphite_path, value & timestamp keys) or MetricBatch records.
+	"""
+	for item in items:
+		if isinstance(item, MetricBatch):
+			for datapoint in item.datapoints():
+				yield datapoint
+		else:
+			yield item['graphite_path'], item['value'], item['timestamp']
+
+def datapoint_count(items):
+	return sum([len(item) if isinstance(item, MetricBatch) else 1 for item in items])
+
+def batch_datapoints(datapoints, priority='normal'):
+	""" Returns the (path, value, timestamp) tuples as a list of MetricBatch records, one per run of equal timestamps. """
+	batches = []
+	batch = None
+	for path, value, timestamp in datapoints:
+		if batch is None or batch.timestamp != timestamp:
+			batch = MetricBatch(timestamp, priority=priority)
+			batches.append(batch)
+		batch.paths.append(path)
+		batch.values.append(value)
+	return batches
+
+def item_priority(item):
+	return item.priority if isinstance(item, MetricBatch) else item.get('priority')
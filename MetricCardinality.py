@@ -0,0 +1,160 @@
+from __future__ import print_function, unicode_literals, division
+
+key_rollup_methods = ('sum', 'avg', 'max', 'min')
+
+def fold_values(rows, method='sum'):
+	""" Returns the sum, avg, max or min of each data column across a list of row value lists, ignoring None values. """
+	folded = []
+	for column_values in zip(*rows):
+		values = [value for value in column_values if value is not None]
+		if not values:
+			folded.append(None)
+		elif method == 'sum':
+			folded.append(sum(values))
+		elif method == 'avg':
+			folded.append(sum(values) / len(values))
+		elif method == 'max':
+			folded.append(max(values))
+		else:
+			folded.append(min(values))
+	return folded
+
+class PathRegistry(object):
+
+
+	def __init__(self, idle_seconds=600):
+		""" Tracks the live series of a metric: each path sent, with the timestamp it was last sent at.  A path not sent for
+			idle_seconds has expired (e.g. its key folded into "other", or the database it named was dropped).
+		"""
+		self._idle_seconds = idle_seconds
+		self._last_seen = {}	# metric path: timestamp last sent
+		self._created_count = 0
+		self._expired_count = 0
+
+	idle_seconds = property(lambda self: self._idle_seconds)
+
+	live_count = property(lambda self: len(self._last_seen), None, None
+		, 'The number of series sent within the last idle_seconds.')
+
+	created_count = property(lambda self: self._created_count, None, None
+		, 'The number of series which became live (including those which came back after expiring).')
+
+	expired_count = property(lambda self: self._expired_count, None, None
+		, 'The number of series which expired.')
+
+	def __contains__(self, path):
+		return path in self._last_seen
+
+	def __len__(self):
+		return len(self._last_seen)
+
+	def paths(self):
+		return sorted(self._last_seen)
+
+	def touch(self, path, timestamp):
+		if path not in self._last_seen:
+			self._created_count += 1
+		self._last_seen[path] = timestamp
+
+	def expire(self, at_time):
+		""" Forgets the paths not sent for idle_seconds, and returns them. """
+		expired = [path for path, timestamp in self._last_seen.items() if at_time - timestamp > self._idle_seconds]
+		for path in expired:
+			del self._last_seen[path]
+		self._expired_count += len(expired)
+		return expired
+
+class CardinalityLimiter(object):
+
+
+	def __init__(self, key_columns, max_keys=None, top_n=None, top_column=None, other_key='other', rollups=(), rollup_key='all'
+			, idle_seconds=600):
+		""" Bounds the number of distinct keys (the values of key_columns) a keyed metric sends, so that a key explosion
+			cannot create thousands of whisper files.  Rows over the limits are folded into one row whose key columns are all
+			other_key, holding the sum of their values:
+				top_n: only the top_n rows by the value of top_column are sent each poll.
+				max_keys: only the first max_keys distinct keys seen are sent; a key frees its place once it has not been seen
+					for idle_seconds.
+			rollups (any of sum, avg, max & min) add rows whose key columns are all rollup_key, holding that rollup of each data
+			column across every row, sent to the column's path suffixed with "_<<rollup>>" (e.g. "IO.all.all.reads_sum").  The
+			rollups of a counter column are of its rates, so the metric appends its rate suffix after the rollup's
+			(e.g. "IO.all.all.reads_sum_per_sec").
+		"""
+		if top_n and not top_column:
+			raise Exception('A top_n limit needs the top_column by which rows are ranked.')
+		invalid_rollups = [r for r in rollups if r not in key_rollup_methods]
+		if invalid_rollups:
+			raise Exception('Key rollups must be any of {}.  User specified: {}'.format(key_rollup_methods, invalid_rollups))
+
+		self._key_columns = list(key_columns)
+		self._max_keys = max_keys
+		self._top_n = top_n
+		self._top_column = top_column
+		self._other_key = other_key
+		self._rollups = tuple(rollups)
+		self._rollup_key = rollup_key
+		self._idle_seconds = idle_seconds
+		self._admitted = {}	# key values: timestamp last seen
+
+		self._folded_count = 0
+
+	max_keys = property(lambda self: self._max_keys)
+
+	top_n = property(lambda self: self._top_n)
+
+	top_column = property(lambda self: self._top_column)
+
+	rollups = property(lambda self: self._rollups)
+
+	admitted_count = property(lambda self: len(self._admitted), None, None
+		, 'The number of distinct keys currently holding one of the max_keys places.')
+
+	folded_count = property(lambda self: self._folded_count, None, None
+		, 'The number of rows folded into the other row.')
+
+	def key_of(self, result):
+		return tuple([result[c] for c in self._key_columns])
+
+	def apply(self, rows, data_columns, timestamp):
+		""" Takes a list of (key column dict, data values, measurement suffix) rows, and returns the rows to send: the rows
+			within the limits, the other row (if any rows were folded), and the rollup rows.
+		"""
+		if self._top_n and len(rows) > self._top_n:
+			i = data_columns.index(self._top_column)
+			ranked = sorted(rows, key=lambda row: (row[1][i] is not None, row[1][i]), reverse=True)
+			kept, folded = ranked[:self._top_n], ranked[self._top_n:]
+		else:
+			kept, folded = list(rows), []
+
+		if self._max_keys is not None:
+			self.__expire_keys(timestamp)
+			admitted = []
+			for row in kept:
+				key = self.key_of(row[0])
+				if key in self._admitted or len(self._admitted) < self._max_keys:
+					self._admitted[key] = timestamp
+					admitted.append(row)
+				else:
+					folded.append(row)
+			kept = admitted
+
+		if folded:
+			self._folded_count += len(folded)
+			kept.append((self.__key_result(folded[0][0], self._other_key), fold_values([row[1] for row in folded]), ''))
+
+		if self._rollups and rows:
+			result = self.__key_result(rows[0][0], self._rollup_key)
+			values = [row[1] for row in rows]
+			for method in self._rollups:
+				kept.append((result, fold_values(values, method), '_' + method))
+		return kept
+
+	def __key_result(self, result, key_value):
+		result = dict(result)
+		for c in self._key_columns:
+			result[c] = key_value
+		return result
+
+	def __expire_keys(self, at_time):
+		for key in [key for key, timestamp in self._admitted.items() if at_time - timestamp > self._idle_seconds]:
+			del self._admitted[key]
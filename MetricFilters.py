@@ -0,0 +1,116 @@
+from __future__ import print_function, unicode_literals, division
+
+from MetricBatch import MetricBatch, iter_datapoints
+
+class SendOnChangeFilter(object):
+
+
+	def __init__(self, heartbeat_seconds=300, idle_seconds=None):
+		""" Keeps the last value sent for each metric path, and filters out items whose value equals it.  So that graphite's
+			keepLastValue can still bridge the gaps, an unchanged value is passed anyway once heartbeat_seconds have passed
+			(by the items' own timestamps) since the path's value was last sent.
+
+			Filtering does not record anything: once the passed items have been sent (or spooled), commit records their values,
+			so that a value whose send failed is not suppressed.  Paths not sent for idle_seconds (by default, twice the
+			heartbeat, or a day without one) are dropped from the table by expire.
+		"""
+		if heartbeat_seconds is not None and heartbeat_seconds < 0:
+			raise Exception('The heartbeat must not be negative.  User specified: {}'.format(heartbeat_seconds))
+
+		self._heartbeat_seconds = heartbeat_seconds
+		self._idle_seconds = idle_seconds if idle_seconds is not None else 2 * heartbeat_seconds if heartbeat_seconds else 86400
+		self._last_values = {}	# metric path: (value, timestamp) last sent
+		self._last_expire_time = None
+		self._expired_count = 0
+
+		self._changed_count = 0
+		self._heartbeat_count = 0
+		self._suppressed_count = 0
+
+	heartbeat_seconds = property(lambda self: self._heartbeat_seconds, None, None
+		, 'The longest time, in seconds, an unchanged value is suppressed before it is sent again.  None never re-sends it.')
+	@heartbeat_seconds.setter
+	def heartbeat_seconds(self, value):
+		self._heartbeat_seconds = value
+
+	path_count = property(lambda self: len(self._last_values), None, None
+		, 'The number of metric paths in the last value table.')
+
+	changed_count = property(lambda self: self._changed_count, None, None
+		, 'The number of items passed because their path was new or its value changed.')
+
+	heartbeat_count = property(lambda self: self._heartbeat_count, None, None
+		, 'The number of unchanged items passed because the heartbeat interval had passed.')
+
+	suppressed_count = property(lambda self: self._suppressed_count, None, None
+		, 'The number of unchanged items filtered out.')
+
+	idle_seconds = property(lambda self: self._idle_seconds)
+
+	expired_count = property(lambda self: self._expired_count, None, None
+		, 'The number of paths dropped from the last value table because they were not sent for idle_seconds.')
+
+	def counters(self):
+		return dict(paths=self.path_count, changed=self._changed_count, heartbeat=self._heartbeat_count
+			, suppressed=self._suppressed_count)
+
+	def __call__(self, items):
+		""" Returns the items which should be sent, in their original order.  A MetricBatch is replaced by a batch of only
+			its datapoints which should be sent, or left out when none should.
+		"""
+		passed = []
+		pending = {}	# metric path: (value, timestamp) passed earlier among these items
+		for item in items:
+			if isinstance(item, MetricBatch):
+				batch = MetricBatch(item.timestamp, priority=item.priority, key=item.key, trace=item.trace)
+				for path, value in zip(item.paths, item.values):
+					if self.passes(path, value, item.timestamp, pending):
+						batch.paths.append(path)
+						batch.values.append(value)
+				if batch.paths:
+					passed.append(batch)
+			elif self.passes(item['graphite_path'], item['value'], item['timestamp'], pending):
+				passed.append(item)
+		return passed
+
+	def passes(self, path, value, timestamp, pending=None):
+		""" Returns True when the datapoint should be sent.  When pending is given, a passed datapoint is recorded in it, so
+			that later datapoints of the same call are compared against it.
+		"""
+		last = pending.get(path) if pending else None
+		if last is None:
+			last = self._last_values.get(path)
+		if last is None or last[0] != value:
+			self._changed_count += 1
+		elif self._heartbeat_seconds is not None and timestamp - last[1] >= self._heartbeat_seconds:
+			self._heartbeat_count += 1
+		else:
+			self._suppressed_count += 1
+			return False
+		if pending is not None:
+			pending[path] = (value, timestamp)
+		return True
+
+	def commit(self, items):
+		""" Records the values of items which were sent (or spooled) as their paths' last sent values. """
+		last_values = self._last_values
+		for path, value, timestamp in iter_datapoints(items):
+			last_values[path] = (value, timestamp)
+
+	def expire(self, at_time, expire_interval_seconds=60):
+		""" Drops the paths not sent for idle_seconds, at most once every expire_interval_seconds.  Returns the number dropped. """
+		if self._last_expire_time is not None and at_time - self._last_expire_time < expire_interval_seconds:
+			return 0
+		self._last_expire_time = at_time
+		expired = [path for path, last in self._last_values.items() if at_time - last[1] > self._idle_seconds]
+		for path in expired:
+			del self._last_values[path]
+		self._expired_count += len(expired)
+		return len(expired)
+
+	def forget(self, path=None):
+		""" Removes the path (or, by default, every path) from the last value table, so that its next value is sent. """
+		if path is None:
+			self._last_values.clear()
+		else:
+			self._last_values.pop(path, None)
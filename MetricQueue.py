@@ -0,0 +1,322 @@
+from __future__ import print_function, unicode_literals, division
+
+import time
+from collections import deque
+from threading import Condition, Lock
+
+from MetricBatch import MetricBatch, item_priority
+
+overflow_policies = ('drop_oldest', 'drop_newest', 'block', 'coalesce')
+
+def item_size(item):
+	""" The number of datapoints an item counts toward a queue's capacity: the length of a MetricBatch, or one. """
+	return len(item) if isinstance(item, MetricBatch) else 1
+
+def graphite_path_key(item):
+	""" The default coalesce key: the path of a dict item, or the key (metric & server) of a MetricBatch. """
+	return item.key if isinstance(item, MetricBatch) else item['graphite_path']
+
+class MetricQueue(object):
+
+
+	def __init__(self):
+		""" A thread safe FIFO queue of metric items which exposes the members of the .NET ConcurrentQueue used by the
+			runners and monitors (Enqueue, TryDequeue and Count), so that they can be used outside of IronPython.
+			Appending to and popping from a deque are atomic, so no lock is required.
+		"""
+		self._items = deque()
+
+	Count = property(lambda self: len(self._items))
+
+	def Enqueue(self, item):
+		self._items.append(item)
+
+	def TryEnqueue(self, item):
+		self._items.append(item)
+		return True
+
+	def TryDequeue(self):
+		""" Returns a tuple of (True, item) when an item was dequeued, otherwise (False, None). """
+		try:
+			return True, self._items.popleft()
+		except (IndexError):
+			return False, None
+
+class BoundedMetricQueue(object):
+
+
+	def __init__(self, capacity=500000, overflow_policy='drop_oldest', block_timeout_seconds=1.0, coalesce_key=graphite_path_key
+			, size=item_size):
+		""" A thread safe FIFO queue of metric items holding at most capacity datapoints, exposing the same members as
+			MetricQueue.  Each item counts as its size (see item_size: a MetricBatch counts its datapoints), so that capacity
+			bounds memory however the datapoints are batched; Count and the counters are in datapoints too.
+			When an item does not fit, the overflow_policy decides what is lost:
+				drop_oldest: the oldest enqueued items are discarded to make room.
+				drop_newest: the item being enqueued is discarded.
+				block: the enqueuing thread waits up to block_timeout_seconds for room, then discards the item being enqueued.
+				coalesce: an item whose coalesce_key (by default its graphite path) is already enqueued replaces the enqueued
+					item's value in place, so only the newest value of each path is kept.  This happens whether or not the queue
+					is full.  An item with a new key enqueued into a full queue discards the oldest enqueued items.
+					Items whose key is None (e.g. relayed batches) are never coalesced.
+			An item larger than capacity is still accepted into an empty queue, rather than being lost whole.
+		"""
+		if overflow_policy not in overflow_policies:
+			raise Exception('The overflow policy must be one of {}.  User specified: {}'.format(overflow_policies, overflow_policy))
+		if capacity < 1:
+			raise Exception('The queue capacity must be at least 1.  User specified: {}'.format(capacity))
+
+		self._capacity = capacity
+		self._overflow_policy = overflow_policy
+		self._block_timeout_seconds = block_timeout_seconds
+		self._coalesce_key = coalesce_key
+		self._size = size
+
+		self._items = deque()
+		self._enqueue_times = deque()	# the epoch time each of the enqueued items was enqueued, in the same order
+		self._datapoint_count = 0	# the summed size of the enqueued items
+		self._coalesce_index = {}	# coalesce key: the enqueued [item] entry holding the newest value for that key.
+		self._not_full = Condition()
+
+		self._enqueued_count = 0
+		self._dequeued_count = 0
+		self._dropped_count = 0
+		self._coalesced_count = 0
+
+	capacity = property(lambda self: self._capacity)
+
+	overflow_policy = property(lambda self: self._overflow_policy)
+
+	Count = property(lambda self: self._datapoint_count, None, None
+		, 'The number of datapoints enqueued.')
+
+	entry_count = property(lambda self: len(self._items), None, None
+		, 'The number of items (or batches) enqueued.')
+
+	enqueued_count = property(lambda self: self._enqueued_count, None, None
+		, 'The number of datapoints accepted into the queue.')
+
+	dequeued_count = property(lambda self: self._dequeued_count, None, None
+		, 'The number of datapoints removed from the queue by TryDequeue.')
+
+	dropped_count = property(lambda self: self._dropped_count, None, None
+		, 'The number of datapoints discarded because the queue was full.')
+
+	coalesced_count = property(lambda self: self._coalesced_count, None, None
+		, 'The number of enqueued datapoints replaced by a newer item of the same key.')
+
+	def counters(self):
+		return dict(depth=self.Count, enqueued=self._enqueued_count, dequeued=self._dequeued_count
+			, dropped=self._dropped_count, coalesced=self._coalesced_count)
+
+	def peek_oldest(self):
+		""" Returns the oldest enqueued item without dequeuing it, or None when the queue is empty. """
+		with self._not_full:
+			if not self._items:
+				return None
+			return self._items[0][0] if self._overflow_policy == 'coalesce' else self._items[0]
+
+	def oldest_enqueue_time(self):
+		""" Returns the epoch time at which the oldest enqueued item was enqueued, or None when the queue is empty.
+			An item coalesced into an enqueued one keeps the enqueued item's place, and so its enqueue time.
+		"""
+		with self._not_full:
+			return self._enqueue_times[0] if self._enqueue_times else None
+
+	def Enqueue(self, item):
+		""" Enqueues the item, applying the overflow policy if the queue is full.  Returns True if the item was accepted
+			(or coalesced into an enqueued item), False if it was discarded.
+		"""
+		return self.__enqueue(item, self._overflow_policy)
+
+	def TryEnqueue(self, item):
+		""" Enqueues the item only if the queue has room: whatever the overflow policy, it neither waits for room nor
+			discards an enqueued item (with coalesce, it still replaces the value of an enqueued item of the same key).
+			Used for items which must not hold up or displace others, such as the runner's own health metrics.
+			Returns True if the item was accepted, False if it was discarded.
+		"""
+		return self.__enqueue(item, 'drop_newest')
+
+	def __enqueue(self, item, full_policy):
+		size = self._size(item)
+		with self._not_full:
+			if self._overflow_policy == 'coalesce':
+				key = self._coalesce_key(item)
+				entry = self._coalesce_index.get(key) if key is not None else None
+				if entry is not None:
+					replaced_size = self._size(entry[0])
+					entry[0] = item
+					self._datapoint_count += size - replaced_size
+					self._coalesced_count += replaced_size
+					self._enqueued_count += size
+					while self._datapoint_count > self._capacity and len(self._items) > 1:
+						self._dropped_count += self._size(self.__pop_oldest())
+					return True
+
+			if self._items and self._datapoint_count + size > self._capacity:
+				if full_policy == 'drop_newest':
+					self._dropped_count += size
+					return False
+				elif full_policy == 'block':
+					deadline = time.time() + self._block_timeout_seconds
+					while self._items and self._datapoint_count + size > self._capacity:
+						remaining = deadline - time.time()
+						if remaining <= 0:
+							self._dropped_count += size
+							return False
+						self._not_full.wait(remaining)
+				else:
+					while self._items and self._datapoint_count + size > self._capacity:
+						self._dropped_count += self._size(self.__pop_oldest())
+
+			if self._overflow_policy == 'coalesce':
+				entry = [item]
+				if key is not None:
+					self._coalesce_index[key] = entry
+				self._items.append(entry)
+			else:
+				self._items.append(item)
+			self._enqueue_times.append(time.time())
+			self._datapoint_count += size
+			self._enqueued_count += size
+			return True
+
+	def TryDequeue(self):
+		""" Returns a tuple of (True, item) when an item was dequeued, otherwise (False, None). """
+		with self._not_full:
+			if not self._items:
+				return False, None
+			item = self.__pop_oldest()
+			self._dequeued_count += self._size(item)
+			self._not_full.notify_all()
+			return True, item
+
+	def __pop_oldest(self):
+		item = self._items.popleft()
+		self._enqueue_times.popleft()
+		if self._overflow_policy == 'coalesce':
+			entry, item = item, item[0]
+			key = self._coalesce_key(item)
+			if self._coalesce_index.get(key) is entry:
+				del self._coalesce_index[key]
+		self._datapoint_count -= self._size(item)
+		return item
+
+default_lane_weights = (('critical', 8), ('normal', 3), ('bulk', 1))
+
+class PriorityMetricQueue(object):
+
+
+	def __init__(self, lane_weights=default_lane_weights, default_lane='normal', capacity=500000, overflow_policy='drop_oldest'
+			, block_timeout_seconds=1.0, coalesce_key=graphite_path_key):
+		""" A thread safe queue of metric items split into priority lanes, exposing the same members as MetricQueue.
+			Each item is enqueued to the lane named by its "priority" (items without one, or with an unknown one, go to
+			default_lane).  Each lane is a BoundedMetricQueue of capacity datapoints, with its own overflow policy.
+
+			TryDequeue drains the lanes by smooth weighted round robin over the (lane, weight) pairs of lane_weights: while every
+			lane has items, a lane of weight 8 is dequeued 8 times for each dequeue of a lane of weight 1; an empty lane yields
+			its turns to the others.  So in a backlog, a lightly loaded critical lane is still drained within a tick.
+			The time each item spent enqueued is measured per lane.
+		"""
+		lane_weights = list(lane_weights.items() if hasattr(lane_weights, 'items') else lane_weights)
+		if not lane_weights or any([weight < 1 for lane, weight in lane_weights]):
+			raise Exception('Each priority lane must have a weight of at least 1.  User specified: {}'.format(lane_weights))
+		if default_lane not in dict(lane_weights):
+			raise Exception('The default lane must be one of the priority lanes {}.  User specified: {}'.format(
+				[lane for lane, weight in lane_weights], default_lane))
+
+		self._lane_weights = lane_weights
+		self._default_lane = default_lane
+		self._lanes = dict([(lane, BoundedMetricQueue(capacity, overflow_policy, block_timeout_seconds
+			, lambda entry: coalesce_key(entry[1]), lambda entry: item_size(entry[1]))) for lane, weight in lane_weights])
+		self._current_weights = dict([(lane, 0) for lane, weight in lane_weights])
+		self._dequeue_lock = Lock()
+
+		self._latency_seconds_total = dict([(lane, 0.0) for lane, weight in lane_weights])
+		self._latency_seconds_max = dict([(lane, 0.0) for lane, weight in lane_weights])
+
+	lanes = property(lambda self: [lane for lane, weight in self._lane_weights], None, None
+		, 'The names of the priority lanes, highest weight first as given.')
+
+	lane_weights = property(lambda self: list(self._lane_weights))
+
+	default_lane = property(lambda self: self._default_lane)
+
+	overflow_policy = property(lambda self: self._lanes[self._default_lane].overflow_policy)
+
+	Count = property(lambda self: sum([lane.Count for lane in self._lanes.values()]))
+
+	entry_count = property(lambda self: sum([lane.entry_count for lane in self._lanes.values()]))
+
+	enqueued_count = property(lambda self: sum([lane.enqueued_count for lane in self._lanes.values()]))
+
+	dequeued_count = property(lambda self: sum([lane.dequeued_count for lane in self._lanes.values()]))
+
+	dropped_count = property(lambda self: sum([lane.dropped_count for lane in self._lanes.values()]))
+
+	coalesced_count = property(lambda self: sum([lane.coalesced_count for lane in self._lanes.values()]))
+
+	def __getitem__(self, lane):
+		return self._lanes[lane]
+
+	def counters(self):
+		return dict(depth=self.Count, enqueued=self.enqueued_count, dequeued=self.dequeued_count
+			, dropped=self.dropped_count, coalesced=self.coalesced_count)
+
+	def lane_counters(self, lane):
+		""" Returns the lane's queue counters, with the total & max seconds its dequeued items spent enqueued. """
+		counters = self._lanes[lane].counters()
+		counters['latency_seconds_total'] = self._latency_seconds_total[lane]
+		counters['latency_seconds_max'] = self._latency_seconds_max[lane]
+		return counters
+
+	def reset_latency_max(self):
+		with self._dequeue_lock:
+			for lane in self._latency_seconds_max:
+				self._latency_seconds_max[lane] = 0.0
+
+	def lane_of(self, item):
+		lane = item_priority(item)
+		return lane if lane in self._lanes else self._default_lane
+
+	def peek_oldest(self):
+		""" Returns the item which has been enqueued longest across all lanes, without dequeuing it, or None. """
+		entries = [entry for entry in [lane.peek_oldest() for lane in self._lanes.values()] if entry is not None]
+		return min(entries, key=lambda entry: entry[0])[1] if entries else None
+
+	def oldest_enqueue_time(self):
+		""" Returns the epoch time at which the oldest item across all lanes was enqueued, or None when the queue is empty. """
+		times = [t for t in [lane.oldest_enqueue_time() for lane in self._lanes.values()] if t is not None]
+		return min(times) if times else None
+
+	def Enqueue(self, item):
+		""" Enqueues the item to its priority lane.  Returns True if the item was accepted, False if it was discarded. """
+		return self._lanes[self.lane_of(item)].Enqueue((time.time(), item))
+
+	def TryEnqueue(self, item):
+		""" Enqueues the item to its priority lane only if the lane has room (see BoundedMetricQueue.TryEnqueue). """
+		return self._lanes[self.lane_of(item)].TryEnqueue((time.time(), item))
+
+	def TryDequeue(self):
+		""" Returns a tuple of (True, item) when an item was dequeued from the lane whose weighted turn it is,
+			otherwise (False, None).
+		"""
+		with self._dequeue_lock:
+			while True:
+				ready = [(lane, weight) for lane, weight in self._lane_weights if self._lanes[lane].Count]
+				if not ready:
+					return False, None
+
+				total_weight = 0
+				for lane, weight in ready:
+					self._current_weights[lane] += weight
+					total_weight += weight
+				lane = max(ready, key=lambda lane_weight: self._current_weights[lane_weight[0]])[0]
+				self._current_weights[lane] -= total_weight
+
+				got_item, entry = self._lanes[lane].TryDequeue()
+				if got_item:	# otherwise another consumer emptied the lane; pick again.
+					latency = time.time() - entry[0]
+					self._latency_seconds_total[lane] += latency
+					if latency > self._latency_seconds_max[lane]:
+						self._latency_seconds_max[lane] = latency
+					return True, entry[1]
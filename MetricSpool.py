@@ -0,0 +1,246 @@
+from __future__ import print_function, unicode_literals, division
+
+import os
+import re
+from threading import Lock
+
+from GraphiteSender import format_plaintext_lines
+from MetricBatch import datapoint_count
+
+segment_name_pattern = re.compile(r'^spool\.(\d{10})\.seg$')
+
+def replace_file(source, destination):
+	""" Renames source over destination.  os.rename will not overwrite an existing file on Windows, and os.replace is not
+		available before python 3.3, so the destination is removed first when necessary.
+	"""
+	try:
+		os.replace(source, destination)
+	except (AttributeError):
+		if os.path.exists(destination):
+			os.remove(destination)
+		os.rename(source, destination)
+
+class MetricSpool(object):
+
+
+	def __init__(self, directory, max_bytes=268435456, segment_bytes=4194304, fsync=True):
+		""" An append only, on disk write ahead spool for metric items which could not be sent to graphite.
+			Items are written as graphite plaintext lines to numbered segment files of up to segment_bytes each, in directory.
+
+			Items are read back oldest first with peek, and only marked as sent with advance once the send succeeded.
+			The read position is kept in an offset file which is replaced atomically, and segments are deleted as soon as they
+			have been read completely, so a crash can at worst cause a replayed chunk to be sent twice.
+
+			When the spool exceeds max_bytes, the oldest segments are discarded.  With fsync True, each append and offset
+			update is flushed to disk before returning.
+		"""
+		self._directory = directory
+		self._max_bytes = max_bytes
+		self._segment_bytes = segment_bytes
+		self._fsync = fsync
+
+		self._lock = Lock()
+		self._segments = {}	# segment number: size in bytes
+		self._read_position = (0, 0)	# (segment number, byte offset)
+		self._write_file = None
+
+		self._spooled_count = 0
+		self._replayed_count = 0
+		self._discarded_bytes = 0
+
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.__load()
+
+	directory = property(lambda self: self._directory)
+
+	max_bytes = property(lambda self: self._max_bytes)
+
+	offset_path = property(lambda self: os.path.join(self._directory, 'spool.offset'))
+
+	spooled_count = property(lambda self: self._spooled_count, None, None
+		, 'The number of items appended to the spool since it was opened.')
+
+	replayed_count = property(lambda self: self._replayed_count, None, None
+		, 'The number of items read from the spool and marked as sent since it was opened.')
+
+	discarded_bytes = property(lambda self: self._discarded_bytes, None, None
+		, 'The number of unsent bytes discarded because the spool exceeded max_bytes.')
+
+	segment_count = property(lambda self: len(self._segments))
+
+	@property
+	def depth_bytes(self):
+		""" The number of bytes in the spool which have not yet been replayed. """
+		return sum(self._segments.values()) - (self._read_position[1] if self._read_position[0] in self._segments else 0)
+
+	def __len__(self):
+		return self.depth_bytes
+
+	def counters(self):
+		return dict(depth_bytes=self.depth_bytes, segments=self.segment_count, spooled=self._spooled_count
+			, replayed=self._replayed_count, discarded_bytes=self._discarded_bytes)
+
+	def segment_path(self, segment_number):
+		return os.path.join(self._directory, 'spool.{:010d}.seg'.format(segment_number))
+
+	def __load(self):
+		""" Finds the segments left by a previous run, and the position up to which they were replayed. """
+		for name in os.listdir(self._directory):
+			m = segment_name_pattern.match(name)
+			if m:
+				self._segments[int(m.group(1))] = os.path.getsize(os.path.join(self._directory, name))
+
+		position = None
+		for path in (self.offset_path, self.offset_path + '.tmp'):
+			try:
+				with open(path, 'rt') as f:
+					segment_number, offset = f.read().split()
+				position = (int(segment_number), int(offset))
+				break
+			except (IOError, OSError, ValueError):
+				continue
+
+		if self._segments:
+			self.__truncate_partial_line(max(self._segments))
+
+		if position is None or position[0] not in self._segments:
+			position = (min(self._segments) if self._segments else 0, 0)
+		self._read_position = position
+
+		# segments before the read position were fully replayed, but not yet removed.
+		for segment_number in [n for n in self._segments if n < position[0]]:
+			self.__remove_segment(segment_number)
+
+	def __truncate_partial_line(self, segment_number):
+		""" Removes a partial line left at the end of a segment by an interrupted write, so that appends start on a new line. """
+		path = self.segment_path(segment_number)
+		with open(path, 'rb+') as f:
+			data = f.read()
+			if data and not data.endswith(b'\n'):
+				f.truncate(data.rfind(b'\n') + 1)
+				self._segments[segment_number] = data.rfind(b'\n') + 1
+
+	def __write_offset(self):
+		temp_path = self.offset_path + '.tmp'
+		with open(temp_path, 'wt') as f:
+			f.write('{} {}'.format(*self._read_position))
+			f.flush()
+			if self._fsync:
+				os.fsync(f.fileno())
+		replace_file(temp_path, self.offset_path)
+
+	def __remove_segment(self, segment_number):
+		if segment_number == self.__write_segment_number():
+			self.__close_write_file()
+		del self._segments[segment_number]
+		try:
+			os.remove(self.segment_path(segment_number))
+		except (OSError):
+			pass
+
+	def __write_segment_number(self):
+		return max(self._segments) if self._segments else None
+
+	def __close_write_file(self):
+		if self._write_file is not None:
+			self._write_file.close()
+			self._write_file = None
+
+	def append(self, items):
+		""" Appends the metric items (or batches) to the newest segment, starting a new segment when it is full.
+			Returns the number of datapoints appended.  Replayed datapoints are read back as dict items.
+		"""
+		count = datapoint_count(items)
+		if not count:
+			return 0
+
+		payload = format_plaintext_lines(items).encode('utf-8')
+		with self._lock:
+			segment_number = self.__write_segment_number()
+			if segment_number is None or self._segments[segment_number] >= self._segment_bytes:
+				self.__close_write_file()
+				segment_number = 0 if segment_number is None else segment_number + 1
+				self._segments[segment_number] = 0
+				if not self._segments or len(self._segments) == 1:
+					self._read_position = (segment_number, 0)
+
+			if self._write_file is None:
+				self._write_file = open(self.segment_path(segment_number), 'ab')
+			self._write_file.write(payload)
+			self._write_file.flush()
+			if self._fsync:
+				os.fsync(self._write_file.fileno())
+			self._segments[segment_number] += len(payload)
+			self._spooled_count += count
+
+			self.__enforce_max_bytes()
+		return count
+
+	def __enforce_max_bytes(self):
+		""" Discards the oldest segments (never the one being written) until the spool fits in max_bytes. """
+		while len(self._segments) > 1 and sum(self._segments.values()) > self._max_bytes:
+			oldest = min(self._segments)
+			self._discarded_bytes += self._segments[oldest] - (self._read_position[1] if self._read_position[0] == oldest else 0)
+			self.__remove_segment(oldest)
+			if self._read_position[0] <= oldest:
+				self._read_position = (min(self._segments), 0)
+				self.__write_offset()
+
+	def peek(self, max_items):
+		""" Reads up to max_items of the oldest unsent items, without marking them as sent.
+			Returns a tuple of the items and the position to pass to advance once they have been sent.
+			A partial line at the end of the newest segment (from an interrupted write) is not read.
+		"""
+		items = []
+		with self._lock:
+			segment_number, offset = self._read_position
+			newest = self.__write_segment_number()
+			while len(items) < max_items and segment_number in self._segments:
+				with open(self.segment_path(segment_number), 'rb') as f:
+					f.seek(offset)
+					while len(items) < max_items:
+						line = f.readline()
+						if not line:
+							break
+						if not line.endswith(b'\n'):
+							if segment_number == newest:
+								break
+						else:
+							item = self.parse_line(line)
+							if item is not None:
+								items.append(item)
+						offset += len(line)
+
+				if offset < self._segments[segment_number] or segment_number == newest:
+					break
+				segment_number, offset = segment_number + 1, 0
+
+		return items, (segment_number, offset)
+
+	def parse_line(self, line):
+		try:
+			graphite_path, value, timestamp = line.decode('utf-8').split()
+			return dict(graphite_path=graphite_path, value=value, timestamp=int(timestamp))
+		except (ValueError, UnicodeDecodeError):
+			return None
+
+	def advance(self, position, item_count=0):
+		""" Marks all items up to the position returned by peek as sent, and removes fully replayed segments. """
+		with self._lock:
+			self._read_position = position
+			for segment_number in [n for n in self._segments if n < position[0]]:
+				self.__remove_segment(segment_number)
+
+			newest = self.__write_segment_number()
+			if newest is not None and position[0] == newest and position[1] >= self._segments[newest]:
+				# everything has been replayed; start over with an empty segment.
+				self.__remove_segment(newest)
+				self._read_position = (newest + 1, 0)
+
+			self._replayed_count += item_count
+			self.__write_offset()
+
+	def close(self):
+		with self._lock:
+			self.__close_write_file()
@@ -0,0 +1,190 @@
+from __future__ import print_function, unicode_literals, division
+
+import bisect
+import math
+import time
+from threading import Lock
+
+from MetricBatch import MetricBatch
+
+trace_stages = ('schedule', 'query', 'emit', 'queue', 'total', 'age')
+execution_measures = ('query_seconds', 'rows', 'values', 'path_seconds')
+
+def datetime_to_epoch(value):
+	""" Returns the epoch time of a local datetime (such as a metric's next_run_time), with its microseconds. """
+	return time.mktime(value.timetuple()) + value.microsecond / 1000000
+
+class LatencyHistogram(object):
+
+	default_bounds = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+	def __init__(self, bounds=default_bounds):
+		""" Counts values (e.g. seconds) in fixed buckets, each holding the values up to and including its upper bound; values
+			above the last bound fall in an overflow bucket.  Adding a value is a bisect and an increment, and memory does not
+			grow with the number of values.  Percentiles are estimated as the upper bound of the bucket holding that rank
+			(capped at the largest value seen).
+		"""
+		self._bounds = tuple(sorted(bounds))
+		self._counts = [0] * (len(self._bounds) + 1)
+		self._count = 0
+		self._total = 0.0
+		self._maximum = 0.0
+
+	bounds = property(lambda self: self._bounds)
+
+	count = property(lambda self: self._count)
+
+	total = property(lambda self: self._total)
+
+	maximum = property(lambda self: self._maximum)
+
+	mean = property(lambda self: self._total / self._count if self._count else 0.0)
+
+	def add(self, value):
+		self._counts[bisect.bisect_left(self._bounds, value)] += 1
+		self._count += 1
+		self._total += value
+		if value > self._maximum:
+			self._maximum = value
+
+	def buckets(self):
+		""" Returns a list of (upper bound, count) tuples; the overflow bucket's upper bound is None. """
+		return list(zip(self._bounds + (None, ), self._counts))
+
+	def percentile(self, percent):
+		if not self._count:
+			return 0.0
+		rank = max(int(math.ceil(percent / 100 * self._count)), 1)
+		cumulative = 0
+		for bound, count in zip(self._bounds, self._counts):
+			cumulative += count
+			if cumulative >= rank:
+				return min(bound, self._maximum)
+		return self._maximum
+
+	def summary(self):
+		return dict(count=self._count, mean=self.mean, max=self._maximum
+			, p50=self.percentile(50), p90=self.percentile(90), p99=self.percentile(99))
+
+	def reset(self):
+		self._counts = [0] * (len(self._bounds) + 1)
+		self._count = 0
+		self._total = 0.0
+		self._maximum = 0.0
+
+class ExecutionStats(object):
+
+	default_count_bounds = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+	def __init__(self, seconds_bounds=LatencyHistogram.default_bounds, count_bounds=default_count_bounds):
+		""" Keeps LatencyHistograms of what each call of a metric function costs:
+				query_seconds: the duration of the query, including reading all rows (for a batch, running & reading the
+					metric's own result set).
+				rows: the number of rows returned.
+				values: the number of values produced from them.
+				path_seconds: the time spent building the paths & values of the rows.
+		"""
+		self._seconds_bounds = seconds_bounds
+		self._count_bounds = count_bounds
+		self._histograms = dict([(measure, LatencyHistogram(count_bounds if measure in ('rows', 'values') else seconds_bounds))
+			for measure in execution_measures])
+		self._lock = Lock()
+
+	def __getitem__(self, measure):
+		return self._histograms[measure]
+
+	def __deepcopy__(self, memo):
+		""" A copy (e.g. of a metric added to a monitor) has its own lock, and empty histograms with the same bounds. """
+		return ExecutionStats(self._seconds_bounds, self._count_bounds)
+
+	def record(self, query_seconds, rows, values, path_seconds):
+		with self._lock:
+			for measure, value in zip(execution_measures, (max(query_seconds, 0.0), rows, values, max(path_seconds, 0.0))):
+				self._histograms[measure].add(value)
+
+	def percentile(self, measure, percent):
+		return self._histograms[measure].percentile(percent)
+
+	def summaries(self, reset=False):
+		""" Returns a dict of {measure: summary} (see LatencyHistogram.summary).  With reset True, the histograms are then emptied. """
+		with self._lock:
+			summaries = dict([(measure, histogram.summary()) for measure, histogram in self._histograms.items() if histogram.count])
+			if reset:
+				for histogram in self._histograms.values():
+					histogram.reset()
+		return summaries
+
+class LatencyTracer(object):
+
+
+	def __init__(self, bounds=LatencyHistogram.default_bounds):
+		""" Keeps LatencyHistograms of the time, in seconds, metric batches spend in each stage between being scheduled and
+			being sent, both overall and per (server, metric):
+				schedule: from the metric's scheduled run time to the start of its query (scheduler lag).
+				query: from the start to the end of the query, including reading all rows.
+				emit: from the end of the query to the batch being enqueued (building paths & values).
+				queue: from being enqueued to the send completing (queueing & sending).
+				total: from the scheduled run time to the send completing.
+				age: from the batch's timestamp to the send completing; how old the datapoints are when they leave.
+		"""
+		self._bounds = bounds
+		self._stages = dict([(stage, LatencyHistogram(bounds)) for stage in trace_stages])
+		self._by_metric = {}	# (server, metric name): {stage: LatencyHistogram}
+		self._lock = Lock()
+
+	def __getitem__(self, stage):
+		return self._stages[stage]
+
+	def metric_keys(self):
+		return sorted(self._by_metric.keys())
+
+	def metric_histogram(self, server, metric_name, stage):
+		return self._by_metric[(server, metric_name)][stage]
+
+	def record(self, server, metric_name, trace, timestamp, sent_time):
+		""" Records the stage latencies of one batch from its (scheduled, query start, query end, enqueued) epoch times.
+			The scheduled time may be None, when the batch was not run by a schedule.
+		"""
+		scheduled, query_start, query_end, enqueued = trace
+		latencies = [('query', query_end - query_start), ('emit', enqueued - query_end), ('queue', sent_time - enqueued)
+			, ('age', sent_time - timestamp)]
+		if scheduled is not None:
+			latencies.extend([('schedule', query_start - scheduled), ('total', sent_time - scheduled)])
+
+		with self._lock:
+			histograms = self._by_metric.get((server, metric_name))
+			if histograms is None:
+				histograms = dict([(stage, LatencyHistogram(self._bounds)) for stage in trace_stages])
+				self._by_metric[(server, metric_name)] = histograms
+			for stage, seconds in latencies:
+				seconds = max(seconds, 0.0)
+				self._stages[stage].add(seconds)
+				histograms[stage].add(seconds)
+
+	def record_items(self, items, sent_time=None):
+		""" Records each traced MetricBatch among the sent items, whose key is (server, root path, metric name).
+			Returns the number of batches recorded.
+		"""
+		sent_time = sent_time if sent_time is not None else time.time()
+		recorded = 0
+		for item in items:
+			if isinstance(item, MetricBatch) and item.trace is not None:
+				self.record(item.key[0], item.key[-1], item.trace, item.timestamp, sent_time)
+				recorded += 1
+		return recorded
+
+	def summaries(self, by_metric=False, reset=False):
+		""" Returns a dict of {stage: summary} (see LatencyHistogram.summary) or, when by_metric is True,
+			of {(server, metric name, stage): summary}.  With reset True, the histograms summarized are then emptied.
+		"""
+		with self._lock:
+			if by_metric:
+				histograms = [((server, metric_name, stage), histogram) for (server, metric_name), stages in self._by_metric.items()
+					for stage, histogram in stages.items()]
+			else:
+				histograms = list(self._stages.items())
+			summaries = dict([(key, histogram.summary()) for key, histogram in histograms if histogram.count])
+			if reset:
+				for key, histogram in histograms:
+					histogram.reset()
+		return summaries
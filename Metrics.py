@@ -5,6 +5,7 @@ from SqlGraphiteMetric import GraphiteSqlMetric
 blocks_waits = GraphiteSqlMetric('metrics.get_waiting_tasks'
 	, path_descriptor='waits', metric_name='blocks_waits'
 	, interval_seconds=5
+	, priority='critical'
 	)
 wait_stats = GraphiteSqlMetric('metrics.get_wait_stats'
 	, path_descriptor='waits.statistics', metric_name='wait_stats'
@@ -36,6 +37,7 @@ lock_stats = GraphiteSqlMetric('metrics.get_resource_locks'
 	, path_descriptor='statistics.resource_locks', metric_name='lock_stats'
 	, key_columns=['waiting_resource']
 	, interval_seconds=60
+	, priority='bulk'
 	)
 latch_wait_stats = GraphiteSqlMetric('metrics.get_latch_waits'
 	, path_descriptor='statistics', metric_name='latch_wait_stats'
@@ -53,6 +55,7 @@ buffer_nodes = GraphiteSqlMetric('metrics.get_buffer_node_values'
 	, path_descriptor='nodes.buffers', metric_name='buffer_nodes'
 	, key_columns=['buffer_node']
 	, interval_seconds=60
+	, priority='bulk'
 	)
 scheduler_waits = GraphiteSqlMetric('metrics.get_scheduler_waits'
 	, path_descriptor='nodes.schedulers', metric_name='scheduler_waits'
@@ -74,5 +77,6 @@ io = GraphiteSqlMetric('metrics.get_read_write_times'
 	, metric_name='io'
 	, key_columns=['database_name','database_file_type','database_file_name', 'physical_drive_letter']
 	, metric_path_function=build_io_result_metric_path
+	, path_columns=['database_name', 'database_file_type', 'physical_drive_letter']
 	, interval_seconds=15
 	)
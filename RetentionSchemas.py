@@ -0,0 +1,135 @@
+from __future__ import print_function, unicode_literals, division
+
+import io
+import re
+
+try:
+	from configparser import RawConfigParser
+except (ImportError):
+	from ConfigParser import RawConfigParser	# python 2
+
+unit_seconds = dict(s=1, m=60, min=60, h=3600, d=86400, w=604800, y=31536000)
+retention_pattern = re.compile(r'^(\d+)([a-z]*):(\d+)([a-z]*)$')
+
+def parse_retention(retention):
+	""" Returns the (seconds per point, points) of a carbon retention definition: "10s:14d" (precision:duration) or
+		"10:120960" (seconds per point:points).
+	"""
+	m = retention_pattern.match(retention.strip().lower())
+	if not m or (m.group(2) and m.group(2) not in unit_seconds) or (m.group(4) and m.group(4) not in unit_seconds):
+		raise Exception('The retention must be formatted as "precision:duration", e.g. "10s:14d".  User specified: {}'.format(retention))
+	precision = int(m.group(1)) * unit_seconds.get(m.group(2), 1)
+	duration = int(m.group(3))
+	points = duration * unit_seconds[m.group(4)] // precision if m.group(4) else duration
+	return precision, points
+
+class RetentionSchema(object):
+
+
+	def __init__(self, name, pattern, retentions):
+		""" One section of carbon's storage-schemas.conf: the whisper retentions of all metric paths matching the pattern.
+			retentions are (seconds per point, points) tuples or carbon retention strings, finest first.
+		"""
+		self._name = name
+		self._pattern = pattern
+		self._regex = re.compile(pattern)
+		self._retentions = [parse_retention(r) if not isinstance(r, tuple) else r for r in retentions]
+		if not self._retentions:
+			raise Exception('The retention schema [{}] defines no retentions.'.format(name))
+
+	name = property(lambda self: self._name)
+
+	pattern = property(lambda self: self._pattern)
+
+	retentions = property(lambda self: list(self._retentions))
+
+	precision_seconds = property(lambda self: self._retentions[0][0], None, None
+		, 'The seconds per point of the finest retention; the interval at which the schema expects datapoints.')
+
+	def matches(self, path):
+		return self._regex.search(path) is not None
+
+class RetentionMap(object):
+
+	interval_node_format = '{}seconds'
+
+	def __init__(self, schemas):
+		""" The retention schemas of a graphite server, in the order carbon applies them (the first match wins), from which
+			the polling intervals a metric may use, and the root path of each interval, are derived.
+			A metric polled every n seconds is sent under "<<root>>.<<server>>.<<n>>seconds", and the schema which carbon
+			will apply to that root must store points every n seconds, or whisper would average or drop datapoints.
+		"""
+		self._schemas = list(schemas)
+
+	schemas = property(lambda self: list(self._schemas))
+
+	@property
+	def intervals(self):
+		""" The polling intervals, in seconds, for which some schema holds points at that precision. """
+		return sorted(set([schema.precision_seconds for schema in self._schemas]))
+
+	@classmethod
+	def parse(cls, text):
+		""" Returns the map of the storage-schemas.conf formatted text.  Sections without a pattern (such as a default
+			catch all written as "pattern = .*") are required to define one, as carbon does.
+		"""
+		parser = RawConfigParser()
+		if hasattr(parser, 'read_string'):
+			parser.read_string(text)
+		else:
+			parser.readfp(io.StringIO(text))
+		schemas = []
+		for section in parser.sections():
+			if not parser.has_option(section, 'pattern') or not parser.has_option(section, 'retentions'):
+				raise Exception('The retention schema [{}] must define both a pattern and retentions.'.format(section))
+			schemas.append(RetentionSchema(section, parser.get(section, 'pattern')
+				, [r for r in parser.get(section, 'retentions').split(',') if r.strip()]))
+		return cls(schemas)
+
+	@classmethod
+	def load(cls, path):
+		with io.open(path, 'rt', encoding='utf-8') as f:
+			return cls.parse(f.read())
+
+	def schema_for(self, path):
+		""" Returns the schema carbon applies to a metric path: the first one whose pattern matches, or None. """
+		for schema in self._schemas:
+			if schema.matches(path):
+				return schema
+		return None
+
+	def check_interval(self, interval_seconds):
+		if interval_seconds != -1 and interval_seconds not in self.intervals:
+			raise Exception('No retention schema stores points every {} seconds.  Metrics can poll at one of: {}'.format(
+				interval_seconds, self.intervals))
+		return interval_seconds
+
+	def interval_node(self, interval_seconds):
+		return self.interval_node_format.format(interval_seconds)
+
+	def check_root(self, root_path, interval_seconds):
+		""" Raises an exception unless the schema carbon applies to metrics under root_path stores points every
+			interval_seconds.  Returns the schema.
+		"""
+		schema = self.schema_for(root_path + '.metric')
+		if schema is None:
+			raise Exception('No retention schema matches metrics under {}.'.format(root_path))
+		if schema.precision_seconds != interval_seconds:
+			raise Exception('Metrics polled every {} seconds under {} would be stored by the retention schema [{}] at {} second precision.'.format(
+				interval_seconds, root_path, schema.name, schema.precision_seconds))
+		return schema
+
+default_storage_schemas = """[ceci_5seconds]
+pattern = \\.5seconds\\.
+retentions = 5s:1d,1m:30d,15m:2y
+
+[ceci_15seconds]
+pattern = \\.15seconds\\.
+retentions = 15s:7d,5m:90d,1h:2y
+
+[ceci_60seconds]
+pattern = \\.60seconds\\.
+retentions = 60s:30d,15m:1y,1h:5y
+"""
+
+default_retention_map = RetentionMap.parse(default_storage_schemas)	# the 5, 15 & 60 second intervals ceci has always used.
@@ -0,0 +1,131 @@
+from __future__ import print_function, unicode_literals, division
+
+import io
+import json
+import os
+from threading import Lock
+
+from MetricSpool import replace_file
+
+class SchemaCatalog(object):
+
+
+	def __init__(self, path=None):
+		""" Caches what GraphiteSqlMetric.try_prepare learns about each metric function, keyed by (instance, db, function):
+			the quoted function name, its column list, and its object_id & modify_date when it was described.
+			Share one catalog among all monitors (pass it to each SqlServerMonitor as schema_catalog).
+
+			With a path, the catalog is loaded from that JSON file, and saved back to it whenever it has changed.  Entries are
+			trusted only once validate has compared their object_id & modify_date against the server, which takes one query
+			for all of a server's functions.
+		"""
+		self._path = path
+		self._entries = {}	# (instance, db, function name): dict(quoted_name, columns, object_id, modify_date)
+		self._is_dirty = False
+		self._lock = Lock()
+
+		self._hit_count = 0
+		self._miss_count = 0
+		self._invalidated_count = 0
+
+		if path and os.path.exists(path):
+			self.load()
+
+	path = property(lambda self: self._path)
+
+	hit_count = property(lambda self: self._hit_count, None, None
+		, 'The number of metric preparations answered from the catalog.')
+
+	miss_count = property(lambda self: self._miss_count, None, None
+		, 'The number of metric preparations which had to describe the function on the server.')
+
+	invalidated_count = property(lambda self: self._invalidated_count, None, None
+		, 'The number of entries dropped because the function was changed or dropped on the server.')
+
+	is_dirty = property(lambda self: self._is_dirty, None, None
+		, 'True when the catalog has changed since it was last saved.')
+
+	def __len__(self):
+		return len(self._entries)
+
+	def get(self, instance, db, function_name):
+		""" Returns the entry of the function, or None. """
+		entry = self._entries.get((instance, db, function_name))
+		if entry is None:
+			self._miss_count += 1
+		else:
+			self._hit_count += 1
+		return entry
+
+	def put(self, instance, db, function_name, quoted_name, columns, version):
+		""" Stores a described function.  version is the (object_id, modify_date) returned by object_versions. """
+		with self._lock:
+			self._entries[(instance, db, function_name)] = dict(quoted_name=quoted_name, columns=list(columns)
+				, object_id=version[0], modify_date=version[1])
+			self._is_dirty = True
+
+	def invalidate(self, instance, db, function_name):
+		with self._lock:
+			if self._entries.pop((instance, db, function_name), None) is not None:
+				self._invalidated_count += 1
+				self._is_dirty = True
+
+	def object_versions(self, target, function_names):
+		""" Returns a dict of function name: (object_id, modify_date) for the inline table value functions named, with one
+			query against the target's current database.  Functions which do not exist map to None.
+			Returns None if the query failed.
+		"""
+		names = sorted(set(function_names))
+		if not names:
+			return {}
+		query = """SELECT f.function_name, o.object_id, convert(nvarchar(30), o.modify_date, 126) AS modify_date
+			FROM (VALUES {}) AS f(function_name)
+			LEFT JOIN sys.objects AS o ON o.object_id = object_id(f.function_name, N'IF');""".format(
+				', '.join(["(N'{}')".format(name.replace("'", "''")) for name in names]))
+		results = target.query_columns(query)
+		if results is False:
+			return None
+		return dict([(name, (object_id, modify_date) if object_id is not None else None)
+			for name, object_id, modify_date in zip(results['function_name'], results['object_id'], results['modify_date'])])
+
+	def validate(self, target, function_names):
+		""" Compares the entries of the functions on the target server & database against the server's current object_id
+			& modify_date, in one query, and drops the entries which no longer match.  Returns the number of valid entries.
+		"""
+		names = [name for name in function_names if (target.instance, target.db, name) in self._entries]
+		if not names:
+			return 0
+		versions = self.object_versions(target, names) or {}
+		valid = 0
+		for name in names:
+			entry = self._entries[(target.instance, target.db, name)]
+			if versions.get(name) == (entry['object_id'], entry['modify_date']):
+				valid += 1
+			else:
+				self.invalidate(target.instance, target.db, name)
+		return valid
+
+	def load(self):
+		with io.open(self._path, 'rt', encoding='utf-8') as f:
+			entries = json.load(f)
+		with self._lock:
+			self._entries = dict([((e['instance'], e['db'], e['function_name']), dict(quoted_name=e['quoted_name']
+				, columns=e['columns'], object_id=e['object_id'], modify_date=e['modify_date'])) for e in entries])
+			self._is_dirty = False
+
+	def save(self):
+		""" Writes the catalog to its path, replacing the previous file atomically. """
+		if not self._path:
+			return
+		with self._lock:
+			entries = [dict(instance=instance, db=db, function_name=function_name, **entry)
+				for (instance, db, function_name), entry in sorted(self._entries.items())]
+			temp_path = self._path + '.tmp'
+			with io.open(temp_path, 'wt', encoding='utf-8') as f:
+				f.write('{}'.format(json.dumps(entries, indent=1, sort_keys=True)))
+			replace_file(temp_path, self._path)
+			self._is_dirty = False
+
+	def save_if_dirty(self):
+		if self._is_dirty:
+			self.save()
@@ -0,0 +1,241 @@
+from __future__ import print_function, unicode_literals, division
+
+import math
+import struct
+from multiprocessing import shared_memory
+from threading import Lock
+
+from MetricBatch import MetricBatch, iter_datapoints, item_priority, intern_path
+
+ring_magic = b'CECIRING'
+ring_version = 2
+ring_priorities = ('critical', 'normal', 'bulk')
+
+header_format = struct.Struct('<8sIIII')	# magic, version, capacity, record size, max path bytes
+counter_format = struct.Struct('<Q')
+head_offset = 64	# read sequence, written only by the reader; on its own cache line.
+tail_offset = 128	# write sequence, written only by the writer.
+dropped_offset = 136	# datapoints the writer dropped because the ring was full.
+invalid_offset = 144	# datapoints the writer could not write: paths too long, or non-numeric values.
+data_offset = 192
+
+record_header_format = struct.Struct('<qdBH')	# timestamp, value, priority index, path length
+
+class SharedMetricRing(object):
+
+
+	def __init__(self, name, capacity=65536, max_path_bytes=200, create=False):
+		""" A single producer, single consumer ring of fixed size datapoint records in a named multiprocessing.shared_memory
+			block, so that a collector process can hand datapoints to the sender process without pickling or per item IPC.
+			Requires CPython 3.8 or later.
+
+			Each record holds a timestamp, a float value, a priority and up to max_path_bytes of utf-8 path.  A MetricBatch's
+			trace and key are not carried, so latency tracing and coalescing of its datapoints start over in the reading
+			process.  The writer only advances the tail (after writing the record) and the reader only advances the head
+			(after reading it), so the two processes share no lock.  This relies on the stores being seen in order by the
+			other process, as on x86.
+
+			With create True the block is created with room for capacity records; otherwise the existing block is attached,
+			and its layout is read from its header.  Exactly one process may write to a ring, and one may read it.  Within
+			the writing process, writes are serialized by a lock, so that several threads (e.g. the timers of several
+			monitors) can share the ring.
+		"""
+		self._create = create
+		if create:
+			self._record_size = record_header_format.size + max_path_bytes
+			self._shm = shared_memory.SharedMemory(name=name, create=True, size=data_offset + capacity * self._record_size)
+			header_format.pack_into(self._shm.buf, 0, ring_magic, ring_version, capacity, self._record_size, max_path_bytes)
+			for offset in (head_offset, tail_offset, dropped_offset, invalid_offset):
+				counter_format.pack_into(self._shm.buf, offset, 0)
+		else:
+			self._shm = self.__attach(name)
+			magic, version, capacity, self._record_size, max_path_bytes = header_format.unpack_from(self._shm.buf, 0)
+			if magic != ring_magic or version != ring_version:
+				self._shm.close()
+				raise Exception('The shared memory block {} is not a version {} metric ring.'.format(name, ring_version))
+
+		self._name = name
+		self._capacity = capacity
+		self._max_path_bytes = max_path_bytes
+		self._buf = self._shm.buf
+
+		self._write_lock = Lock()
+		self._written_count = 0
+		self._read_count = 0
+
+	def __attach(self, name):
+		""" Attaches without registering the block with the resource tracker, which would otherwise unlink it when this
+			process exits, while the process which created it is still using it.
+
+			Before python 3.13, attaching always registers the block, so the registration is undone; but only when attaching
+			started this process's resource tracker.  A tracker which was already running may have been inherited from the
+			creating process (e.g. a collector forked or spawned by the sender), in which case the registration is the creator's
+			own, and must stay for the creator to unlink the block.  So a process which attaches a ring, and already ran its
+			own resource tracker (e.g. for other shared memory), unlinks the block when it exits.
+		"""
+		try:
+			return shared_memory.SharedMemory(name=name, create=False, track=False)
+		except (TypeError):	# before python 3.13
+			try:
+				from multiprocessing import resource_tracker
+				tracker_running = resource_tracker._resource_tracker._fd is not None
+			except (ImportError, AttributeError):
+				resource_tracker = None
+			shm = shared_memory.SharedMemory(name=name, create=False)
+			if resource_tracker is not None and not tracker_running:
+				try:
+					resource_tracker.unregister(shm._name, 'shared_memory')
+				except (AttributeError, KeyError):
+					pass
+			return shm
+
+	name = property(lambda self: self._name)
+
+	capacity = property(lambda self: self._capacity)
+
+	max_path_bytes = property(lambda self: self._max_path_bytes)
+
+	head = property(lambda self: counter_format.unpack_from(self._buf, head_offset)[0])
+
+	tail = property(lambda self: counter_format.unpack_from(self._buf, tail_offset)[0])
+
+	Count = property(lambda self: self.tail - self.head, None, None
+		, 'The number of records written and not yet read.')
+
+	dropped_count = property(lambda self: counter_format.unpack_from(self._buf, dropped_offset)[0], None, None
+		, 'The number of datapoints the writer dropped because the ring was full.')
+
+	written_count = property(lambda self: self._written_count, None, None
+		, 'The number of records this process wrote.')
+
+	read_count = property(lambda self: self._read_count, None, None
+		, 'The number of records this process read.')
+
+	invalid_count = property(lambda self: counter_format.unpack_from(self._buf, invalid_offset)[0], None, None
+		, 'The number of datapoints the writer could not write: paths longer than max_path_bytes, or non-numeric values.')
+
+	def counters(self):
+		return dict(depth=self.Count, written=self._written_count, read=self._read_count, dropped=self.dropped_count
+			, invalid=self.invalid_count)
+
+	def __increment(self, offset):
+		counter_format.pack_into(self._buf, offset, counter_format.unpack_from(self._buf, offset)[0] + 1)
+
+	def write(self, path, value, timestamp, priority=None):
+		""" Writes one datapoint.  Returns False when it was dropped because the ring is full or it was invalid. """
+		encoded = path.encode('utf-8')
+		try:
+			value = float(value)
+		except (TypeError, ValueError):
+			value = None
+		with self._write_lock:
+			if value is None or len(encoded) > self._max_path_bytes or math.isnan(value):
+				self.__increment(invalid_offset)
+				return False
+
+			tail = self.tail
+			if tail - self.head >= self._capacity:
+				self.__increment(dropped_offset)
+				return False
+
+			offset = data_offset + (tail % self._capacity) * self._record_size
+			record_header_format.pack_into(self._buf, offset, int(timestamp), value
+				, ring_priorities.index(priority) if priority in ring_priorities else 1, len(encoded))
+			start = offset + record_header_format.size
+			self._buf[start:start + len(encoded)] = encoded
+			counter_format.pack_into(self._buf, tail_offset, tail + 1)	# publishes the record.
+			self._written_count += 1
+			return True
+
+	def Enqueue(self, item):
+		""" Writes each datapoint of a dict item or MetricBatch, so that the ring can stand in for a runner's queue in a
+			collector process (e.g. SqlServerMonitor.attach(ring)).  Returns True if every datapoint was written.
+		"""
+		priority = item_priority(item)
+		written = True
+		for path, value, timestamp in iter_datapoints((item, )):
+			written = self.write(path, value, timestamp, priority) and written
+		return written
+
+	def read(self, max_records=None):
+		""" Reads up to max_records of the oldest records, as (path, value, timestamp, priority) tuples. """
+		head = self.head
+		tail = self.tail
+		if max_records is not None:
+			tail = min(tail, head + max_records)
+
+		datapoints = []
+		for sequence in range(head, tail):
+			offset = data_offset + (sequence % self._capacity) * self._record_size
+			timestamp, value, priority, length = record_header_format.unpack_from(self._buf, offset)
+			start = offset + record_header_format.size
+			path = intern_path(bytes(self._buf[start:start + length]).decode('utf-8'))
+			datapoints.append((path, value, timestamp, ring_priorities[priority]))
+		counter_format.pack_into(self._buf, head_offset, tail)	# releases the records to the writer.
+		self._read_count += tail - head
+		return datapoints
+
+	def close(self):
+		self._buf = None
+		self._shm.close()
+
+	def unlink(self):
+		""" Removes the shared memory block.  Called by the process which created it, once no process uses it. """
+		self._shm.unlink()
+
+class SharedMetricRingRelay(object):
+
+
+	def __init__(self, rings, max_records_per_poll=100000):
+		""" Merges the datapoints written to SharedMetricRings by collector processes into a runner's queue; added to the
+			runner with add_relay.  On each send tick, up to max_records_per_poll records are read from each ring and enqueued
+			as MetricBatch records.  Rings are given as SharedMetricRing objects or as the names of existing rings.
+		"""
+		self._rings = [ring if isinstance(ring, SharedMetricRing) else SharedMetricRing(ring) for ring in rings]
+		self._max_records_per_poll = max_records_per_poll
+		self._queue = None
+		self._received_count = 0
+
+	rings = property(lambda self: list(self._rings))
+
+	received_count = property(lambda self: self._received_count, None, None
+		, 'The number of datapoints read from the rings.')
+
+	invalid_count = property(lambda self: sum([ring.invalid_count for ring in self._rings]), None, None
+		, 'The number of datapoints the collector processes could not write to their ring.')
+
+	dropped_count = property(lambda self: sum([ring.dropped_count for ring in self._rings]), None, None
+		, 'The number of datapoints the collector processes dropped because their ring was full.')
+
+	def attach(self, queue):
+		self._queue = queue
+		return self
+
+	def start(self):
+		return self
+
+	def stop(self):
+		pass
+
+	def poll(self, at_time=None, force=False):
+		""" Enqueues the records waiting in each ring (all of them, when force is True).  Returns the number of datapoints enqueued. """
+		if self._queue is None:
+			return 0
+		count = 0
+		for ring in self._rings:
+			batches = {}	# (priority, timestamp): MetricBatch
+			for path, value, timestamp, priority in ring.read(None if force else self._max_records_per_poll):
+				batch = batches.get((priority, timestamp))
+				if batch is None:
+					batch = batches[(priority, timestamp)] = MetricBatch(timestamp, priority=priority)
+				batch.paths.append(path)
+				batch.values.append(value)
+				count += 1
+			for key in sorted(batches, key=lambda key: key[1]):
+				self._queue.Enqueue(batches[key])
+		self._received_count += count
+		return count
+
+	def close(self):
+		for ring in self._rings:
+			ring.close()
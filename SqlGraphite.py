@@ -1,29 +1,20 @@
 from __future__ import print_function, unicode_literals, division
 
-import socket
-from threading import Event
+import time
+from threading import Event, Lock
 
-import clr
-clr.AddReference('System.Collections')
-
-from System.Collections.Concurrent import ConcurrentQueue
 from System.Threading import Timer, TimerCallback, Timeout
 
 from ApplicationBase import WindowsAppLoggingBase as LoggingBase
+from GraphiteRunnerBase import GraphiteRunnerBase
 
-class SqlMonitorGraphiteRunner(LoggingBase):
+class SqlMonitorGraphiteRunner(GraphiteRunnerBase, LoggingBase):
 
 
 	def __init__(self, **kwargs):
-		self._servers = {}
-		self._queue = ConcurrentQueue[dict]()
-
-		self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)	# UDP
-		self._graphite_server = None
-		self._graphite_port = None
 		self._is_paused = Event()
-		self._echo = False
-		self._silent = False
+		self._send_lock = Lock()
+		self._is_shut_down = False
 
 		_delegate = TimerCallback(self.send_to_graphite)
 		self._send_timer = Timer(_delegate, None, Timeout.Infinite, Timeout.Infinite)
@@ -31,66 +22,19 @@ class SqlMonitorGraphiteRunner(LoggingBase):
 		super(SqlMonitorGraphiteRunner, self).__init__(**kwargs)
 		self.info(">>>>>>>>>>>>>>>>>>LET'S!>>START!>>RUNNING!!!>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
 
-	def add_server(self, server):
-		self[server.name] = server
-		return self
-
-	def __getitem__(self, server_name):
-		if '\\' in server_name:
-			server_name = server_name.replace('\\', '.')
-		return self._servers[server_name]
-
-	@LoggingBase.log_to('debug', log_with_params=True)
-	def __setitem__(self, server_name, value):
-		if '\\' in server_name:
-			server_name = server_name.replace('\\', '.')
-		if server_name in self._servers:
-			self.error('''Cannot add the same server and instance to the monitor runner twice.  To alter metrics attached to the server, address the attached server directly.''')
-		else:
-			self._servers[server_name] = value
-
-	graphite_server = property(lambda self: self._graphite_server)
-	@graphite_server.setter
-	def graphite_server(self, value):
-		self._graphite_server = value
-
-	graphite_port = property(lambda self: self._graphite_port)
-	@graphite_port.setter
-	def graphite_port(self, value):
-		self._graphite_port = value
-
-	echo = property(lambda self: self._echo, None, None
-		, '''Echoes all received metrics to the screen when True. When False still prints "." to the terminal while running and "*" while sending. To suppress all output set "silent" to True.''')
-	@echo.setter
-	def echo(self, value):
-		self._echo = bool(value)
-
-	silent = property(lambda self: self._silent, None, None
-		, '''Suppresses all terminal output.''')
-	@silent.setter
-	def silent(self, value):
-		self._silent = bool(value)
-
-	def __call__(self, graphite_server=None, graphite_port=None, echo=None):
-		self.start(graphite_server, graphite_port, echo)
-
 	@LoggingBase.log_to('debug', log_with_params=True)
 	def start(self, graphite_server=None, graphite_port=None, echo=None):
-		""" On start, the runner passes the ConcurrentQueue object to all added servers as a place to store graphite metric 
+		""" On start, the runner passes its bounded queue to all added servers as a place to store graphite metric
 			results.  The results are then dequeued and sent to the graphite server & port by the GraphiteMonitor.
 
-			Server & port should either be specified in this method, or assigned directly to the GraphiteMonitor object using the exposed 
+			Server & port should either be specified in this method, or assigned directly to the GraphiteMonitor object using the exposed
 			properties before the start command is issued.
 		"""
-		if graphite_server:
-			self._graphite_server = graphite_server
-		if graphite_port:
-			self._graphite_port = graphite_port
-		if echo:
-			self._echo = echo
+		self.configure(graphite_server, graphite_port, echo)
 		for server_name in self._servers:
 			# pass the collection queue to each server being monitored, and start monitoring on those servers.
 			self[server_name](self._queue)
+		self.start_relays()
 
 		return self.run()
 
@@ -107,39 +51,47 @@ class SqlMonitorGraphiteRunner(LoggingBase):
 		self._send_timer.Change(Timeout.Infinite, Timeout.Infinite)
 
 	@LoggingBase.log_to('debug')
-	def quit(self):
-		self.__del__()
+	def quit(self, drain_seconds=None):
+		return self.shutdown(drain_seconds)
 
 	def __del__(self):
+		self.shutdown()
+
+	def shutdown(self, drain_seconds=None):
+		""" Releases the timers on all monitored servers, then sends whatever remains enqueued until the queue is empty
+			or drain_seconds (default: shutdown_drain_seconds) pass.  Returns the number of items left unsent.
+		"""
+		if self._is_shut_down:
+			return 0
+
+		unsent = 0
 		try:
 			for server_name in self._servers.keys():
 				self[server_name].release_timer()
-			while self.send_to_graphite():
-				pass
+			self.stop_relays()
+			self._send_timer.Change(Timeout.Infinite, Timeout.Infinite)
+
+			with self._send_lock:
+				unsent = self.drain_for_shutdown(drain_seconds)
 		except (Exception) as e:
 			self.exception(e)
 			raise e
 		finally:
-			self._socket.close()
+			self._is_shut_down = True
+			self.close_connections()
 			self._send_timer.Dispose()
 
-	def send_to_graphite(self, item=None):
-		""" This recursive function will continue to dequeue and send all enqueued items one at a time 
-			over UDP to the graphite server & port. 
-			If echo is ON and no items are found to send, prints a dot (".") to the screen. 
-		"""
-		if not item:
-			if not self.silent:
-				print('.', end='')
-		else:
-			message = "{graphite_path} {value} {timestamp}\n".format(**item)
-			if not self.silent:
-				print(message if self.echo else '*', end='')
-			self._socket.sendto(message, (self.graphite_server, self.graphite_port))
-
-		got_item, item = self._queue.TryDequeue()
-		if got_item:
-			self.send_to_graphite(item)
-		return got_item
-
+		return unsent
 
+	def send_to_graphite(self, state=None):
+		""" Function called on timer to send enqueued items to the graphite server & port, within the per tick budget
+			of max_items_per_tick and max_seconds_per_tick.  Returns the number of items sent.
+			When called from TimerCallback, the state argument is always passed (and ignored).
+			If the previous tick is still sending, this tick returns immediately.
+		"""
+		if not self._send_lock.acquire(False):
+			return 0
+		try:
+			return self.drain(self.max_items_per_tick, time.time() + self.max_seconds_per_tick)
+		finally:
+			self._send_lock.release()
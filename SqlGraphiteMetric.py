@@ -1,6 +1,14 @@
 from __future__ import print_function, unicode_literals, division
 
 import time
+from collections import OrderedDict
+from string import Formatter
+
+from CircuitBreaker import CircuitBreaker
+from MetricAggregation import MetricAggregator, CounterRates
+from MetricCardinality import CardinalityLimiter, PathRegistry
+from MetricBatch import MetricBatch, intern_path
+from MetricTracing import datetime_to_epoch, ExecutionStats
 
 def append_dot(instring):
 	""" Function returns a string with a single dot at the end, or an empty string if passed an empty object.
@@ -15,14 +23,21 @@ def append_dot(instring):
 
 class GraphiteSqlMetric(object):
 
-	metric_intervals = {-1, 5, 15, 60}
+	priorities = ('critical', 'normal', 'bulk')
 
 	def check_interval(self, interval_seconds):
-		if interval_seconds not in self.metric_intervals:
-			raise Exception('A metric can only poll at one of the following intervals (in seconds): {}'.format(self.metric_intervals))
+		""" A metric polls every interval_seconds, or is disabled with -1.  The monitor a metric is added to checks the
+			interval against the retention schemas of its graphite server, as does setting the interval of an added metric.
+		"""
+		if interval_seconds != -1 and not interval_seconds > 0:
+			raise Exception('A metric must poll at a positive interval (in seconds), or -1 to disable it.  User specified: {}'.format(interval_seconds))
 		return interval_seconds
 
-	def __init__(self, function_name, key_columns=[], path_descriptor=None, metric_name=None, metric_path_function=None, interval_seconds=60):
+	def __init__(self, function_name, key_columns=[], path_descriptor=None, metric_name=None, metric_path_function=None, interval_seconds=60
+			, aggregate_seconds=None, rollups=('avg', ), forward_raw=True, priority='normal', path_template=None, path_cache_size=10000
+			, counter_columns=(), rate_suffix='_per_sec', command_timeout_seconds=None, timeout_fraction=0.5, breaker_timeouts=3
+			, breaker_cooldown_seconds=None, max_keys=None, top_n=None, top_column=None, other_key='other', key_rollups=()
+			, series_idle_seconds=None, path_columns=None):
 		""" Creates a graphite poller based on results of a SQL Server table value function.
 			If key_columns are specified, they should be ordered as appropriate in the graphite path, or a formatter 
 			function should be specified as "metric_path_function".
@@ -32,7 +47,44 @@ class GraphiteSqlMetric(object):
 
 			The metric will be named for the path_descriptor if no name is specified.  This means that if two metrics send to the same path,
 			you must specify a name for at least one of them.
+
+			If aggregate_seconds is specified, each value is also added to a per path window of that many seconds, and the rollups
+			(any of avg, min, max, last, sum & count) of each completed window are sent to their own suffixed paths
+			(e.g. "wait_time_ms_avg").  Set forward_raw to False to send only the rollups, and not every polled value.
+
+			Instead of a metric_path_function, a path_template may name the result columns from which each row's path is
+			built, e.g. "IO.{database_file_type}.{physical_drive_letter}"; spaces in column values are replaced by underscores.
+			The template is compiled once the metric is prepared.  Built paths are interned, and kept in a least recently used
+			cache of up to path_cache_size paths, keyed by root path, the row's key values and the data column.  The key values
+			are those of the template's columns, or of key_columns.  A metric_path_function may read any column, so its paths
+			are only cached when path_columns names every column it uses; otherwise each path is built for every row.
+
+			Data columns named in counter_columns hold cumulative counters: instead of their raw value, the per second rate
+			since the previous poll is sent, to the column's path with rate_suffix appended (e.g. "wait_time_ms_per_sec").
+			No rate is sent for the first poll of a path, nor after the counter was reset (e.g. by a SQL Server restart).
+
+			The priority (critical, normal or bulk) is set on each of the metric's items.  A runner with priority_lanes
+			sends critical items ahead of a backlog of normal & bulk items.
+
+			The metric function is cancelled once it runs for command_timeout_seconds; by default, timeout_fraction of the
+			interval (at least one second), so that a slow function cannot delay the server's other metrics past their own
+			interval.  After breaker_timeouts consecutive timeouts the metric's circuit_breaker opens, and the metric is
+			skipped for breaker_cooldown_seconds (by default, five intervals) rather than adding load to a struggling server.
+			The first call after the cooldown is a probe, whose success resumes polling.
+
+			Keyed metrics can bound the number of series they create (see MetricCardinality.CardinalityLimiter): max_keys
+			distinct keys at most, only the top_n rows by top_column each poll, with the rest folded into a row whose key
+			columns are other_key, and key_rollups (sum, avg, max, min) sent across all keys.  Counter rates are taken per
+			key before folding, so a counter column's rollups are sent to "<<column>>_<<rollup>><<rate_suffix>>" (e.g.
+			"reads_sum_per_sec").  The path_registry tracks the live series: those sent within series_idle_seconds (by
+			default, ten intervals and at least ten minutes).  The counter of a path not sampled for series_idle_seconds is
+			forgotten, whether or not its rate was sent.
 		"""
+		if priority not in self.priorities:
+			raise Exception('The priority must be one of {}.  User specified: {}'.format(self.priorities, priority))
+		if path_template and metric_path_function:
+			raise Exception('A metric path can be built from either a path_template or a metric_path_function, not both.')
+
 		# SELECT from table value functions must always be schema qualified.
 		if '.' not in function_name:
 			function_name = 'dbo.{}'.format(function_name)
@@ -60,8 +112,40 @@ class GraphiteSqlMetric(object):
 		self._data_columns = []	# The difference of all columns and the provided key_columns (i.e. those columns which hold graphable data).
 		self._data_metric_paths = {}	# dict uses data column as a key, and the formatable metric path (when provided key column value) as a value.
 
+		self._priority = priority
+		self._command_timeout_seconds = command_timeout_seconds
+		self._timeout_fraction = timeout_fraction
+		self._circuit_breaker = CircuitBreaker(breaker_timeouts
+			, breaker_cooldown_seconds if breaker_cooldown_seconds is not None else 5 * max(interval_seconds, 1))
+		self._counter_columns = set(counter_columns)
+		self._rate_suffix = rate_suffix
+		self._counter_rates = CounterRates()
+		self._execution_stats = ExecutionStats()
+		self._forward_raw = forward_raw
+		self._aggregator = None
+		if aggregate_seconds:
+			self.check_aggregate_seconds(aggregate_seconds, interval_seconds)
+			self._aggregator = MetricAggregator(aggregate_seconds, rollups)
+
+		self._path_template = path_template
+		self._template_columns = [field for literal, field, spec, conversion in Formatter().parse(path_template) if field] if path_template else []
+		self._path_key_columns = self._template_columns if path_template else list(key_columns)
+		self._path_cache_columns = list(path_columns) if path_columns is not None \
+			else None if metric_path_function else self._path_key_columns
+		self._path_cache_size = path_cache_size
+		self._path_cache = OrderedDict()	# (root path, key column values, data column): interned metric path, least recently used first
+
+		if (max_keys or top_n or key_rollups) and not self._path_key_columns:
+			raise Exception('Cardinality rules apply to keyed metrics: specify key_columns or a path_template.')
+		series_idle_seconds = series_idle_seconds if series_idle_seconds is not None else max(10 * interval_seconds, 600)
+		self._path_registry = PathRegistry(series_idle_seconds)
+		self._cardinality = CardinalityLimiter(self._path_key_columns, max_keys, top_n, top_column, other_key, key_rollups
+			, idle_seconds=series_idle_seconds) if (max_keys or top_n or key_rollups) else None
+
 		if metric_path_function:
 			self.__build_result_metric_path = metric_path_function
+		elif path_template:
+			self.__build_result_metric_path = self.__build_template_metric_key_path
 		else:
 			self.__build_result_metric_path = self.__build_generic_metric_key_path
 
@@ -73,17 +157,33 @@ class GraphiteSqlMetric(object):
 			return self._quoted_function_name
 		return self._function_name
 
+	unquoted_function_name = property(lambda self: self._function_name, None, None
+		, 'The schema qualified function name, as specified.')
+
 	interval_seconds = property(lambda self: self._interval_seconds)
 	@interval_seconds.setter
 	def interval_seconds(self, interval_seconds):
+		if self._aggregator is not None:
+			self.check_aggregate_seconds(self._aggregator.interval_seconds, interval_seconds)
+
+		self.check_interval(interval_seconds)
+		if interval_seconds > 0 and self._target is not None:
+			self._target.retention_map.check_interval(interval_seconds)
+			self._target.interval_root(interval_seconds)	# raises unless the server's retention schema matches the interval.
+
 		if interval_seconds == -1:
 			self._is_ready = False
 
 		if self._interval_seconds == -1 and interval_seconds > 0:	# metric was disabled, but should now be enabled
-			self._interval_seconds = self.check_interval(interval_seconds)
+			self._interval_seconds = interval_seconds
 			self.try_prepare()	# sets is_ready T or F
 		else:
-			self._interval_seconds = self.check_interval(interval_seconds)
+			self._interval_seconds = interval_seconds
+
+	def check_aggregate_seconds(self, aggregate_seconds, interval_seconds):
+		if interval_seconds > 0 and aggregate_seconds <= interval_seconds:
+			raise Exception('A metric must aggregate over a longer interval than it polls.  User specified {} seconds for a {} second metric.'.format(
+				aggregate_seconds, interval_seconds))
 
 	next_run_time = property(lambda self: self._next_run_time, None, None
 		, 'The next scheduled run date.')
@@ -108,6 +208,63 @@ class GraphiteSqlMetric(object):
 
 	is_ready = property(lambda self: self._is_ready)
 
+	columns = property(lambda self: list(self._columns), None, None
+		, 'All columns of the metric function, once prepared.')
+
+	select_statement = property(lambda self: "SELECT * FROM {}();".format(self.function_name), None, None
+		, 'The query which polls the metric function.')
+
+	priority = property(lambda self: self._priority, None, None
+		, 'The priority lane of the metric\'s items: critical, normal or bulk.')
+	@priority.setter
+	def priority(self, value):
+		if value not in self.priorities:
+			raise Exception('The priority must be one of {}.  User specified: {}'.format(self.priorities, value))
+		self._priority = value
+
+	@property
+	def command_timeout_seconds(self):
+		""" The seconds after which the metric function is cancelled. """
+		if self._command_timeout_seconds is not None:
+			return self._command_timeout_seconds
+		return max(int(self._interval_seconds * self._timeout_fraction), 1)
+	@command_timeout_seconds.setter
+	def command_timeout_seconds(self, value):
+		self._command_timeout_seconds = value
+
+	path_registry = property(lambda self: self._path_registry, None, None
+		, 'The PathRegistry of the series the metric has sent recently.')
+
+	cardinality = property(lambda self: self._cardinality, None, None
+		, 'The CardinalityLimiter which bounds the keys the metric sends, or None.')
+
+	execution_stats = property(lambda self: self._execution_stats, None, None
+		, 'The ExecutionStats histograms of the query seconds, rows, values & path building seconds of each call.')
+
+	circuit_breaker = property(lambda self: self._circuit_breaker, None, None
+		, 'The CircuitBreaker which skips the metric after repeated timeouts; its trip_count & skip_count are reported.')
+
+	path_template = property(lambda self: self._path_template, None, None
+		, 'The format string of result columns from which each row\'s metric path is built, or None.')
+
+	path_cache_count = property(lambda self: len(self._path_cache), None, None
+		, 'The number of metric paths in the path cache.')
+
+	counter_columns = property(lambda self: sorted(self._counter_columns), None, None
+		, 'The data columns holding cumulative counters, which are sent as per second rates.')
+
+	counter_rates = property(lambda self: self._counter_rates, None, None
+		, 'The CounterRates which keeps the previous sample of each counter path.')
+
+	aggregator = property(lambda self: self._aggregator, None, None
+		, 'The MetricAggregator which rolls polled values up over a coarser interval, or None.')
+
+	forward_raw = property(lambda self: self._forward_raw, None, None
+		, 'When False, only the aggregated rollups of polled values are sent.')
+	@forward_raw.setter
+	def forward_raw(self, value):
+		self._forward_raw = bool(value)
+
 	def check_target_exception(self):
 		""" If an exception was captured on the target sql instance, it is cleared, and the function returns the exception message.
 			The function otherwise returns False.
@@ -123,6 +280,9 @@ class GraphiteSqlMetric(object):
 			function's column set.  All columns are stored to _columns, and all non-key columns are stored to _data_columns.
 
 			The metric's interval cannot be set to -1, as this denotes paused sampling.
+
+			When the target has a schema_catalog, the quoted name & columns are taken from it if present, and stored to it
+			once described otherwise.
 		"""
 		self._is_ready = False
 
@@ -132,19 +292,12 @@ class GraphiteSqlMetric(object):
 		if not self.target:
 			return False
 
-		self._quoted_function_name = self.target.quotename(self.function_name)
-		func_id = self.target.scalar_result("SELECT object_id(N'{}', N'IF');".format(self.function_name), log_query=True)
-
-		if self.target.is_null_or_none(func_id):
-			sqlmsg = self.check_target_exception()
-			print( "The object {} is required, but was not found in the {} catalog, on the server: {}\n{}".format(
-				self.function_name, self.target.db, self.target.instance, sqlmsg if sqlmsg else ""
-				))
-			return False
-
-		self._columns = [c.name for c in self.target.get_columns(self.function_name)]
-
-		if self.check_target_exception():
+		catalog = getattr(self.target, 'schema_catalog', None)
+		entry = catalog.get(self.target.instance, self.target.db, self._function_name) if catalog is not None else None
+		if entry is not None:
+			self._quoted_function_name = entry['quoted_name']
+			self._columns = list(entry['columns'])
+		elif not self.__describe_function(catalog):
 			return False
 
 		missing_keys = [c for c in self._key_columns if c not in self._columns]
@@ -153,7 +306,21 @@ class GraphiteSqlMetric(object):
 				"The columns {} sent to the GraphiteSqlMetric as key_columns were not found in the metric function's column set.".format(missing_keys))
 			return False
 
-		self._data_columns = [c for c in self._columns if c not in self._key_columns]
+		missing_template_columns = [c for c in self._template_columns if c not in self._columns]
+		if missing_template_columns:
+			raise Exception(
+				"The columns {} named in the GraphiteSqlMetric's path_template were not found in the metric function's column set.".format(missing_template_columns))
+		self.__compile_path_template()
+
+		self._data_columns = [c for c in self._columns if c not in self._key_columns and c not in self._template_columns]
+
+		missing_counters = [c for c in self._counter_columns if c not in self._data_columns]
+		if missing_counters:
+			raise Exception(
+				"The columns {} sent to the GraphiteSqlMetric as counter_columns were not found in the metric function's data columns.".format(missing_counters))
+		if self._cardinality is not None and self._cardinality.top_column and self._cardinality.top_column not in self._data_columns:
+			raise Exception(
+				"The top_column {} of the GraphiteSqlMetric was not found in the metric function's data columns.".format(self._cardinality.top_column))
 		# self._data_metric_paths = dict([(c, self._build_full_metric_path(c)) for c in self._data_columns])
 
 		self.target.info("The metric <<{}>> is ready on {}.".format(self.name, self.target.instance))
@@ -168,27 +335,180 @@ class GraphiteSqlMetric(object):
 			return ""
 		return '.'.join([result[c].replace(' ', '_') for c in self._key_columns])
 
+	def __describe_function(self, catalog=None):
+		""" Quotes the function name and reads its columns from the server, storing them to the catalog if one is given. """
+		self._quoted_function_name = self.target.quotename(self._function_name)
+		if catalog is not None:
+			versions = catalog.object_versions(self.target, [self._function_name])
+			version = versions.get(self._function_name) if versions else None
+			func_id = version[0] if version else None
+		else:
+			func_id = self.target.scalar_result("SELECT object_id(N'{}', N'IF');".format(self.function_name), log_query=True)
+
+		if self.target.is_null_or_none(func_id):
+			sqlmsg = self.check_target_exception()
+			print( "The object {} is required, but was not found in the {} catalog, on the server: {}\n{}".format(
+				self.function_name, self.target.db, self.target.instance, sqlmsg if sqlmsg else ""
+				))
+			return False
+
+		self._columns = [c.name for c in self.target.get_columns(self.function_name)]
+
+		if self.check_target_exception():
+			return False
+
+		if catalog is not None:
+			catalog.put(self.target.instance, self.target.db, self._function_name, self._quoted_function_name, self._columns, version)
+		return True
+
+	def __compile_path_template(self):
+		""" Compiles the path template into a function of a result row, and empties the path cache. """
+		self._path_cache.clear()
+		if not self._path_template:
+			return
+		template = self._path_template.format
+		columns = self._template_columns
+		self._compiled_path_template = lambda result: template(**dict([(c, '{}'.format(result[c]).replace(' ', '_')) for c in columns]))
+
+	def __build_template_metric_key_path(self, result):
+		if not result:
+			return ""
+		return self._compiled_path_template(result)
+
 	def build_full_metric_path(self, result, metric_measurement_name, root_path=""):
 		metric_path = append_dot(root_path) + append_dot(self._path_descriptor)
 		result_metric_path = metric_path + append_dot(self.__build_result_metric_path(result))
 		return result_metric_path + metric_measurement_name
 
+	def row_path_key(self, result, root_path=""):
+		""" Returns the part of the path cache key shared by all data columns of a result row; its key values are None
+			when the row's paths are not cached.
+		"""
+		if self._path_cache_columns is None:
+			return root_path, None
+		return root_path, tuple([result[c] for c in self._path_cache_columns])
+
+	def cached_metric_path(self, row_key, result, metric_measurement_name):
+		""" Returns the interned metric path of a data column in a result row, from the path cache when possible. """
+		if row_key[1] is None:
+			return intern_path(self.build_full_metric_path(result, metric_measurement_name, row_key[0]))
+		key = (row_key, metric_measurement_name)
+		path = self._path_cache.pop(key, None)
+		if path is None:
+			path = intern_path(self.build_full_metric_path(result, metric_measurement_name, row_key[0]))
+			if len(self._path_cache) >= self._path_cache_size:
+				self._path_cache.popitem(last=False)
+		self._path_cache[key] = path
+		return path
+
+	def result_rows(self, results):
+		""" Generator function yields, for each row of a columnar query result (see SqlServerConnectionBase.query_columns),
+			a dict of the row's key columns (from which its metric path is built) and the list of its data column values.
+		"""
+		if not results:
+			return
+		key_columns = [c for c in self._columns if c not in self._data_columns]
+		key_arrays = [results[c] for c in key_columns]
+		data_arrays = [results[c] for c in self._data_columns]
+		for i in range(len(results[self._columns[0]]) if self._columns else 0):
+			yield dict([(c, array[i]) for c, array in zip(key_columns, key_arrays)]), [array[i] for array in data_arrays]
+
+	def __counter_row_rates(self, result, row_values, root_path, timestamp):
+		""" Returns a row's data values, with the per second rate (or None) of each counter column in place of its value. """
+		row_key = self.row_path_key(result, root_path)
+		return [self._counter_rates.rate(self.cached_metric_path(row_key, result, column + self._rate_suffix), value, timestamp)
+			if column in self._counter_columns and value is not None else value
+			for column, value in zip(self._data_columns, row_values)]
+
+	def ensure_ready(self):
+		return self.is_ready or self.try_prepare()
+
 	def __call__(self, queue, root_path="", log_query=False):
-		if not self.is_ready:
-			if not self.try_prepare():
-				return False
+		if not self.ensure_ready():
+			return False
+
+		query_start = time.time()
+		if not self._circuit_breaker.allow(query_start):
+			self.target.debug("Skipped <<{}>> on {}; its circuit breaker is open.".format(self.name, self.target.instance))
+			return False
 
 		self.target.debug("Calling <<{}>> on {}.".format(self.name, self.target.instance))
 
-		ts = int(time.time())	# epoch time truncated to second
+		results = self.target.query_columns(self.select_statement, self._columns, log_query=log_query
+			, timeout_seconds=self.command_timeout_seconds)
+		self.record_outcome(results is not False, self.target.timed_out)
+		return self.emit(queue, results, root_path, query_start, time.time())
 
-		for result in self.target.query_results(
-				"SELECT * FROM {}();".format(self.function_name), log_query=log_query):
-			if result:
-				for column in self._data_columns:
-					queue.Enqueue(
-						dict(graphite_path=self.build_full_metric_path(result, column, root_path), value=result[column], timestamp=ts)
-						)
+	def record_outcome(self, succeeded, timed_out=False):
+		""" Records the outcome of a call of the metric function with its circuit breaker.  Only timeouts count towards
+			tripping it; other errors (e.g. a dropped function) are logged by the target as before.
+		"""
+		if succeeded:
+			self._circuit_breaker.record_success()
+		elif timed_out:
+			if self._circuit_breaker.record_failure():
+				self.target.warning("<<{}>> timed out {} times on {}; skipping it for {} seconds.".format(self.name
+					, self._circuit_breaker.failure_threshold, self.target.instance, self._circuit_breaker.cooldown_seconds))
+
+	def emit(self, queue, results, root_path="", query_start=None, query_end=None):
+		""" Enqueues the values of a columnar result of the metric function (see SqlServerConnectionBase.query_columns)
+			as one MetricBatch, along with any completed rollups.  query_start & query_end are the epoch times the query
+			ran between; the batch's timestamp is the query start.  Returns False if the target raised an exception.
+			With cardinality rules, the rows are limited & folded (see CardinalityLimiter) before their paths are built.
+		"""
+		scheduled = datetime_to_epoch(self._next_run_time) if self._next_run_time else None
+		query_start = query_start if query_start is not None else time.time()
+		query_end = query_end if query_end is not None else query_start
+		ts = int(query_start)	# epoch time truncated to second
+		batch = MetricBatch(ts, priority=self._priority, key=(self.target.instance, root_path, self.name))
+
+		counter_columns = self._counter_columns
+		rows = len(results[self._columns[0]]) if results and self._columns else 0
+		values = 0
+		result_rows = ((result, row_values, '') for result, row_values in self.result_rows(results))
+		rated = self._cardinality is not None and bool(counter_columns)
+		if self._cardinality is not None:
+			if rated:
+				result_rows = [(result, self.__counter_row_rates(result, row_values, root_path, query_start), suffix)
+					for result, row_values, suffix in result_rows]
+			result_rows = self._cardinality.apply(list(result_rows), self._data_columns, ts)
+		registry = self._path_registry
+		for result, row_values, suffix in result_rows:
+			row_key = self.row_path_key(result, root_path)
+			for column, value in zip(self._data_columns, row_values):
+				if value is None:
+					continue
+				if column in counter_columns:
+					path = self.cached_metric_path(row_key, result, column + suffix + self._rate_suffix)
+					if not rated:
+						value = self._counter_rates.rate(path, value, query_start)
+						if value is None:
+							continue
+				else:
+					path = self.cached_metric_path(row_key, result, column + suffix)
+				registry.touch(path, ts)
+				if self._aggregator is not None:
+					for item in self._aggregator.add(path, value, ts):
+						item['priority'] = self._priority
+						queue.Enqueue(item)
+				if self._forward_raw:
+					batch.append(path, value)
+				values += 1
+
+		emitted = time.time()
+		if results is not False:
+			self._execution_stats.record(query_end - query_start, rows, values, emitted - query_end)
+			registry.expire(ts)
+			self._counter_rates.expire(query_start, registry.idle_seconds)
+
+		if batch.paths:
+			batch.trace = (scheduled, query_start, query_end, emitted)
+			queue.Enqueue(batch)
+
+		if self._aggregator is not None:
+			for item in self._aggregator.flush(ts):
+				item['priority'] = self._priority
+				queue.Enqueue(item)
 
 		if self.check_target_exception():
 			return False
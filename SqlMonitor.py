@@ -6,6 +6,7 @@ from datetime import datetime, timedelta
 from System.Threading import Timer, TimerCallback, Timeout
 
 from SqlServer import SqlServerConnectionBase as SqlConnection
+from RetentionSchemas import default_retention_map
 
 class SqlJob(object):
 
@@ -47,6 +48,10 @@ class SqlServerMonitor(SqlConnection):
 		self._queue = None
 		self._metrics = {}
 		self._graphite_root = graphite_root
+		self._batch_metrics = kwargs.pop('batch_metrics') if 'batch_metrics' in kwargs else True
+		self._schema_catalog = kwargs.pop('schema_catalog') if 'schema_catalog' in kwargs else None
+		self._retention_map = kwargs.pop('retention_map') if 'retention_map' in kwargs else default_retention_map
+		self._interval_roots = {}	# interval seconds: root path, validated against the retention map
 
 		# self._schedule_manager = ScheduleManager()
 
@@ -59,6 +64,25 @@ class SqlServerMonitor(SqlConnection):
 
 	name = property(lambda self: self._server_identifier)
 
+	schema_catalog = property(lambda self: self._schema_catalog, None, None
+		, 'The SchemaCatalog, shared among monitors, from which metrics are prepared without describing their function, or None.')
+	@schema_catalog.setter
+	def schema_catalog(self, value):
+		self._schema_catalog = value
+
+	retention_map = property(lambda self: self._retention_map, None, None
+		, 'The RetentionMap of the graphite server; the root path of each polling interval must be stored at that precision.')
+	@retention_map.setter
+	def retention_map(self, value):
+		self._retention_map = value
+		self._interval_roots = {}
+
+	batch_metrics = property(lambda self: self._batch_metrics, None, None
+		, 'When True, metrics due in the same tick are polled in one batch of queries over one connection.')
+	@batch_metrics.setter
+	def batch_metrics(self, value):
+		self._batch_metrics = bool(value)
+
 	def __getitem__(self, metric_name):
 		return self._metrics[metric_name]
 
@@ -68,22 +92,31 @@ class SqlServerMonitor(SqlConnection):
 	def graphite_root(self, value):
 		self._metric_root = value
 
-	def build_metric_root(self, metric_name):
-		""" Returns the root path of a given metric on a sql server.  Because graphite has different retention
-			policies for metrics that poll at 5, 15, or 60 seconds, this must be included in the root path.
+	def interval_root(self, interval_seconds):
+		""" Returns the root path of the metrics polled every interval_seconds on this sql server.  Graphite applies a
+			retention schema by path, so the interval is included in the root path, and the schema the retention map
+			applies to that root must store points every interval_seconds.
 		"""
-		# interval can be -1 when disabled.
-		if self[metric_name].interval_seconds < 0:
-			return None
+		root = self._interval_roots.get(interval_seconds)
+		if root is None:
+			root = self._graphite_root + '.' if self._graphite_root else ""
 
-		root = self._graphite_root + '.' if self._graphite_root else ""
+			root += self._server_identifier
 
-		root += self._server_identifier
-
-		root += ".{}seconds".format(self[metric_name].interval_seconds)
+			root += '.' + self._retention_map.interval_node(interval_seconds)
 
+			self._retention_map.check_root(root, interval_seconds)
+			self._interval_roots[interval_seconds] = root
 		return root
 
+	def build_metric_root(self, metric_name):
+		""" Returns the root path of a given metric on a sql server (see interval_root). """
+		# interval can be -1 when disabled.
+		if self[metric_name].interval_seconds < 0:
+			return None
+
+		return self.interval_root(self[metric_name].interval_seconds)
+
 	@SqlConnection.log_to('debug')
 	def add_metric(self, metric, interval_seconds=None):
 		if metric.name in self._metrics:
@@ -93,6 +126,9 @@ class SqlServerMonitor(SqlConnection):
 		m = deepcopy(metric)
 		if interval_seconds:
 			m.interval_seconds = interval_seconds
+		if m.interval_seconds > 0:
+			self._retention_map.check_interval(m.interval_seconds)
+			self.interval_root(m.interval_seconds)	# raises unless the server's retention schema matches the interval.
 		m.target = self
 		m.next_run_time = datetime.now() + timedelta(seconds=m.interval_seconds)
 		self._metrics[m.name] = m
@@ -130,27 +166,101 @@ class SqlServerMonitor(SqlConnection):
 		if not at_datetime:
 			at_datetime = datetime.now()
 		metrics = [self[m] for m in self.list_metrics() if at_datetime >= self[m].next_run_time]
+		ready = [metric for metric in metrics if metric.ensure_ready()]	# prepares each unprepared metric once per tick.
+
+		called = self.call_metrics_batched(ready, at_datetime) if self._batch_metrics and len(ready) > 1 else []
 
 		for metric in metrics:
+			if metric in ready and metric not in called:
+				try:
+					if metric(self._queue, root_path=self.build_metric_root(metric.name)):
+						metric.last_run_time = at_datetime
+				except (Exception) as e:
+					self.exception(e)
+					raise(e)
+
+			metric.next_run_time = at_datetime + timedelta(seconds=metric.interval_seconds)
+
+		if self._schema_catalog is not None:
+			self._schema_catalog.save_if_dirty()
+		return self
+
+	def circuit_counters(self):
+		""" Returns a dict of metric name: circuit breaker counters (failures, trips, skips & probes). """
+		return dict([(m, self[m].circuit_breaker.counters()) for m in self.list_metrics()])
+
+	def execution_summaries(self, reset=False):
+		""" Returns a dict of metric name: {measure: summary} of each metric's ExecutionStats (query seconds, rows, values &
+			path building seconds), from which the most expensive metric functions on the server can be found.
+		"""
+		summaries = [(m, self[m].execution_stats.summaries(reset)) for m in self.list_metrics()]
+		return dict([(m, summary) for m, summary in summaries if summary])
+
+	def live_series(self):
+		""" Returns a dict of metric name: the number of series the metric has sent recently (see PathRegistry). """
+		return dict([(m, self[m].path_registry.live_count) for m in self.list_metrics()])
+
+	def validate_schema_catalog(self):
+		""" Drops the catalog entries of this server's metric functions which were changed or dropped, with one query.
+			Returns the number of valid entries.
+		"""
+		if self._schema_catalog is None:
+			return 0
+		return self._schema_catalog.validate(self, [self[m].unquoted_function_name for m in self.list_metrics()])
+
+	def call_metrics_batched(self, metrics, at_datetime):
+		""" Polls all due metrics with one batch of queries over one connection, reading each metric's result set in turn.
+			The metrics must be ready (see GraphiteSqlMetric.ensure_ready).  The batch may run for the sum of the metrics'
+			command timeouts.  If one metric function fails or times out, the metrics read before it still report, and it and
+			the metrics after it are left to be called one at a time.  A timeout is not charged to the circuit breaker of the
+			metric which was running, as the metrics before it used up part of the batch's timeout; its own call is timed
+			against its own timeout.  Metrics whose circuit breaker is not closed are always called on their own.
+			Returns the metrics which were handled.
+		"""
+		ready = [metric for metric in metrics if metric.circuit_breaker.is_closed]
+		if len(ready) < 2:
+			return []
+
+		self.debug("Calling <<{}>> in one batch on {}.".format(', '.join([metric.name for metric in ready]), self.instance))
+		result_sets = self.query_column_sets([(metric.select_statement, metric.columns) for metric in ready]
+			, timeout_seconds=sum([metric.command_timeout_seconds for metric in ready]))
+		if result_sets is False:
+			self.clear_exception()
+			self.warning("The batch of {} metrics failed on {}; calling each metric on its own.".format(len(ready), self.instance))
+			return []
+		handled = ready[:len(result_sets)]
+		if len(result_sets) < len(ready):
+			failed = ready[len(result_sets)]
+			self.clear_exception()
+			self.warning("<<{}>> {} in a batch on {}; calling the {} metrics not handled on their own.".format(failed.name
+				, 'timed out' if self.timed_out else 'failed', self.instance, len(ready) - len(handled)))
+
+		for metric, results, (query_start, query_end) in zip(ready, result_sets, self.result_set_times):
+			metric.record_outcome(True)
 			try:
-				if metric(self._queue, root_path=self.build_metric_root(metric.name)):
+				if metric.emit(self._queue, results, self.build_metric_root(metric.name), query_start, query_end):
 					metric.last_run_time = at_datetime
 			except (Exception) as e:
 				self.exception(e)
 				raise(e)
-
-			metric.next_run_time = at_datetime + timedelta(seconds=metric.interval_seconds)
-
-		return self
+		return handled
 
 	def __call__(self, queue):
 		""" When the SqlServerMonitor is called, the timer is started, and individual metrics will be called
 			on their own individual schedules.  The results are enqueued in the queue object that is passed.
 		"""
-		self._queue = queue
+		self.attach(queue)
 		self.run()
 		return self
 
+	def attach(self, queue):
+		""" Sets the queue object in which metric results are enqueued, without starting the timer.  Used by runners
+			which schedule look_for_work themselves.
+		"""
+		self._queue = queue
+		self.validate_schema_catalog()
+		return self
+
 	def run(self):
 		self._t.Change(1000, 1000)	# wait one second, and begin calling look_for_work once a second.
 
@@ -1,11 +1,13 @@
 from __future__ import print_function, unicode_literals, division
 
 from collections import namedtuple	# get_columns result
+import math
+import time
 
 import clr
 clr.AddReference('System.Data')
 from System.Data.SqlClient import SqlConnection, SqlException, SqlCommand
-from System import Convert, InvalidOperationException
+from System import Convert, InvalidOperationException, Array, Object, DBNull
 
 from ApplicationBase import WindowsAppLoggingBase as Logging
 from LoggingBase import format_exception
@@ -42,6 +44,8 @@ class SqlServerConnectionBase(Logging):
 
 		self._exception_message = None
 		self._last_rowcount = 0
+		self._timed_out = False
+		self._result_set_times = []
 
 		super(SqlServerConnectionBase, self).__init__(**kwargs)
 
@@ -82,6 +86,12 @@ class SqlServerConnectionBase(Logging):
 
 	exception_message = property(lambda self: self._exception_message)
 
+	timed_out = property(lambda self: self._timed_out, None, None
+		, 'True when the last query_columns or query_column_sets call failed because its command timeout expired.')
+
+	result_set_times = property(lambda self: list(self._result_set_times), None, None
+		, 'The (start, end) epoch times of running & reading each result set of the last query_column_sets call.')
+
 	@property
 	def raised_exception(self):
 		return True if self._exception_message else False
@@ -181,11 +191,126 @@ class SqlServerConnectionBase(Logging):
 			yield False
 		except (SqlException) as e:
 			self._exception_message = e.Message
+			self._timed_out = self.is_timeout(e)
 			self.error("The query generated an exception:\n{}\n\n{}".format(query, self.exception_message))
 			self.exception(e)
 
 			yield False
 
+	@Logging.log_to('debug')
+	def query_columns(self, query, columns=None, db=None, log_query=False, timeout_seconds=None):
+		""" Returns the result of a query as a dict of column name: list of values, for the columns named (by default, all
+			columns).  Ordinals are resolved once, and each row is read with a single GetValues call into a reused object
+			array, rather than through the reader once per cell.  NULLs are returned as None.
+			With timeout_seconds, the command is cancelled once it runs that long (rather than the client's default 30
+			seconds), and timed_out is set.  Returns False if the query raised an exception.
+		"""
+		connection_string = "server={};database={};Trusted_Connection=True;".format(self.instance, db if db else self.db)
+		query = query.replace('\t', ' ')
+		if log_query:
+			self.info(query)
+
+		self._timed_out = False
+		try:
+			with SqlConnection(connection_string) as con:
+				with SqlCommand(query, con) as command:
+					self.__set_command_timeout(command, timeout_seconds)
+					con.Open()
+					reader = command.ExecuteReader()
+
+					self._last_rowcount = 0
+					result = self.__read_columns(reader, columns)
+					reader.Close()
+		except (InvalidOperationException) as i:
+			self._exception_message = i.Message
+			self.error("The connection defined is invalid:\n{}\n\n{}".format(connection_string, self.exception_message))
+			self.exception(i)
+
+			return False
+		except (SqlException) as e:
+			self._exception_message = e.Message
+			self._timed_out = self.is_timeout(e)
+			self.error("The query generated an exception:\n{}\n\n{}".format(query, self.exception_message))
+			self.exception(e)
+
+			return False
+
+		return result
+
+	@Logging.log_to('debug')
+	def query_column_sets(self, queries, db=None, log_query=False, timeout_seconds=None):
+		""" Runs a list of (query, columns) pairs as one batch over one connection, and returns a list with the columnar
+			result of each query (see query_columns), read in order with NextResult.  Each query must return exactly one
+			result set.  timeout_seconds applies to the whole batch.  If a query raises an exception, the result sets read
+			before it are returned, so that their count is the index of the failed query.  Returns False if the connection
+			is invalid.  The time each result set took is kept in result_set_times; the first includes connecting.
+		"""
+		connection_string = "server={};database={};Trusted_Connection=True;".format(self.instance, db if db else self.db)
+		batch = '\n'.join([query for query, columns in queries]).replace('\t', ' ')
+		if log_query:
+			self.info(batch)
+
+		result_sets = []
+		self._result_set_times = []
+		self._timed_out = False
+		set_start = time.time()
+		try:
+			with SqlConnection(connection_string) as con:
+				with SqlCommand(batch, con) as command:
+					self.__set_command_timeout(command, timeout_seconds)
+					con.Open()
+					reader = command.ExecuteReader()
+
+					self._last_rowcount = 0
+					for query, columns in queries:
+						if result_sets and not reader.NextResult():
+							break
+						result_sets.append(self.__read_columns(reader, columns))
+						set_end = time.time()
+						self._result_set_times.append((set_start, set_end))
+						set_start = set_end
+					reader.Close()
+		except (InvalidOperationException) as i:
+			self._exception_message = i.Message
+			self.error("The connection defined is invalid:\n{}\n\n{}".format(connection_string, self.exception_message))
+			self.exception(i)
+
+			return False
+		except (SqlException) as e:
+			self._exception_message = e.Message
+			self._timed_out = self.is_timeout(e)
+			self.error("Query {} of the batch generated an exception:\n{}\n\n{}".format(len(result_sets) + 1, batch
+				, self.exception_message))
+			self.exception(e)
+
+		return result_sets
+
+	def is_timeout(self, sql_exception):
+		""" SqlClient reports an expired command timeout as error number -2. """
+		return sql_exception.Number == -2
+
+	def __set_command_timeout(self, command, timeout_seconds):
+		if timeout_seconds is not None:
+			command.CommandTimeout = max(int(math.ceil(timeout_seconds)), 1)	# 0 would wait indefinitely.
+
+	def __read_columns(self, reader, columns=None):
+		""" Reads the reader's current result set into a dict of column name: list of values. """
+		if columns is None:
+			columns = [reader.GetName(i) for i in range(reader.FieldCount)]
+		ordinals = [reader.GetOrdinal(c) for c in columns]
+		arrays = [[] for c in columns]
+		values = Array.CreateInstance(Object, reader.FieldCount)
+		null = DBNull.Value
+
+		while reader.Read():
+			self._last_rowcount += 1
+			reader.GetValues(values)
+			row = list(values)
+			for array, ordinal in zip(arrays, ordinals):
+				value = row[ordinal]
+				array.append(None if value is null else value)
+		return dict(zip(columns, arrays))
+
 	def check_object_exists(self, object_name, object_type_code=None):
 		if object_type_code:
 			r = self.scalar_result(
@@ -0,0 +1,8 @@
+from __future__ import print_function, unicode_literals, division
+
+import os
+import sys
+
+# the modules live at the root of the repository (and the logging bases in ipy), rather than in a package.
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [root, os.path.join(root, 'ipy')]
@@ -0,0 +1,62 @@
+from __future__ import print_function, unicode_literals, division
+
+import unittest
+
+from CircuitBreaker import CircuitBreaker
+
+class CircuitBreakerTest(unittest.TestCase):
+
+	def test_trips_after_consecutive_failures(self):
+		breaker = CircuitBreaker(failure_threshold=3, cooldown_seconds=60)
+		self.assertFalse(breaker.record_failure(0))
+		self.assertFalse(breaker.record_failure(1))
+		self.assertEqual(breaker.state, 'closed')
+
+		self.assertTrue(breaker.record_failure(2))
+		self.assertEqual(breaker.state, 'open')
+		self.assertFalse(breaker.is_closed)
+
+	def test_success_resets_consecutive_failures(self):
+		breaker = CircuitBreaker(failure_threshold=2, cooldown_seconds=60)
+		breaker.record_failure(0)
+		breaker.record_success()
+		self.assertFalse(breaker.record_failure(1))
+		self.assertEqual(breaker.state, 'closed')
+
+	def test_skips_calls_during_cooldown(self):
+		breaker = CircuitBreaker(failure_threshold=1, cooldown_seconds=60)
+		breaker.record_failure(0)
+
+		self.assertFalse(breaker.allow(30))
+		self.assertFalse(breaker.allow(59))
+		self.assertEqual(breaker.skip_count, 2)
+
+	def test_probe_success_closes(self):
+		breaker = CircuitBreaker(failure_threshold=1, cooldown_seconds=60)
+		breaker.record_failure(0)
+
+		self.assertTrue(breaker.allow(60))
+		self.assertEqual(breaker.state, 'half_open')
+		self.assertFalse(breaker.allow(61))	# only one probe at a time.
+		breaker.record_success()
+		self.assertEqual(breaker.state, 'closed')
+		self.assertTrue(breaker.allow(62))
+
+	def test_probe_failure_reopens_for_another_cooldown(self):
+		breaker = CircuitBreaker(failure_threshold=3, cooldown_seconds=60)
+		for i in range(3):
+			breaker.record_failure(i)
+		self.assertTrue(breaker.allow(62))
+
+		self.assertTrue(breaker.record_failure(62))	# a failed probe trips at once.
+		self.assertEqual(breaker.state, 'open')
+		self.assertFalse(breaker.allow(100))
+		self.assertTrue(breaker.allow(122))
+		self.assertEqual(breaker.counters(), dict(failures=4, trips=2, skips=1, probes=2))
+
+	def test_rejects_threshold_below_one(self):
+		with self.assertRaises(Exception):
+			CircuitBreaker(failure_threshold=0)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,141 @@
+from __future__ import print_function, unicode_literals, division
+
+import bisect
+import socket
+import unittest
+from hashlib import md5
+
+from GraphiteDestinations import ConsistentHashRing, GraphiteDestinationSet
+from GraphiteSender import PartialSendError
+from MetricBatch import iter_datapoints, batch_datapoints
+
+def carbon_position(key):
+	return int(md5(key.encode('utf-8')).hexdigest()[:4], 16)
+
+def carbon_ring(nodes, replica_count=100):
+	""" The (position, node) entries of carbon-relay's ConsistentHashRing, built as carbon builds them. """
+	ring = []
+	for server, instance in nodes:
+		key = "('{}', {})".format(server, "'{}'".format(instance) if instance is not None else 'None')
+		for i in range(replica_count):
+			position = carbon_position('{}:{}'.format(key, i))
+			while position in [entry[0] for entry in ring]:
+				position += 1
+			bisect.insort(ring, (position, server, instance or ''))
+	return ring
+
+class FakeSender(object):
+
+	def __init__(self, server, port, **kwargs):
+		self.graphite_server = server
+		self.graphite_port = port
+		self.fail = False
+		self.fail_after = None
+		self.sent = []
+
+	def send(self, items):
+		if self.fail:
+			raise socket.error('connection refused')
+		datapoints = list(iter_datapoints(items))
+		if self.fail_after is not None and len(datapoints) > self.fail_after:
+			self.sent.extend([datapoint[0] for datapoint in datapoints[:self.fail_after]])
+			raise PartialSendError(batch_datapoints(datapoints[self.fail_after:]), 'connection reset')
+		self.sent.extend([datapoint[0] for datapoint in datapoints])
+		return 1
+
+	def flush(self):
+		return 0
+
+	def close(self):
+		pass
+
+class ConsistentHashRingTest(unittest.TestCase):
+
+	nodes = [('carbon1', 'a'), ('carbon2', 'a'), ('carbon3', None)]
+
+	def test_node_key_matches_carbon(self):
+		ring = ConsistentHashRing([('carbon1', 'a')], replica_count=1)
+		self.assertEqual(ring._ring[0][0], carbon_position("('carbon1', 'a'):0"))
+		ring = ConsistentHashRing([('carbon1', None)], replica_count=1)
+		self.assertEqual(ring._ring[0][0], carbon_position("('carbon1', None):0"))
+
+	def test_path_goes_to_first_replica_at_or_after_its_position(self):
+		ring = ConsistentHashRing(self.nodes)
+		expected = carbon_ring(self.nodes)
+		for path in ['servers.sql{}.waits.{}'.format(i, j) for i in range(20) for j in range(5)]:
+			position, server, instance = expected[bisect.bisect_left(expected, (carbon_position(path), )) % len(expected)]
+			self.assertEqual(ring.get_node(path), (server, instance or None))
+
+	def test_get_nodes_yields_each_node_once(self):
+		ring = ConsistentHashRing(self.nodes)
+		self.assertEqual(sorted(ring.get_nodes('a.b.c'), key=str), sorted(self.nodes, key=str))
+
+	def test_colliding_positions_are_moved_up(self):
+		ring = ConsistentHashRing([('carbon{}'.format(i), None) for i in range(200)])
+		self.assertEqual(len(set([entry[0] for entry in ring._ring])), len(ring._ring))
+
+	def test_removing_a_node_moves_only_its_paths(self):
+		ring = ConsistentHashRing(self.nodes)
+		paths = ['a.b.{}'.format(i) for i in range(500)]
+		before = dict([(path, ring.get_node(path)) for path in paths])
+		ring.remove_node(('carbon3', None))
+		for path in paths:
+			if before[path] != ('carbon3', None):
+				self.assertEqual(ring.get_node(path), before[path])
+			else:
+				self.assertNotEqual(ring.get_node(path), ('carbon3', None))
+
+	def test_removing_a_node_forgets_its_entries(self):
+		ring = ConsistentHashRing(self.nodes)
+		ring.remove_node(('carbon3', None))
+		self.assertEqual(sorted(ring._entry_nodes), ring._ring)
+		self.assertEqual(set(ring._entry_nodes.values()), set(self.nodes[:2]))
+
+class GraphiteDestinationSetTest(unittest.TestCase):
+
+	destinations = [('carbon1', 2004, 'a'), ('carbon2', 2004, 'a'), ('carbon3', 2004)]
+
+	def test_routes_to_replication_factor_distinct_destinations(self):
+		destinations = GraphiteDestinationSet(self.destinations, FakeSender, replication_factor=2)
+		for path in ['a.b.{}'.format(i) for i in range(50)]:
+			nodes = destinations.route(path)
+			self.assertEqual(len(set(nodes)), 2)
+			self.assertEqual(nodes[0], destinations.ring.get_node(path))
+
+	def test_fails_over_to_next_destination(self):
+		destinations = GraphiteDestinationSet(self.destinations, FakeSender)
+		paths = ['a.b.{}'.format(i) for i in range(50)]
+		down = destinations.ring.get_node(paths[0])
+		destinations[down].fail = True
+
+		destinations.send([dict(graphite_path=path, value=1, timestamp=1000) for path in paths])
+
+		sent = []
+		for node in destinations.ring.nodes:
+			sent.extend(destinations[node].sent)
+		self.assertEqual(sorted(sent), sorted(paths))
+		self.assertIn(down, destinations.down_nodes())
+		self.assertGreater(destinations.failover_count, 0)
+
+	def test_partial_send_fails_over_only_unsent_datapoints(self):
+		destinations = GraphiteDestinationSet(self.destinations, FakeSender)
+		paths = ['a.b.{}'.format(i) for i in range(50)]
+		destinations[destinations.ring.get_node(paths[0])].fail_after = 3
+
+		destinations.send([dict(graphite_path=path, value=1, timestamp=1000) for path in paths])
+
+		sent = []
+		for node in destinations.ring.nodes:
+			sent.extend(destinations[node].sent)
+		self.assertEqual(sorted(sent), sorted(paths))
+
+	def test_raises_unsent_datapoints_when_all_down(self):
+		destinations = GraphiteDestinationSet(self.destinations, FakeSender)
+		for node in destinations.ring.nodes:
+			destinations[node].fail = True
+
+		with self.assertRaises(PartialSendError):
+			destinations.send([dict(graphite_path='a.b', value=1, timestamp=1000)])
+
+if __name__ == '__main__':
+	unittest.main()
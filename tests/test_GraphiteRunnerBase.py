@@ -0,0 +1,110 @@
+from __future__ import print_function, unicode_literals, division
+
+import time
+import unittest
+
+from GraphiteRunnerBase import GraphiteRunnerBase
+
+class QuietLogging(object):
+	""" Stands in for a LoggingBase, keeping the messages logged. """
+
+	def __init__(self, **kwargs):
+		self.messages = []
+
+	def debug(self, message):
+		self.messages.append(message)
+
+	info = error = debug
+
+class Runner(GraphiteRunnerBase, QuietLogging):
+	pass
+
+class FakeSender(object):
+	""" Sends each chunk as one datagram, keeping the chunks sent. """
+
+	def __init__(self):
+		self.graphite_server = 'localhost'
+		self.graphite_port = 2003
+		self.chunks = []
+
+	def send(self, items):
+		self.chunks.append(list(items))
+		return 1
+
+	def flush(self):
+		return 0
+
+	def close(self):
+		pass
+
+def item(i, priority=None):
+	return dict(graphite_path='a.b{}'.format(i), value=i, timestamp=1000, priority=priority)
+
+def runner(count, **kwargs):
+	r = Runner(trace_latency=False, **kwargs)
+	r.silent = True
+	r._sender = FakeSender()
+	for i in range(count):
+		r.queue.Enqueue(item(i))
+	return r
+
+class ServerTest(unittest.TestCase):
+
+	def test_adding_a_server_is_logged(self):
+		r = runner(0)
+		r['sql1\\a'] = 'server'
+		self.assertEqual(r['sql1.a'], 'server')
+		self.assertTrue(r.messages[-1].startswith('Runner called __setitem__'))
+
+class DrainTest(unittest.TestCase):
+
+	def test_max_items_leaves_the_rest_queued(self):
+		r = runner(10)
+		self.assertEqual(r.drain(max_items=4, chunk_size=3), 4)
+		self.assertEqual([len(chunk) for chunk in r.sender.chunks], [3, 1])
+		self.assertEqual(r.queue.Count, 6)
+
+	def test_drains_in_chunks(self):
+		r = runner(10)
+		self.assertEqual(r.drain(chunk_size=3), 10)
+		self.assertEqual([len(chunk) for chunk in r.sender.chunks], [3, 3, 3, 1])
+		self.assertEqual(r.health()['datagrams_sent'], 4)
+
+	def test_past_deadline_sends_nothing(self):
+		r = runner(10)
+		self.assertEqual(r.drain(deadline=time.time() - 1), 0)
+		self.assertEqual(r.sender.chunks, [])
+		self.assertEqual(r.queue.Count, 10)
+
+	def test_steps_yield_after_each_chunk(self):
+		r = runner(10)
+		steps = r.drain_steps(chunk_size=4)
+		next(steps)
+		self.assertEqual((len(r.sender.chunks), r.queue.Count), (1, 6))
+		next(steps)
+		self.assertEqual((len(r.sender.chunks), r.queue.Count), (2, 2))
+
+	def test_critical_lane_drains_first_under_a_budget(self):
+		r = runner(0, priority_lanes=True)
+		for i in range(10):
+			r.queue.Enqueue(item(i, 'bulk'))
+		for i in range(10, 14):
+			r.queue.Enqueue(item(i, 'critical'))
+
+		r.drain(max_items=5, chunk_size=5)
+		sent = [i['priority'] for chunk in r.sender.chunks for i in chunk]
+		self.assertEqual(sent[:4], ['critical'] * 4)
+		self.assertEqual(r.queue.Count, 9)
+
+class HealthTest(unittest.TestCase):
+
+	def test_oldest_item_age_is_time_spent_queued(self):
+		r = runner(1)	# items are timestamped 1000, long before they were enqueued.
+		enqueued = r.queue.oldest_enqueue_time()
+		self.assertEqual(r.health(enqueued + 5)['oldest_item_age_seconds'], 5)
+
+		r.drain()
+		self.assertEqual(r.health()['oldest_item_age_seconds'], 0)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,180 @@
+from __future__ import print_function, unicode_literals, division
+
+import errno
+import pickle
+import socket
+import struct
+import unittest
+
+from GraphiteSender import GraphitePlaintextUdpSender, GraphitePickleTcpSender, PartialSendError, format_plaintext_lines
+from MetricBatch import MetricBatch, iter_datapoints
+
+class FakeSocket(object):
+	""" Accepts up to accept_bytes in total, then refuses with EAGAIN (or fails, with fail True). """
+
+	def __init__(self, accept_bytes=None, fail=False):
+		self.accept_bytes = accept_bytes
+		self.fail = fail
+		self.written = bytearray()
+		self.closed = False
+
+	def __room(self, data):
+		if self.accept_bytes is None:
+			return len(data)
+		return max(min(len(data), self.accept_bytes - len(self.written)), 0)
+
+	def send(self, data):
+		room = self.__room(data)
+		if not room:
+			if self.fail:
+				raise socket.error(errno.ECONNRESET, 'connection reset')
+			raise socket.error(errno.EAGAIN, 'would block')
+		self.written.extend(bytes(data[:room]))
+		return room
+
+	def sendall(self, data):
+		room = self.__room(data)
+		self.written.extend(bytes(data[:room]))
+		if room < len(data):
+			raise socket.error(errno.ECONNRESET, 'connection reset')
+
+	def settimeout(self, seconds):
+		pass
+
+	def setblocking(self, flag):
+		pass
+
+	def close(self):
+		self.closed = True
+
+def unframe(data):
+	""" Returns the pickled lists of a stream of length prefixed pickles. """
+	batches = []
+	while data:
+		length, = struct.unpack(b'!L', bytes(data[:4]))
+		batches.append(pickle.loads(bytes(data[4:4 + length])))
+		data = data[4 + length:]
+	return batches
+
+def batch(count, timestamp=1000):
+	return MetricBatch(timestamp, paths=['a.b{}'.format(i) for i in range(count)], values=list(range(count)))
+
+def connected(sender, fake):
+	sender._socket = fake	# connect returns an open socket as it is.
+	return sender
+
+class UdpPackTest(unittest.TestCase):
+
+	def setUp(self):
+		self.sender = GraphitePlaintextUdpSender('localhost', 2003, max_datagram_bytes=100)
+
+	def tearDown(self):
+		self.sender.close()
+
+	def test_datagrams_hold_whole_lines_under_the_limit(self):
+		items = [batch(20), batch(20, 1010)]
+		datagrams = [bytes(datagram) for datagram in self.sender.pack(items)]
+
+		self.assertGreater(len(datagrams), 1)
+		for datagram in datagrams:
+			self.assertLessEqual(len(datagram), 100)
+			self.assertTrue(datagram.endswith(b'\n'))
+		self.assertEqual(b''.join(datagrams).decode('utf-8'), format_plaintext_lines(items))
+
+	def test_datagrams_are_filled(self):
+		datagrams = [bytes(datagram) for datagram in self.sender.pack([batch(20)])]
+		for datagram, following in zip(datagrams, datagrams[1:]):
+			self.assertGreater(len(datagram) + len(following.split(b'\n')[0]) + 1, 100)
+
+	def test_long_line_is_sent_on_its_own(self):
+		path = 'a.' + 'b' * 120
+		items = [dict(graphite_path='a.b', value=1, timestamp=1000), dict(graphite_path=path, value=2, timestamp=1000)
+			, dict(graphite_path='a.c', value=3, timestamp=1000)]
+		datagrams = [bytes(datagram) for datagram in self.sender.pack(items)]
+
+		self.assertEqual(datagrams, [b'a.b 1 1000\n', '{} 2 1000\n'.format(path).encode('utf-8'), b'a.c 3 1000\n'])
+
+	def test_limit_is_validated(self):
+		with self.assertRaises(Exception):
+			self.sender.max_datagram_bytes = 70000
+
+class PicklePackTest(unittest.TestCase):
+
+	def test_frame_loads_back_to_path_timestamp_value(self):
+		sender = GraphitePickleTcpSender('carbon', 2004)
+		frames = list(sender.pack([dict(graphite_path='a.b', value='1.5', timestamp=1000), batch(2, 1010)]))
+
+		self.assertEqual(len(frames), 1)
+		length, = struct.unpack(b'!L', frames[0][:4])
+		self.assertEqual(length, len(frames[0]) - 4)
+		self.assertEqual(pickle.loads(frames[0][4:]), [('a.b', (1000, 1.5)), ('a.b0', (1010, 0.0)), ('a.b1', (1010, 1.0))])
+
+	def test_max_batch_size_splits_pickles(self):
+		sender = GraphitePickleTcpSender('carbon', 2004, max_batch_size=2)
+		self.assertEqual([len(b) for b in unframe(b''.join(sender.pack([batch(5)])))], [2, 2, 1])
+
+	def test_non_numeric_values_are_skipped(self):
+		sender = GraphitePickleTcpSender('carbon', 2004)
+		items = [dict(graphite_path='a', value=None, timestamp=1000), dict(graphite_path='b', value=2, timestamp=1000)]
+		self.assertEqual(unframe(b''.join(sender.pack(items))), [[('b', (1000, 2.0))]])
+
+class PickleSendTest(unittest.TestCase):
+
+	def test_blocking_failure_returns_only_unwritten_pickles(self):
+		fake = FakeSocket(accept_bytes=None)
+		sender = connected(GraphitePickleTcpSender('carbon', 2004, max_batch_size=2), fake)
+		fake.accept_bytes = len(list(sender.pack([batch(2)]))[0]) + 10	# the second pickle is cut off.
+
+		with self.assertRaises(PartialSendError) as raised:
+			sender.send([batch(5)])
+		self.assertEqual([path for path, value, timestamp in iter_datapoints(raised.exception.unsent_items)]
+			, ['a.b2', 'a.b3', 'a.b4'])
+		self.assertFalse(sender.is_connected)
+
+	def test_non_blocking_holds_what_the_socket_refuses(self):
+		fake = FakeSocket(accept_bytes=10)
+		sender = connected(GraphitePickleTcpSender('carbon', 2004, max_batch_size=2, wait_for_write=False), fake)
+
+		self.assertEqual(sender.send([batch(4)]), 0)	# nothing was written in full.
+		self.assertEqual(sender.pending_count, 2)
+		self.assertEqual(sender.pending_bytes, sum([len(f) for f in sender.pack([batch(4)])]) - 10)
+
+		fake.accept_bytes = None
+		self.assertEqual(sender.send([]), 2)
+		self.assertEqual((sender.pending_count, sender.pending_bytes), (0, 0))
+		self.assertEqual([len(b) for b in unframe(fake.written)], [2, 2])
+
+	def test_held_pickles_over_the_limit_are_returned(self):
+		fake = FakeSocket(accept_bytes=10)
+		sender = connected(GraphitePickleTcpSender('carbon', 2004, wait_for_write=False, max_pending_bytes=20), fake)
+
+		with self.assertRaises(PartialSendError) as raised:
+			sender.send([batch(3)])
+		self.assertEqual(len(list(iter_datapoints(raised.exception.unsent_items))), 3)
+		self.assertEqual((sender.pending_count, sender.pending_bytes), (0, 0))
+		self.assertTrue(fake.closed)
+
+	def test_close_keeps_held_pickles_to_rewrite_whole(self):
+		fake = FakeSocket(accept_bytes=10)
+		sender = connected(GraphitePickleTcpSender('carbon', 2004, wait_for_write=False), fake)
+		sender.send([batch(3)])
+		frame_bytes = sum([len(f) for f in sender.pack([batch(3)])])
+
+		sender.close()
+		self.assertEqual((sender.pending_count, sender.pending_bytes), (1, frame_bytes))
+
+		fake = connected(sender, FakeSocket())._socket
+		self.assertEqual(sender.flush(), 0)
+		self.assertEqual([len(b) for b in unframe(fake.written)], [3])
+
+	def test_reset_connection_returns_held_pickles(self):
+		fake = FakeSocket(accept_bytes=10, fail=True)
+		sender = connected(GraphitePickleTcpSender('carbon', 2004, wait_for_write=False), fake)
+
+		with self.assertRaises(PartialSendError) as raised:
+			sender.send([batch(3)])
+		self.assertEqual(len(list(iter_datapoints(raised.exception.unsent_items))), 3)
+		self.assertEqual(sender.pending_count, 0)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,96 @@
+from __future__ import print_function, unicode_literals, division
+
+import unittest
+
+from MetricAggregation import MetricAggregator, CounterRates
+
+class MetricAggregatorTest(unittest.TestCase):
+
+	def test_later_window_completes_the_open_one(self):
+		aggregator = MetricAggregator(60, ('avg', 'max'))
+		self.assertEqual(aggregator.add('a.b', 1, 1200), [])
+		self.assertEqual(aggregator.add('a.b', 3, 1230), [])
+
+		self.assertEqual(aggregator.add('a.b', 5, 1260), [dict(graphite_path='a.b_avg', value=2.0, timestamp=1200)
+			, dict(graphite_path='a.b_max', value=3.0, timestamp=1200)])
+		self.assertEqual(aggregator.window_count, 1)
+
+	def test_flush_completes_only_ended_windows(self):
+		aggregator = MetricAggregator(60)
+		aggregator.add('a.b', 1, 1200)
+		aggregator.add('a.c', 2, 1260)
+
+		self.assertEqual(aggregator.flush(1270), [dict(graphite_path='a.b_avg', value=1.0, timestamp=1200)])
+		self.assertEqual(aggregator.window_count, 1)
+		self.assertEqual(len(aggregator.flush(force=True)), 1)
+
+	def test_flush_forgets_the_rollup_paths_of_idle_paths(self):
+		aggregator = MetricAggregator(60)
+		for i in range(100):
+			aggregator.add('a.b{}'.format(i), i, 1200)
+			aggregator.add('a.b{}'.format(i), i, 1260)
+		aggregator.add('a.b0', 0, 1320)
+		self.assertEqual(len(aggregator._rollup_paths), 100)
+
+		aggregator.flush(1330)
+		self.assertEqual(list(aggregator._rollup_paths), ['a.b0'])
+		self.assertEqual(aggregator.window_count, 1)
+
+	def test_non_numeric_values_are_ignored(self):
+		aggregator = MetricAggregator(60)
+		self.assertEqual(aggregator.add('a.b', None, 1200), [])
+		self.assertEqual(aggregator.window_count, 0)
+
+	def test_rejects_unknown_rollups(self):
+		with self.assertRaises(Exception):
+			MetricAggregator(60, ('median', ))
+
+class CounterRatesTest(unittest.TestCase):
+
+	def test_first_sample_has_no_rate(self):
+		rates = CounterRates()
+		self.assertIsNone(rates.rate('a.reads', 100, 1000))
+		self.assertEqual(rates.rate('a.reads', 700, 1060), 10.0)
+		self.assertEqual((rates.first_count, rates.path_count), (1, 1))
+
+	def test_reset_counter_starts_a_new_baseline(self):
+		rates = CounterRates()
+		rates.rate('a.reads', 1000, 1000)
+		self.assertIsNone(rates.rate('a.reads', 30, 1060))	# e.g. SQL Server restarted.
+		self.assertEqual(rates.rate('a.reads', 90, 1120), 1.0)
+		self.assertEqual(rates.reset_count, 1)
+
+	def test_repeated_timestamp_has_no_rate_and_keeps_the_baseline(self):
+		rates = CounterRates()
+		rates.rate('a.reads', 100, 1000)
+		self.assertIsNone(rates.rate('a.reads', 200, 1000))
+		self.assertEqual(rates.rate('a.reads', 160, 1060), 1.0)
+
+	def test_non_numeric_value_has_no_rate(self):
+		rates = CounterRates()
+		self.assertIsNone(rates.rate('a.reads', None, 1000))
+		self.assertEqual(rates.path_count, 0)
+
+	def test_forget(self):
+		rates = CounterRates()
+		rates.rate('a.reads', 100, 1000)
+		rates.rate('a.writes', 100, 1000)
+		rates.forget('a.reads')
+		self.assertIsNone(rates.rate('a.reads', 160, 1060))
+		self.assertEqual(rates.rate('a.writes', 160, 1060), 1.0)
+
+		rates.forget()
+		self.assertEqual(rates.path_count, 0)
+
+	def test_expire_forgets_idle_paths(self):
+		rates = CounterRates()
+		rates.rate('a.reads', 100, 1000)
+		rates.rate('a.writes', 100, 1500)
+
+		self.assertEqual(rates.expire(1600, 600), 0)
+		self.assertEqual(rates.expire(1601, 600), 1)
+		self.assertIsNone(rates.rate('a.reads', 200, 1700))
+		self.assertEqual(rates.expired_count, 1)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,62 @@
+from __future__ import print_function, unicode_literals, division
+
+import unittest
+
+from MetricCardinality import CardinalityLimiter, PathRegistry
+
+def rows(*keyed_values):
+	return [(dict(database_name=key), list(values), '') for key, values in keyed_values]
+
+def by_key(result_rows):
+	return dict([(result['database_name'] + suffix, values) for result, values, suffix in result_rows])
+
+class CardinalityLimiterTest(unittest.TestCase):
+
+	data_columns = ['reads', 'writes']
+
+	def test_top_n_folds_the_rest_into_other(self):
+		limiter = CardinalityLimiter(['database_name'], top_n=2, top_column='reads')
+		result = limiter.apply(rows(('a', (1, 10)), ('b', (5, 20)), ('c', (3, 30)), ('d', (2, None))), self.data_columns, 1000)
+
+		self.assertEqual(by_key(result), {'b': [5, 20], 'c': [3, 30], 'other': [3, 10]})
+		self.assertEqual(limiter.folded_count, 2)
+
+	def test_max_keys_admits_first_keys_seen(self):
+		limiter = CardinalityLimiter(['database_name'], max_keys=2)
+		limiter.apply(rows(('a', (1, 1)), ('b', (1, 1))), self.data_columns, 1000)
+		result = limiter.apply(rows(('c', (4, 4)), ('a', (1, 1)), ('d', (2, 2))), self.data_columns, 1015)
+
+		self.assertEqual(by_key(result), {'a': [1, 1], 'other': [6, 6]})
+		self.assertEqual(limiter.admitted_count, 2)
+
+	def test_idle_key_frees_its_place(self):
+		limiter = CardinalityLimiter(['database_name'], max_keys=1, idle_seconds=60)
+		limiter.apply(rows(('a', (1, 1))), self.data_columns, 1000)
+
+		self.assertEqual(list(by_key(limiter.apply(rows(('b', (1, 1))), self.data_columns, 1030))), ['other'])
+		self.assertEqual(list(by_key(limiter.apply(rows(('b', (1, 1))), self.data_columns, 1061))), ['b'])
+
+	def test_rollups_across_all_keys(self):
+		limiter = CardinalityLimiter(['database_name'], rollups=('sum', 'max'))
+		result = limiter.apply(rows(('a', (1, 4)), ('b', (3, None))), self.data_columns, 1000)
+
+		self.assertEqual(by_key(result), {'a': [1, 4], 'b': [3, None], 'all_sum': [4, 4], 'all_max': [3, 4]})
+
+	def test_rejects_unknown_rollup(self):
+		with self.assertRaises(Exception):
+			CardinalityLimiter(['database_name'], rollups=('median', ))
+
+class PathRegistryTest(unittest.TestCase):
+
+	def test_expires_idle_paths(self):
+		registry = PathRegistry(idle_seconds=60)
+		registry.touch('a', 1000)
+		registry.touch('b', 1000)
+		registry.touch('a', 1050)
+
+		self.assertEqual(registry.expire(1061), ['b'])
+		self.assertEqual(registry.paths(), ['a'])
+		self.assertEqual((registry.created_count, registry.expired_count), (2, 1))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,80 @@
+from __future__ import print_function, unicode_literals, division
+
+import unittest
+
+from MetricBatch import MetricBatch
+from MetricFilters import SendOnChangeFilter
+
+def item(path, value, timestamp):
+	return dict(graphite_path=path, value=value, timestamp=timestamp)
+
+def sent(send_filter, items):
+	""" Filters the items, and commits what passed as sent. """
+	passed = send_filter(items)
+	send_filter.commit(passed)
+	return passed
+
+class SendOnChangeFilterTest(unittest.TestCase):
+
+	def test_unchanged_value_is_suppressed(self):
+		send_filter = SendOnChangeFilter(heartbeat_seconds=300)
+		self.assertEqual(len(sent(send_filter, [item('a', 1, 1000)])), 1)
+		self.assertEqual(sent(send_filter, [item('a', 1, 1060)]), [])
+		self.assertEqual(len(sent(send_filter, [item('a', 2, 1120)])), 1)
+		self.assertEqual(send_filter.counters(), dict(paths=1, changed=2, heartbeat=0, suppressed=1))
+
+	def test_unchanged_value_is_sent_on_the_heartbeat(self):
+		send_filter = SendOnChangeFilter(heartbeat_seconds=300)
+		sent(send_filter, [item('a', 1, 1000)])
+		self.assertEqual(sent(send_filter, [item('a', 1, 1299)]), [])
+		self.assertEqual(len(sent(send_filter, [item('a', 1, 1300)])), 1)
+		self.assertEqual(sent(send_filter, [item('a', 1, 1360)]), [])	# the heartbeat restarts from the last send.
+		self.assertEqual((send_filter.heartbeat_count, send_filter.suppressed_count), (1, 2))
+
+	def test_no_heartbeat_never_resends(self):
+		send_filter = SendOnChangeFilter(heartbeat_seconds=None)
+		sent(send_filter, [item('a', 1, 1000)])
+		self.assertEqual(sent(send_filter, [item('a', 1, 100000)]), [])
+
+	def test_nothing_is_recorded_until_commit(self):
+		send_filter = SendOnChangeFilter()
+		self.assertEqual(len(send_filter([item('a', 1, 1000)])), 1)
+		self.assertEqual(len(send_filter([item('a', 1, 1060)])), 1)	# the first send was never committed.
+		self.assertEqual(send_filter.path_count, 0)
+
+	def test_repeats_within_one_call_are_compared_to_each_other(self):
+		send_filter = SendOnChangeFilter()
+		passed = send_filter([item('a', 1, 1000), item('a', 1, 1060), item('a', 2, 1120)])
+		self.assertEqual([i['value'] for i in passed], [1, 2])
+
+	def test_batch_keeps_only_changed_datapoints(self):
+		send_filter = SendOnChangeFilter()
+		sent(send_filter, [MetricBatch(1000, paths=['a', 'b'], values=[1, 2], priority='critical')])
+
+		passed = sent(send_filter, [MetricBatch(1060, paths=['a', 'b'], values=[1, 3], priority='critical')
+			, MetricBatch(1060, paths=['c'], values=[1]), MetricBatch(1120, paths=['a'], values=[1])])
+		self.assertEqual([(batch.paths, batch.values) for batch in passed], [(['b'], [3]), (['c'], [1])])
+		self.assertEqual(passed[0].priority, 'critical')
+
+	def test_expire_drops_idle_paths_once_per_interval(self):
+		send_filter = SendOnChangeFilter(heartbeat_seconds=300)	# idle after 600 seconds
+		sent(send_filter, [item('a', 1, 1000), item('b', 1, 1500)])
+
+		self.assertEqual(send_filter.expire(1601), 1)
+		self.assertEqual(send_filter.path_count, 1)
+		self.assertEqual(send_filter.expire(2200, expire_interval_seconds=3600), 0)	# within the interval of the last expire.
+		self.assertEqual(send_filter.expire(2200), 1)
+		self.assertEqual(send_filter.expired_count, 2)
+
+	def test_forgotten_path_is_sent_again(self):
+		send_filter = SendOnChangeFilter()
+		sent(send_filter, [item('a', 1, 1000)])
+		send_filter.forget('a')
+		self.assertEqual(len(sent(send_filter, [item('a', 1, 1060)])), 1)
+
+	def test_rejects_negative_heartbeat(self):
+		with self.assertRaises(Exception):
+			SendOnChangeFilter(heartbeat_seconds=-1)
+
+if __name__ == '__main__':
+	unittest.main()
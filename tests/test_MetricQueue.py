@@ -0,0 +1,133 @@
+from __future__ import print_function, unicode_literals, division
+
+import threading
+import time
+import unittest
+
+from MetricBatch import MetricBatch
+from MetricQueue import BoundedMetricQueue, PriorityMetricQueue
+
+def item(path, value, timestamp=1000):
+	return dict(graphite_path=path, value=value, timestamp=timestamp)
+
+def drain(queue):
+	items = []
+	while True:
+		dequeued, item = queue.TryDequeue()
+		if not dequeued:
+			return items
+		items.append(item)
+
+class BoundedMetricQueueTest(unittest.TestCase):
+
+	def test_drop_oldest(self):
+		queue = BoundedMetricQueue(capacity=3, overflow_policy='drop_oldest')
+		for i in range(5):
+			self.assertTrue(queue.Enqueue(item('a.b', i)))
+
+		self.assertEqual([i['value'] for i in drain(queue)], [2, 3, 4])
+		self.assertEqual(queue.counters(), dict(depth=0, enqueued=5, dequeued=3, dropped=2, coalesced=0))
+
+	def test_drop_newest(self):
+		queue = BoundedMetricQueue(capacity=3, overflow_policy='drop_newest')
+		accepted = [queue.Enqueue(item('a.b', i)) for i in range(5)]
+
+		self.assertEqual(accepted, [True, True, True, False, False])
+		self.assertEqual([i['value'] for i in drain(queue)], [0, 1, 2])
+		self.assertEqual(queue.dropped_count, 2)
+
+	def test_block_times_out(self):
+		queue = BoundedMetricQueue(capacity=1, overflow_policy='block', block_timeout_seconds=0.05)
+		queue.Enqueue(item('a.b', 0))
+
+		started = time.time()
+		self.assertFalse(queue.Enqueue(item('a.b', 1)))
+		self.assertGreaterEqual(time.time() - started, 0.04)
+		self.assertEqual(queue.dropped_count, 1)
+
+	def test_block_waits_for_room(self):
+		queue = BoundedMetricQueue(capacity=1, overflow_policy='block', block_timeout_seconds=5.0)
+		queue.Enqueue(item('a.b', 0))
+		timer = threading.Timer(0.05, queue.TryDequeue)
+		timer.start()
+
+		self.assertTrue(queue.Enqueue(item('a.b', 1)))
+		timer.join()
+		self.assertEqual([i['value'] for i in drain(queue)], [1])
+		self.assertEqual(queue.dropped_count, 0)
+
+	def test_coalesce_keeps_newest_value_per_path(self):
+		queue = BoundedMetricQueue(capacity=10, overflow_policy='coalesce')
+		for path, value in (('a', 1), ('b', 1), ('a', 2), ('a', 3)):
+			queue.Enqueue(item(path, value))
+
+		self.assertEqual([(i['graphite_path'], i['value']) for i in drain(queue)], [('a', 3), ('b', 1)])
+		self.assertEqual(queue.coalesced_count, 2)
+
+	def test_coalesce_full_queue_drops_oldest(self):
+		queue = BoundedMetricQueue(capacity=2, overflow_policy='coalesce')
+		for path in ('a', 'b', 'c'):
+			queue.Enqueue(item(path, 1))
+
+		self.assertEqual([i['graphite_path'] for i in drain(queue)], ['b', 'c'])
+		self.assertEqual(queue.dropped_count, 1)
+
+	def test_batch_counts_its_datapoints(self):
+		queue = BoundedMetricQueue(capacity=5, overflow_policy='drop_oldest')
+		queue.Enqueue(item('a', 1))
+		queue.Enqueue(MetricBatch(1000, paths=['b', 'c', 'd', 'e'], values=[1, 2, 3, 4]))
+		self.assertEqual((queue.Count, queue.entry_count), (5, 2))
+
+		queue.Enqueue(item('f', 1))	# the single item is evicted to make room.
+		self.assertEqual((queue.Count, queue.entry_count, queue.dropped_count), (5, 2, 1))
+
+	def test_oversize_batch_accepted_into_empty_queue(self):
+		queue = BoundedMetricQueue(capacity=2, overflow_policy='drop_newest')
+		self.assertTrue(queue.Enqueue(MetricBatch(1000, paths=['a', 'b', 'c'], values=[1, 2, 3])))
+		self.assertFalse(queue.Enqueue(item('d', 1)))
+
+	def test_try_enqueue_never_evicts(self):
+		queue = BoundedMetricQueue(capacity=1, overflow_policy='drop_oldest')
+		queue.Enqueue(item('a', 1))
+
+		self.assertFalse(queue.TryEnqueue(item('b', 1)))
+		self.assertEqual([i['graphite_path'] for i in drain(queue)], ['a'])
+
+	def test_oldest_enqueue_time_is_when_queued_not_the_timestamp(self):
+		queue = BoundedMetricQueue(capacity=2, overflow_policy='drop_oldest')
+		self.assertIsNone(queue.oldest_enqueue_time())
+
+		before = time.time()
+		queue.Enqueue(item('a', 1, timestamp=0))
+		queue.Enqueue(item('b', 1, timestamp=0))
+		self.assertGreaterEqual(queue.oldest_enqueue_time(), before)
+
+		time.sleep(0.01)
+		after = time.time()
+		queue.Enqueue(item('c', 1))	# drops a
+		queue.TryDequeue()	# dequeues b
+		self.assertGreaterEqual(queue.oldest_enqueue_time(), after)
+
+class PriorityMetricQueueTest(unittest.TestCase):
+
+	def test_critical_lane_dequeued_first(self):
+		queue = PriorityMetricQueue()
+		queue.Enqueue(dict(item('bulk', 1), priority='bulk'))
+		queue.Enqueue(item('normal', 1))
+		queue.Enqueue(dict(item('critical', 1), priority='critical'))
+
+		self.assertEqual([i['graphite_path'] for i in drain(queue)], ['critical', 'normal', 'bulk'])
+
+	def test_oldest_enqueue_time_across_lanes(self):
+		queue = PriorityMetricQueue()
+		queue.Enqueue(dict(item('bulk', 1), priority='bulk'))
+		enqueued = queue['bulk'].oldest_enqueue_time()
+		time.sleep(0.01)
+		queue.Enqueue(dict(item('critical', 1), priority='critical'))
+
+		self.assertEqual(queue.oldest_enqueue_time(), enqueued)
+		drain(queue)
+		self.assertIsNone(queue.oldest_enqueue_time())
+
+if __name__ == '__main__':
+	unittest.main()
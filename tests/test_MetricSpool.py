@@ -0,0 +1,88 @@
+from __future__ import print_function, unicode_literals, division
+
+import shutil
+import tempfile
+import unittest
+
+from MetricBatch import MetricBatch
+from MetricSpool import MetricSpool
+
+def items(count, start=0):
+	return [dict(graphite_path='a.b{}'.format(i), value=i, timestamp=1000 + i) for i in range(start, start + count)]
+
+class MetricSpoolTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def spool(self, **kwargs):
+		kwargs.setdefault('fsync', False)
+		return MetricSpool(self.directory, **kwargs)
+
+	def test_replays_oldest_first(self):
+		spool = self.spool()
+		spool.append(items(3))
+		spool.append([MetricBatch(2000, paths=['c.d', 'c.e'], values=[1, 2])])
+
+		replayed, position = spool.peek(10)
+		self.assertEqual([i['graphite_path'] for i in replayed], ['a.b0', 'a.b1', 'a.b2', 'c.d', 'c.e'])
+		self.assertEqual(replayed[3]['timestamp'], 2000)
+		spool.close()
+
+	def test_peek_does_not_advance(self):
+		spool = self.spool()
+		spool.append(items(3))
+
+		first, position = spool.peek(2)
+		again, position = spool.peek(2)
+		self.assertEqual(first, again)
+
+		spool.advance(position, len(again))
+		rest, position = spool.peek(10)
+		self.assertEqual([i['graphite_path'] for i in rest], ['a.b2'])
+		self.assertEqual(spool.replayed_count, 2)
+		spool.close()
+
+	def test_resumes_from_offset_after_reopening(self):
+		spool = self.spool(segment_bytes=40)
+		spool.append(items(5))
+		replayed, position = spool.peek(2)
+		spool.advance(position, len(replayed))
+		spool.close()
+
+		spool = self.spool(segment_bytes=40)
+		replayed, position = spool.peek(10)
+		self.assertEqual([i['graphite_path'] for i in replayed], ['a.b2', 'a.b3', 'a.b4'])
+		spool.advance(position, len(replayed))
+		self.assertEqual(len(spool), 0)
+		spool.close()
+
+	def test_partial_line_is_not_replayed(self):
+		spool = self.spool()
+		spool.append(items(1))
+		spool.close()
+		with open(spool.segment_path(0), 'ab') as f:
+			f.write(b'a.b9 9')	# a write interrupted mid line.
+
+		spool = self.spool()
+		replayed, position = spool.peek(10)
+		self.assertEqual([i['graphite_path'] for i in replayed], ['a.b0'])
+		spool.close()
+
+	def test_discards_oldest_segments_over_max_bytes(self):
+		spool = self.spool(segment_bytes=20, max_bytes=60)
+		for i in range(10):
+			spool.append(items(1, i))
+
+		self.assertLessEqual(spool.depth_bytes, 60)
+		self.assertGreater(spool.discarded_bytes, 0)
+		replayed, position = spool.peek(10)
+		self.assertEqual(replayed[-1]['graphite_path'], 'a.b9')
+		self.assertNotIn('a.b0', [i['graphite_path'] for i in replayed])
+		spool.close()
+
+if __name__ == '__main__':
+	unittest.main()
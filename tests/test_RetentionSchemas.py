@@ -0,0 +1,79 @@
+from __future__ import print_function, unicode_literals, division
+
+import unittest
+
+from RetentionSchemas import RetentionMap, RetentionSchema, parse_retention, default_retention_map
+
+storage_schemas = """[carbon]
+pattern = ^carbon\\.
+retentions = 60:90d
+
+[ceci_10seconds]
+pattern = \\.10seconds\\.
+retentions = 10s:14d, 1m:90d
+
+[default]
+pattern = .*
+retentions = 60s:1y
+"""
+
+class ParseRetentionTest(unittest.TestCase):
+
+	def test_precision_and_duration_units(self):
+		self.assertEqual(parse_retention('10s:14d'), (10, 120960))
+		self.assertEqual(parse_retention('1m:1y'), (60, 525600))
+		self.assertEqual(parse_retention(' 1H:2Y '), (3600, 17520))
+
+	def test_seconds_per_point_and_points(self):
+		self.assertEqual(parse_retention('60:1440'), (60, 1440))
+
+	def test_rejects_unknown_units(self):
+		for retention in ('10x:14d', '10s', 'ten:14d'):
+			with self.assertRaises(Exception):
+				parse_retention(retention)
+
+class RetentionMapTest(unittest.TestCase):
+
+	def setUp(self):
+		self.retention_map = RetentionMap.parse(storage_schemas)
+
+	def test_parse_keeps_schema_order(self):
+		self.assertEqual([schema.name for schema in self.retention_map.schemas], ['carbon', 'ceci_10seconds', 'default'])
+		self.assertEqual(self.retention_map.schemas[1].retentions, [(10, 120960), (60, 129600)])
+
+	def test_parse_requires_pattern_and_retentions(self):
+		with self.assertRaises(Exception):
+			RetentionMap.parse('[ceci]\nretentions = 10s:14d\n')
+		with self.assertRaises(Exception):
+			RetentionSchema('empty', '.*', [])
+
+	def test_first_matching_schema_applies(self):
+		self.assertEqual(self.retention_map.schema_for('carbon.agents.a').name, 'carbon')
+		self.assertEqual(self.retention_map.schema_for('servers.sql1.10seconds.waits').name, 'ceci_10seconds')
+		self.assertEqual(self.retention_map.schema_for('servers.sql1.waits').name, 'default')
+
+	def test_check_interval(self):
+		self.assertEqual(self.retention_map.intervals, [10, 60])
+		self.assertEqual(self.retention_map.check_interval(10), 10)
+		self.assertEqual(self.retention_map.check_interval(-1), -1)
+		with self.assertRaises(Exception):
+			self.retention_map.check_interval(15)
+
+	def test_check_root(self):
+		root = 'servers.sql1.' + self.retention_map.interval_node(10)
+		self.assertEqual(root, 'servers.sql1.10seconds')
+		self.assertEqual(self.retention_map.check_root(root, 10).name, 'ceci_10seconds')
+		with self.assertRaises(Exception):
+			self.retention_map.check_root('servers.sql1.60seconds', 10)	# stored by the default schema, at 60 seconds.
+
+	def test_check_root_requires_a_matching_schema(self):
+		with self.assertRaises(Exception):
+			RetentionMap.parse('[carbon]\npattern = ^carbon\\.\nretentions = 60:90d\n').check_root('servers.sql1.60seconds', 60)
+
+	def test_default_map_has_ceci_intervals(self):
+		self.assertEqual(default_retention_map.intervals, [5, 15, 60])
+		for interval in (5, 15, 60):
+			default_retention_map.check_root('servers.sql1.{}seconds'.format(interval), interval)
+
+if __name__ == '__main__':
+	unittest.main()
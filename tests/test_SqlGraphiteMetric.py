@@ -0,0 +1,160 @@
+from __future__ import print_function, unicode_literals, division
+
+import unittest
+from copy import deepcopy
+
+from MetricQueue import BoundedMetricQueue
+from RetentionSchemas import default_retention_map
+from SqlGraphiteMetric import GraphiteSqlMetric
+
+class Column(object):
+
+	def __init__(self, name):
+		self.name = name
+
+class FakeTarget(object):
+	""" Stands in for a SqlServerMonitor, whose metric function returns one row per drive. """
+	instance = 'sql1'
+	db = 'monitor'
+	raised_exception = False
+	timed_out = False
+	columns = ('database_file_type', 'physical_drive_letter', 'reads', 'writes')
+	retention_map = default_retention_map
+
+	def __init__(self, drives=3):
+		self.drives = drives
+
+	def debug(self, message):
+		pass
+
+	info = warning = debug
+
+	def interval_root(self, interval_seconds):
+		root = 'servers.sql1.' + self.retention_map.interval_node(interval_seconds)
+		self.retention_map.check_root(root, interval_seconds)
+		return root
+
+	def quotename(self, name):
+		return '[{}]'.format(name)
+
+	def scalar_result(self, query, log_query=False):
+		return 1
+
+	def is_null_or_none(self, value):
+		return value is None
+
+	def get_columns(self, function_name):
+		return [Column(c) for c in self.columns]
+
+	def query_columns(self, query, columns=None, log_query=False, timeout_seconds=None):
+		return dict(database_file_type=['ROWS data'] * self.drives, physical_drive_letter=['C{}'.format(i) for i in range(self.drives)]
+			, reads=list(range(self.drives)), writes=list(range(self.drives)))
+
+def poll(metric, times=1):
+	""" Calls the metric, and returns the paths of the batches it enqueued. """
+	queue = BoundedMetricQueue()
+	for i in range(times):
+		metric(queue, root_path='servers.sql1')
+	batches = []
+	while True:
+		dequeued, batch = queue.TryDequeue()
+		if not dequeued:
+			return batches
+		batches.append(batch.paths)
+
+class GraphiteSqlMetricPathCacheTest(unittest.TestCase):
+
+	def metric(self, **kwargs):
+		metric = GraphiteSqlMetric('io_stats', metric_name='io', interval_seconds=15, **kwargs)
+		metric.target = FakeTarget()
+		return metric
+
+	def test_template_paths_are_cached_and_reused(self):
+		metric = self.metric(path_template='IO.{database_file_type}.{physical_drive_letter}')
+		first, second = poll(metric, 2)
+
+		self.assertEqual(first[:2], ['servers.sql1.IO.ROWS_data.C0.reads', 'servers.sql1.IO.ROWS_data.C0.writes'])
+		self.assertEqual(metric.path_cache_count, 6)
+		self.assertTrue(all([a is b for a, b in zip(first, second)]))
+
+	def test_key_column_paths_are_cached(self):
+		metric = self.metric(key_columns=['database_file_type', 'physical_drive_letter'])
+		self.assertEqual(poll(metric)[0][:1], ['servers.sql1.ROWS_data.C0.reads'])
+		self.assertEqual(metric.path_cache_count, 6)
+
+	def test_cache_is_bounded(self):
+		metric = self.metric(key_columns=['database_file_type', 'physical_drive_letter'], path_cache_size=4)
+		metric.target.drives = 10
+		self.assertEqual(len(poll(metric)[0]), 20)
+		self.assertEqual(metric.path_cache_count, 4)
+
+	def test_path_function_is_not_cached_without_path_columns(self):
+		calls = []
+		def drive_path(result):
+			calls.append(result)
+			return 'IO.' + result['physical_drive_letter']
+		metric = self.metric(key_columns=['database_file_type', 'physical_drive_letter'], metric_path_function=drive_path)
+		poll(metric, 2)
+
+		self.assertEqual(metric.path_cache_count, 0)
+		self.assertEqual(len(calls), 12)	# once per row & data column, on every poll.
+
+	def test_path_function_is_cached_by_path_columns(self):
+		calls = []
+		def drive_path(result):
+			calls.append(result)
+			return 'IO.' + result['physical_drive_letter']
+		metric = self.metric(key_columns=['database_file_type', 'physical_drive_letter'], metric_path_function=drive_path
+			, path_columns=['physical_drive_letter'])
+		first, second = poll(metric, 2)
+
+		self.assertEqual(first, second)
+		self.assertEqual(first[0], 'servers.sql1.IO.C0.reads')
+		self.assertEqual(len(calls), 6)	# only on the first poll.
+
+	def test_row_path_key(self):
+		metric = self.metric(path_template='IO.{physical_drive_letter}')
+		result = dict(database_file_type='ROWS data', physical_drive_letter='C')
+		self.assertEqual(metric.row_path_key(result, 'root'), ('root', ('C', )))
+
+class GraphiteSqlMetricIntervalTest(unittest.TestCase):
+
+	def test_interval_must_be_positive_or_disabled(self):
+		with self.assertRaises(Exception):
+			GraphiteSqlMetric('io_stats', interval_seconds=0)
+		metric = GraphiteSqlMetric('io_stats', interval_seconds=-1)
+		metric.interval_seconds = 7	# not yet added to a monitor, so not checked against a retention map.
+		self.assertEqual(metric.interval_seconds, 7)
+
+	def test_added_metric_interval_is_checked_against_the_retention_map(self):
+		metric = GraphiteSqlMetric('io_stats', interval_seconds=15)
+		metric.target = FakeTarget()
+		metric.interval_seconds = 60
+		self.assertEqual(metric.interval_seconds, 60)
+
+		with self.assertRaises(Exception):
+			metric.interval_seconds = 30
+		self.assertEqual(metric.interval_seconds, 60)
+
+		metric.interval_seconds = -1
+		self.assertEqual(metric.interval_seconds, -1)
+
+class GraphiteSqlMetricCopyTest(unittest.TestCase):
+
+	def test_deepcopy(self):
+		""" SqlServerMonitor.add_metric adds a deep copy of each metric, so every metric must survive one. """
+		metric = GraphiteSqlMetric('metrics.get_waits', key_columns=['wait_type'], interval_seconds=15
+			, aggregate_seconds=60, counter_columns=['wait_time_ms'], max_keys=10)
+		metric.execution_stats.record(0.5, 10, 20, 0.01)
+
+		copied = deepcopy(metric)
+
+		self.assertIsNot(copied.execution_stats, metric.execution_stats)
+		self.assertEqual(copied.execution_stats.summaries(), {})
+		self.assertEqual(copied.execution_stats['rows'].bounds, metric.execution_stats['rows'].bounds)
+		self.assertEqual(copied.interval_seconds, 15)
+		copied.execution_stats.record(1.0, 1, 1, 0.0)
+		self.assertEqual(metric.execution_stats['query_seconds'].count, 1)
+
+if __name__ == '__main__':
+	unittest.main()